@@ -1,26 +1,108 @@
-from core.models import Struct, template_tags
-from core.template import MetalTemplate
+from core.models import (Struct, publishing_tags, Template, Page, page_status,
+    TemplateMapping, FileInfo, template_type, mapped_value)
+from core.libs.peewee import fn
+from core.template import MetalTemplate, checked_registries
+from core.db.instrument import query_scope
 from core.error import PageTemplateError
+from collections import OrderedDict
+from threading import Lock
+from settings import TEMPLATE_CACHE_ENTRIES
+import hashlib, os
+
+class LRUCache():
+    '''
+    Dictionary-like cache that holds at most a fixed number of entries,
+    discarding the least recently used ones first, and counts hits and misses.
+
+    Keys are tuples whose first element is the ID of the blog
+    the entry belongs to, so that entries can be invalidated per blog.
+    Keys should also carry a version of whatever the entry was built from
+    (e.g., a template's ID and modification date), so that an entry
+    built from an outdated template is never found.
+    '''
+
+    def __init__(self, size=None):
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __getitem__(self, key):
+        with self.lock:
+            try:
+                value = self.entries[key]
+            except KeyError:
+                self.misses += 1
+                raise
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def __setitem__(self, key, value):
+        size = int(TEMPLATE_CACHE_ENTRIES) if self.size is None else self.size
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > size:
+                self.entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def invalidate(self, blog_id):
+        '''
+        Removes all the entries for a given blog.
+        '''
+        with self.lock:
+            for key in [k for k in self.entries if k[0] == blog_id]:
+                del self.entries[key]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
 
 class Cache():
-    template_cache = {}
-    blog_tag_cache = {}
-    path_cache = {}
-    module_cache = {}
-    include_cache = {}
+    template_cache = LRUCache()
+    blog_tag_cache = LRUCache()
+    path_cache = LRUCache()
+    module_cache = LRUCache()
+    include_cache = LRUCache()
+    template_registry_cache = LRUCache()
     # ssi_cache = {}
 
+    caches = ('template_cache', 'blog_tag_cache', 'path_cache',
+        'module_cache', 'include_cache', 'template_registry_cache')
+
     @classmethod
     def clear(self):
-        self.template_cache = {}
-        self.blog_tag_cache = {}
-        self.path_cache = {}
-        self.module_cache = {}
-        self.include_cache = {}
-        # self.ssi_cache = {}
+        for n in self.caches:
+            getattr(self, n).clear()
+
+    @classmethod
+    def invalidate_blog(self, blog_id):
+        for n in self.caches:
+            getattr(self, n).invalidate(blog_id)
+
+    @classmethod
+    def stats(self):
+        '''
+        Returns a list of (cache name, entries, hits, misses) for each cache.
+        '''
+        return [(n, len(getattr(self, n)), getattr(self, n).hits, getattr(self, n).misses)
+            for n in self.caches]
 
-def invalidate_cache():
-    Cache.clear()
+def invalidate_cache(blog=None):
+    '''
+    Invalidates cached templates, includes and modules.
+
+    :param blog:
+        If provided, only the entries for this blog are invalidated.
+    '''
+    if blog is None:
+        Cache.clear()
+    else:
+        Cache.invalidate_blog(getattr(blog, 'id', blog))
 
 save_action_list = Struct()
 
@@ -63,7 +145,173 @@ media_filetypes.types = {
     'png':media_filetypes.image,
     }
 
-def generate_page_text(f, tags):
+class TemplateRegistry():
+    '''
+    All of a blog's templates, by title, along with the file paths of its
+    server-side includes, loaded in one pass so that includes, SSIs and
+    modules can be looked up by name without querying the database.
+    See template_registry().
+    '''
+
+    def __init__(self, blog, stamp=None):
+        self.blog = blog
+        self.stamp = stamp if stamp is not None else self.read_stamp(blog)
+        self.templates = dict((n.title, n) for n in
+            Template.select().where(Template.blog == blog))
+        self.ssi_paths = None
+
+    @staticmethod
+    def read_stamp(blog):
+        '''
+        Returns the number of templates in a blog and the latest modification
+        date among them, read from the database. A registry whose stamp
+        doesn't match this is out of date, e.g. because a template was
+        edited or deleted by another process.
+
+        :param blog:
+            The blog ID to use.
+        '''
+        return Template.select(fn.COUNT(Template.id),
+            fn.MAX(Template.modified_date)).where(
+            Template.blog == blog).tuples().get()
+
+    def _ssi_paths(self):
+        return FileInfo.select(Template.title, FileInfo.file_path).join(
+            TemplateMapping).join(Template).where(
+            Template.blog == self.blog,
+            Template.template_type == template_type.include,
+            TemplateMapping.is_default == True).order_by(FileInfo.id.asc())
+
+    def get(self, title):
+        '''
+        Returns the blog's template with a given title.
+        Raises Template.DoesNotExist if there isn't one.
+
+        :param title:
+            The title of the template.
+        '''
+        try:
+            return self.templates[title]
+        except KeyError:
+            raise Template.DoesNotExist('Template {} not found.'.format(title))
+
+    def ssi_path(self, title):
+        '''
+        Returns the file path for the blog's server-side include with a given title.
+        Raises Template.DoesNotExist or FileInfo.DoesNotExist if there isn't one.
+
+        :param title:
+            The title of the include template.
+        '''
+        template = self.get(title)
+        if template.template_type != template_type.include:
+            raise Template.DoesNotExist('Template {} is not an include.'.format(title))
+
+        # The file path of the first fileinfo for each include template's
+        # default mapping. Fileinfo paths can change without any template
+        # changing, so they're loaded again each time the registry is checked.
+        ssi_paths = self.ssi_paths
+        if ssi_paths is None:
+            ssi_paths = {}
+            for ssi_title, file_path in self._ssi_paths().tuples():
+                ssi_paths.setdefault(ssi_title, file_path)
+            self.ssi_paths = ssi_paths
+        try:
+            return ssi_paths[title]
+        except KeyError:
+            raise FileInfo.DoesNotExist('No file found for include {}.'.format(title))
+
+
+def template_registry(blog):
+    '''
+    Returns the TemplateRegistry for a blog, loading it if needed.
+
+    A cached registry is checked against the blog's templates in the
+    database (see TemplateRegistry.read_stamp) before it's used, so edits
+    made by other processes are picked up. While a template is executing,
+    the check is made only once per blog for the outermost render.
+
+    :param blog:
+        The blog object, or blog ID, to use.
+    '''
+    blog_id = getattr(blog, 'id', blog)
+    checked = checked_registries()
+    if checked is not None and blog_id in checked:
+        return checked[blog_id]
+
+    stamp = TemplateRegistry.read_stamp(blog_id)
+    try:
+        registry = Cache.template_registry_cache[(blog_id,)]
+    except KeyError:
+        registry = None
+    if registry is None or registry.stamp != stamp:
+        registry = TemplateRegistry(blog_id, stamp)
+        Cache.template_registry_cache[(blog_id,)] = registry
+    else:
+        registry.ssi_paths = None
+
+    if checked is not None:
+        checked[blog_id] = registry
+    return registry
+
+
+def templates_version(blog):
+    '''
+    Returns the IDs and modification dates of the blog's templates that
+    other templates can load by name, as includes, SSIs or modules,
+    read from the database. While an IdentityMap is active, e.g. for
+    a batch of publishing jobs, they're read only once.
+
+    :param blog:
+        The blog object to use.
+    '''
+    return mapped_value(('templates_version', blog.id), lambda: tuple(
+        (n[0], str(n[1])) for n in Template.select(Template.id,
+        Template.modified_date).where(Template.blog == blog,
+        ~(Template.template_type << (template_type.index, template_type.page,
+            template_type.archive))).order_by(Template.id).tuples()))
+
+
+def render_fingerprint(f, tags):
+    '''
+    Returns a fingerprint of the inputs used to render a fileinfo:
+    the template and the templates it can load (see templates_version),
+    the modification date of the page being rendered (if any),
+    and the fileinfo's path and archive context.
+
+    Changes to anything else a template reads, such as another page,
+    a category or a setting, are not part of the fingerprint. Fileinfos
+    queued because of such a change have their fingerprints cleared
+    when they're queued (see core.cms.queue), and a forced republish
+    clears all of a blog's fingerprints.
+
+    :param f:
+        The fileinfo object to use.
+    :param tags:
+        The tagset the fileinfo will be rendered with.
+    '''
+
+    template = f.template_mapping.template
+
+    if tags.page is not None:
+        page_version = (tags.page.id, str(tags.page.modified_date))
+    else:
+        page_version = None
+
+    inputs = (
+        template.id,
+        str(template.modified_date),
+        templates_version(template.blog),
+        page_version,
+        sorted(f.context_values.items()),
+        f.file_path,
+        f.url,
+        )
+
+    return hashlib.sha1(repr(inputs).encode('utf8')).hexdigest()
+
+
+def generate_page_text(f, tags, fingerprint=None):
     '''
     Generates the text for a given page based on its fileinfo
     and a given tagset.
@@ -72,27 +320,41 @@ def generate_page_text(f, tags):
         The fileinfo object to use.
     :param tags:
         The tagset to use.
+    :param fingerprint:
+        The render fingerprint for the fileinfo, from render_fingerprint.
+        If this matches the fingerprint of the fileinfo's last successful
+        build and the file is still on disk, nothing is rendered
+        and None is returned.
     '''
 
+    if (fingerprint is not None and fingerprint == f.fingerprint
+            and os.path.isfile(f.sitewide_file_path)):
+        return None
+
     tp = f.template_mapping.template
 
+    # Keyed by the template body, so an edited template is never
+    # served from an entry compiled from its earlier version.
+    template_key = (tp.blog.id, tp.id, hash(tp.body))
+
     try:
-        tpx = Cache.template_cache[f.template_mapping.template.id]
+        tpx = Cache.template_cache[template_key]
 
     except KeyError:
         try:
-            pre_tags = Cache.blog_tag_cache[tp.blog.id]
+            pre_tags = Cache.blog_tag_cache[(tp.blog.id,)]
         except KeyError:
-            pre_tags = template_tags(blog=tp.blog)
+            pre_tags = publishing_tags(blog=tp.blog)
 
-        Cache.blog_tag_cache[tp.blog.id] = pre_tags
+        Cache.blog_tag_cache[(tp.blog.id,)] = pre_tags
 
         tpx = MetalTemplate(source=tp.body,
-            tags=pre_tags.__dict__)
-        Cache.template_cache[f.template_mapping.template.id] = tpx
+            tags=pre_tags.namespace, template_name=tp.title)
+        Cache.template_cache[template_key] = tpx
 
     try:
-        return tpx.render(**tags.__dict__)
+        with query_scope('render', tp.for_log, nested=True):
+            return tpx.render(tags.namespace)
 
     except Exception:
         import traceback, sys
@@ -8,9 +8,11 @@ from core.models import (Page, TagAssociation, Tag,
     Category, PageCategory, template_tags, page_status)
 
 from . import save_action_list  # , invalidate_cache
-from .queue import queue_page_actions, queue_ssi_actions, queue_index_actions, queue_page_archive_actions
+from .queue import (queue_page_actions, queue_ssi_actions, queue_index_actions, queue_page_archive_actions,
+                    queue_dependent_actions)
 from .fileinfo import (delete_page_fileinfo, build_archives_fileinfos, build_pages_fileinfos, delete_fileinfo_files,
-                       purge_fileinfos, build_indexes_fileinfos)
+                       purge_fileinfos, build_indexes_fileinfos, build_blog_fileinfos,
+                       update_archive_membership, update_page_fileinfos, clear_fingerprints)
 
 from settings import BASE_URL
 
@@ -40,6 +42,8 @@ def save_page(page, user, blog=None):
     save_action = int(request.forms.get('save'))
 
     original_page_status = page_status.unpublished
+    original_publication_date = None
+    original_categories, original_tags = set(), set()
     new_basename = getunicode('basename')
 
     if page is None:
@@ -72,6 +76,8 @@ def save_page(page, user, blog=None):
 
         original_page_status = page.status
         original_page_basename = page.basename
+        original_publication_date = page.publication_date
+        original_categories, original_tags = page_listings(page)
 
         page.modified_date = datetime.datetime.utcnow()
 
@@ -173,9 +179,7 @@ def save_page(page, user, blog=None):
             n.primary = True
             n.save()
 
-        delete_page_fileinfo(page)
-        build_archives_fileinfos((page,))
-        build_pages_fileinfos((page,))
+        update_page_fileinfos(page)
 
     # UPDATE TAGS
 
@@ -185,14 +189,37 @@ def save_page(page, user, blog=None):
         add_tags_to_page(tag_text, page)
         delete_orphaned_tags(page.blog)
 
+    # UPDATE ARCHIVE MEMBERSHIP
+
+    update_archive_membership(page.blog, (page,))
+
     # QUEUE CHANGES FOR PUBLICATION (if any)
 
     if ((save_action & save_action_list.UPDATE_LIVE_PAGE)
         and (page.status == page_status.published)):
 
-        queue_ssi_actions(page.blog)
         queue_page_actions((page,))
-        queue_index_actions(page.blog)
+
+        # Pages that list this page only need to be rebuilt if it's new,
+        # moved in time, or moved between categories or tags.
+
+        categories, tags = page_listings(page)
+
+        collection = (original_page_status != page.status or
+            original_publication_date != page.publication_date)
+
+        if collection:
+            categories |= original_categories
+            tags |= original_tags
+        else:
+            categories ^= original_categories
+            tags ^= original_tags
+
+        queue_dependent_actions(page.blog,
+            pages=(page,),
+            categories=categories,
+            tags=tags,
+            collection=collection)
 
         msg.append(" Live page updated.")
 
@@ -224,6 +251,22 @@ def save_page(page, user, blog=None):
 # Maybe both by way of a proxy
 
 
+def page_listings(page):
+    '''
+    Returns the sets of category IDs and tag IDs a page is listed under.
+
+    :param page:
+        The page object to use.
+    '''
+    categories = set(n for n, in PageCategory.select(PageCategory.category).where(
+        PageCategory.page == page).tuples())
+
+    tags = set(n for n, in TagAssociation.select(TagAssociation.tag).where(
+        TagAssociation.page == page).tuples())
+
+    return categories, tags
+
+
 def delete_orphaned_tags(blog):
     '''
     Cleans up tags that no longer have any page associations.
@@ -335,10 +378,16 @@ def unpublish_page(page, save=True):
     if save:
         page.save(page.user)
 
+    categories, tags = page_listings(page)
+
     queue_page_actions((page.next_page, page.previous_page,), no_neighbors=True)
     queue_page_archive_actions(page)
-    queue_ssi_actions(page.blog)
-    queue_index_actions(page.blog)
+    update_archive_membership(page.blog, (page,))
+    queue_dependent_actions(page.blog,
+        pages=(page,),
+        categories=categories,
+        tags=tags,
+        collection=True)
 
     delete_fileinfo_files(page.fileinfos)
 
@@ -379,12 +428,17 @@ def publish_blog(blog_id):
     pass
 
 
-def republish_blog(blog):
+def republish_blog(blog, force=False):
     '''
     Queues all published pages and index items for a given blog.
 
     :param blog:
         The blog object to republish.
+    :param force:
+        By default, files whose render fingerprints show that none of
+        their inputs have changed are not rendered again. Set this to True
+        to render every file again, e.g. after a change to something
+        the fingerprints don't cover, such as a category or a setting.
     '''
 
     data = []
@@ -393,9 +447,12 @@ def republish_blog(blog):
 
     begin = time.clock()
 
-    queue_ssi_actions(blog)
-    queue_page_actions(blog.pages.published.iterator(), no_neighbors=True)
-    queue_index_actions(blog, include_manual=True)
+    if force:
+        clear_fingerprints(blog)
+
+    queue_ssi_actions(blog, force=False)
+    queue_page_actions(blog.pages.published.iterator(), no_neighbors=True, force=False)
+    queue_index_actions(blog, include_manual=True, force=False)
 
     end = time.clock()
 
@@ -408,7 +465,11 @@ def republish_blog(blog):
 
 def purge_blog(blog):
     '''
-    Deletes all fileinfos from a given blog and recreates them.
+    Rebuilds all fileinfos for a given blog, in bulk.
+    Fileinfos that no longer match any template mapping are deleted;
+    fileinfos that are unchanged are kept, along with their digests,
+    but their render fingerprints are cleared, so that the next
+    republish renders every file again.
     This function may also eventually be expanded to delete all the files
     associated with a given blog (except for assets)
     No security checks are performed.
@@ -423,46 +484,20 @@ def purge_blog(blog):
 
     begin = time.clock()
 
-    fileinfos_purged, fileinfocontexts_purged = purge_fileinfos(blog.fileinfos)
+    result = build_blog_fileinfos(blog)
+    clear_fingerprints(blog)
 
-    erase = time.clock()
+    end = time.clock()
 
-    report.append("<hr/>{0} fileinfo objects (and {1} fileinfo context objects) erased in {2:.2f} seconds.".format(
-        fileinfos_purged,
-        fileinfocontexts_purged,
-        erase - begin
+    report.append("<hr/>{0} fileinfo objects created, {1} updated and {2} unchanged; {3} erased.".format(
+        len(result.inserted),
+        len(result.updated),
+        result.unchanged,
+        len(result.deleted)
         ))
 
-    includes_to_insert = blog.ssi_templates
-    includes_inserted = build_indexes_fileinfos(includes_to_insert)
-
-    ssi_time = time.clock()
-
-    report.append("<hr/>{0} server-side include objects created in {1:.2f} seconds.".format(
-        includes_inserted, ssi_time - erase))
-
-    # pages_inserted = build_pages_fileinfos(blog.pages)
-    pages_inserted = 0
-    rebuild = time.clock()
-
-    report.append("<hr/>{0} page objects created in {1:.2f} seconds,".format(pages_inserted,
-        rebuild - erase))
-
-    # f_i = build_archives_fileinfos(blog.published_pages)
-    f_i = 0
-    arch_obj = time.clock()
-    report.append("{0} archive page objects created in {1:.2f} seconds.".format(f_i,
-        arch_obj - rebuild))
-
-    index_objects = build_indexes_fileinfos(blog.index_templates)
-    index_obj = time.clock()
-    report.append("{0} index page objects created in {1:.2f} seconds.".format(index_objects,
-        index_obj - arch_obj))
-
-    end = time.clock()
-
-    total_objects = blog.pages.count() + f_i + blog.index_templates.count()
-    report.append("<hr/>Total objects created: <b>{}</b>.".format(total_objects))
+    total_objects = len(result.inserted) + len(result.updated) + result.unchanged
+    report.append("<hr/>Total objects: <b>{}</b>.".format(total_objects))
     report.append("Total processing time: <b>{0:.2f}</b> seconds.".format(end - begin))
     report.append("<hr/>It is recommended that you <a href='{}'>republish this blog</a>.".format(
         '{}/blog/{}/republish'.format(BASE_URL, blog.id)))
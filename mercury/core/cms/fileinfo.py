@@ -1,19 +1,23 @@
 import os, datetime
+from functools import lru_cache
+from collections import OrderedDict
+from itertools import product
 
 from core.utils import generate_date_mapping
 from core.error import ArchiveMappingFormatException, NoArchiveForFileInfo
 
 from core.models import (Page, TemplateMapping, TagAssociation, template_type,
-    Category, PageCategory, FileInfo, template_tags, User,
-    FileInfoContext)
+    Category, PageCategory, FileInfo, publishing_tags, User,
+    FileInfoContext, FileInfoDependency, archive_type, Template, Queue, db,
+    IdentityMap, Struct, page_status, PageArchiveFileInfo, Media, PageNeighbor,
+    Blog, Site)
 
 from core.libs.peewee import IntegrityError
 
 
 def eval_paths(path_string, dict_data):
-    path_obj = replace_mapping_tags(path_string)
     try:
-        paths = eval(path_obj, dict_data)
+        paths = eval(compile_mapping_path(path_string), dict_data)
     except Exception as e:
         paths = None
         # raise Exception('Invalid path string: {} // Data: {} // Exception: {}'.format(
@@ -23,6 +27,37 @@ def eval_paths(path_string, dict_data):
     return paths
 
 
+def eval_mapping_paths(mappings, pages):
+    '''
+    Evaluates the path expressions of a set of template mappings
+    over a batch of pages, with each expression compiled only once
+    and the template tags for each page built only once.
+    Yields (page, tags, mapping, paths) for each page and mapping,
+    where paths is the result of eval_paths().
+
+    :param mappings:
+        The template mappings to evaluate.
+    :param pages:
+        An iterable of Page objects.
+    '''
+    codes = []
+    for mapping in mappings:
+        try:
+            code = mapping.path_code
+        except SyntaxError:
+            code = None
+        codes.append((mapping, code))
+
+    for page in pages:
+        tags = publishing_tags(page=page)
+        for mapping, code in codes:
+            try:
+                paths = eval(code, tags.namespace) if code is not None else None
+            except Exception:
+                paths = None
+            yield page, tags, mapping, paths
+
+
 def generate_page_tags(f, blog):
     '''
     Returns the page text and the pathname for a file to generate.
@@ -37,7 +72,7 @@ def generate_page_tags(f, blog):
     if f.page is None:
 
         if f.xref.template.template_type == template_type.index:
-            tags = template_tags(blog=blog,
+            tags = publishing_tags(blog=blog,
                 template=f.xref.template,
                 fileinfo=f)
         else:
@@ -47,14 +82,14 @@ def generate_page_tags(f, blog):
 
             # The context object we use
 
-            tags = template_tags(blog=blog,
+            tags = publishing_tags(blog=blog,
                 template=f.xref.template,
                 archive=archive_pages,
                 archive_context=f,
                 fileinfo=f)
 
     else:
-        tags = template_tags(page=f.page,
+        tags = publishing_tags(page=f.page,
             template=f.xref.template,
             fileinfo=f)
 
@@ -76,24 +111,31 @@ def build_pages_fileinfos(pages, template_mappings=None):
 
     fileinfos = []
 
+    # Page mappings are the same for every page in a blog.
+    blog_mappings = {}
+    if template_mappings is not None:
+        template_mappings = list(template_mappings)
+
     for n, page in enumerate(pages):
 
         if template_mappings is None:
-            mappings = page.template_mappings
+            blog_id = page._data.get('blog')
+            if blog_id not in blog_mappings:
+                blog_mappings[blog_id] = list(page.template_mappings)
+            mappings = blog_mappings[blog_id]
         else:
             mappings = template_mappings
 
-        if mappings.count() == 0:
+        if len(mappings) == 0:
             raise TemplateMapping.DoesNotExist('No template mappings found for this page.')
 
-        tags = template_tags(page=page)
+        tags = publishing_tags(page=page)
 
         for t in mappings:
 
-            # path_string = replace_mapping_tags(t.path_string)
             path_string = generate_date_mapping(
                 page.publication_date_tz.date(), tags,
-                replace_mapping_tags(t.path_string))
+                t.path_code)
 
             # for tag archives, we need to return a list from the date mapping
             # in the event that we have a tag present that's an iterable like the tag list
@@ -130,46 +172,46 @@ def build_archives_fileinfos_by_mappings(template, pages=None, early_exit=False)
     # counter = 0
     mapping_list = {}
 
-    if pages is None:
+    all_pages = pages is None
+    if all_pages:
         pages = template.blog.pages.published
 
-    for page in pages:
-        tags = template_tags(page=page)
-        if page.archive_mappings.count() == 0:
+    mappings = list(template.mappings)
+
+    for page, tags, mapping, paths_list in eval_mapping_paths(mappings, pages):
+        if mapping is mappings[0] and page.archive_mappings.count() == 0:
             raise TemplateMapping.DoesNotExist('No template mappings found for the archives for this page.')
-        for mapping in template.mappings:
-            paths_list = eval_paths(mapping.path_string, tags.__dict__)
 
-            if type(paths_list) in (list,):
-                paths = []
-                for n in paths_list:
-                    if n is None:
-                        continue
-                    p = page.proxy(n[0])
-                    paths.append((p, n[1]))
-            else:
-                paths = (
-                    (page, paths_list)
-                    ,)
-
-            for page, path in paths:
-                path_string = generate_date_mapping(page.publication_date_tz,
-                    tags, path, do_eval=False)
-
-                if path_string == '' or path_string is None:
-                    continue
-                if path_string in mapping_list:
+        if type(paths_list) in (list,):
+            paths = []
+            for n in paths_list:
+                if n is None:
                     continue
+                p = page.proxy(n[0])
+                paths.append((p, n[1]))
+        else:
+            paths = (
+                (page, paths_list)
+                ,)
 
-                mapping_list[path_string] = (
-                    (None, mapping, path_string,
-                    page.blog.url + "/" + path_string,
-                    page.blog.path + '/' + path_string,)
-                    ,
-                    (page),
-                    )
+        for page, path in paths:
+            path_string = generate_date_mapping(page.publication_date_tz,
+                tags, path, do_eval=False)
+
+            if path_string == '' or path_string is None:
+                continue
+            if path_string in mapping_list:
+                continue
 
-        if early_exit and len(mapping_list) > 0:
+            mapping_list[path_string] = (
+                (None, mapping, path_string,
+                page.blog.url + "/" + path_string,
+                page.blog.path + '/' + path_string,)
+                ,
+                (page),
+                )
+
+        if early_exit and mapping is mappings[-1] and len(mapping_list) > 0:
             # return mapping_list
             break
 
@@ -200,6 +242,8 @@ def build_archives_fileinfos_by_mappings(template, pages=None, early_exit=False)
         new_fileinfo.save()
         fileinfo_list.append(new_fileinfo)
 
+    update_archive_membership(template.blog, None if all_pages else pages)
+
     return fileinfo_list
 
 def build_archives_fileinfos(pages):
@@ -212,18 +256,21 @@ def build_archives_fileinfos(pages):
 
     counter = 0
     mapping_list = {}
+    pages = list(pages)
 
     try:
 
+        # Archive mappings are the same for every page in a blog.
+        blog_mappings = {}
+
         for page in pages:
-            tags = template_tags(page=page)
-            if page.archive_mappings.count() == 0:
+            blog_id = page._data.get('blog')
+            if blog_id not in blog_mappings:
+                blog_mappings[blog_id] = list(page.archive_mappings)
+            if len(blog_mappings[blog_id]) == 0:
                 raise TemplateMapping.DoesNotExist('No template mappings found for the archives for this page.')
-            s = []
-            for m in page.archive_mappings:
-                q = replace_mapping_tags(m.path_string)
-                s.append(q)
-                paths_list = eval_paths(m.path_string, tags.__dict__)
+
+            for page, tags, m, paths_list in eval_mapping_paths(blog_mappings[blog_id], (page,)):
 
                 if type(paths_list) in (list,):
                     paths = []
@@ -282,6 +329,9 @@ def build_archives_fileinfos(pages):
             new_fileinfo.mapping_sort = '/'.join(archive_context)
             new_fileinfo.save()
 
+        if pages:
+            update_archive_membership(pages[0].blog, pages)
+
         return counter + 1
 
     except Exception:
@@ -311,11 +361,10 @@ def build_indexes_fileinfos(templates):
 
         blog = index_mappings[0].template.blog
 
-        tags = template_tags(blog_id=blog.id)
+        tags = publishing_tags(blog_id=blog.id)
 
         for i in index_mappings:
-            path_string = replace_mapping_tags(i.path_string)
-            path_string = eval(path_string, tags.__dict__)
+            path_string = eval(i.path_code, tags.namespace)
 
             if path_string == '' or path_string is None:
                 continue
@@ -378,20 +427,7 @@ def add_page_fileinfo(page, template_mapping, file_path,
             fileinfo = new_fileinfo
 
         except IntegrityError:
-
-            from core.error import FileInfoCollision
-            collision = FileInfo.get(
-                FileInfo.sitewide_file_path == sitewide_file_path)
-            raise FileInfoCollision('''
-Template mapping #{}, {}, for template #{},
-yields a path that already exists in the system: {}
-This appears to be a collision with mapping {} in template {}'''.format(
-                template_mapping.id,
-                template_mapping.path_string,
-                template_mapping.template.id,
-                sitewide_file_path,
-                collision.template_mapping.path_string,
-                collision.template_mapping.template.for_log))
+            raise fileinfo_collision(template_mapping, sitewide_file_path)
 
     else:
 
@@ -404,11 +440,46 @@ This appears to be a collision with mapping {} in template {}'''.format(
 
         fileinfo = existing_fileinfo
 
+    # The default page mapping provides the page's permalink,
+    # whose path within the blog is stored on the page itself.
+    if (page is not None and template_mapping.is_default and
+            template_mapping.template.template_type == template_type.page and
+            template_mapping.template.default_type == archive_type.page and
+            page.canonical_file_path != file_path):
+        Page.update(canonical_file_path=file_path).where(
+            Page.id == page.id).execute()
+        page.canonical_file_path = file_path
+
     return fileinfo
 
 # TODO: we may want to move this and page_fileinfo to the models
 
 
+def fileinfo_collision(template_mapping, sitewide_file_path):
+    '''
+    Returns the FileInfoCollision error for a template mapping
+    whose path is already used by another fileinfo.
+
+    :param template_mapping:
+        The template mapping whose fileinfo could not be added.
+    :param sitewide_file_path:
+        The sitewide file path it yielded.
+    '''
+    from core.error import FileInfoCollision
+    collision = FileInfo.get(
+        FileInfo.sitewide_file_path == sitewide_file_path)
+    return FileInfoCollision('''
+Template mapping #{}, {}, for template #{},
+yields a path that already exists in the system: {}
+This appears to be a collision with mapping {} in template {}'''.format(
+        template_mapping.id,
+        template_mapping.path_string,
+        template_mapping.template.id,
+        sitewide_file_path,
+        collision.template_mapping.path_string,
+        collision.template_mapping.template.for_log))
+
+
 def delete_fileinfo_files(fileinfos):
     '''
     Iterates through the fileinfos (e.g.,for a given page)
@@ -428,6 +499,116 @@ def delete_fileinfo_files(fileinfos):
     return deleted_files
 
 
+def collect_orphaned_files(blog, delete=False):
+    '''
+    Walks a blog's output directory and finds the files that no fileinfo,
+    current preview or media object accounts for, e.g. files left behind
+    by purged fileinfos, changed mappings or abandoned previews.
+    A preview is current only if it was written after the page or template
+    it shows was last saved, i.e. it shows an edit that hasn't been saved since.
+    The output directories of other blogs, and of sites, nested
+    under the blog's directory are left out of the walk.
+    Returns a Struct with the number of files checked, the paths of
+    the orphaned files, and the paths of the files deleted.
+
+    If another blog has the same output directory, DeletionError is raised,
+    since the files of one can't be told apart from those of the other.
+
+    :param blog:
+        The blog whose output directory is to be checked.
+    :param delete:
+        If True, the orphaned files are deleted, in batches of GC_BATCH_SIZE.
+        Otherwise they are only reported.
+    '''
+    from fnmatch import fnmatch
+    from settings import GC_BATCH_SIZE, GC_IGNORE_PATTERNS
+
+    from core.error import DeletionError
+
+    root = os.path.normpath(blog.path)
+    ignore = [n.strip() for n in GC_IGNORE_PATTERNS.split(',') if n.strip()]
+
+    nested = set()
+    for path, in Blog.select(Blog.path).where(Blog.id != blog.id).tuples():
+        if not path:
+            continue
+        path = os.path.normpath(path)
+        if path == root:
+            raise DeletionError('Blog {} shares its output directory, {}, with another blog; '
+                'orphaned files can\'t be collected for it.'.format(blog.for_log, root))
+        nested.add(path)
+    for path, in Site.select(Site.path).tuples():
+        if path and os.path.normpath(path) != root:
+            nested.add(os.path.normpath(path))
+
+    live = set()
+    previews = []
+
+    mappings = TemplateMapping.select(TemplateMapping.id).join(Template).where(
+        Template.blog == blog)
+    for path, preview_path, fileinfo_id in FileInfo.select(FileInfo.sitewide_file_path,
+            FileInfo.preview_path, FileInfo.id).where(
+            FileInfo.template_mapping << mappings).tuples():
+        live.add(os.path.normpath(path))
+        if preview_path is not None:
+            previews.append(fileinfo_id)
+
+    for ids in _chunks(previews):
+        for fileinfo in FileInfo.select().where(FileInfo.id << ids):
+            preview_path = os.path.normpath(os.path.join(root, fileinfo.preview_path))
+            saved = (fileinfo.page.modified_date if fileinfo.page is not None
+                else fileinfo.template_mapping.template.modified_date)
+            try:
+                written = datetime.datetime.utcfromtimestamp(os.path.getmtime(preview_path))
+            except OSError:
+                continue
+            if saved is None or written >= saved:
+                live.add(preview_path)
+
+    for path, in Media.select(Media.path).where(Media.blog == blog).tuples():
+        live.add(os.path.normpath(path))
+
+    result = Struct()
+    result.checked, result.orphans, result.deleted = 0, [], []
+
+    directories = [root]
+    while directories:
+        try:
+            entries = list(os.scandir(directories.pop()))
+        except FileNotFoundError:
+            continue
+        for entry in entries:
+            if any(fnmatch(entry.name, n) for n in ignore):
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                if os.path.normpath(entry.path) not in nested:
+                    directories.append(entry.path)
+            elif entry.is_file(follow_symlinks=False):
+                result.checked += 1
+                if os.path.normpath(entry.path) not in live:
+                    result.orphans.append(entry.path)
+
+    if delete:
+        for batch in _chunks(result.orphans, int(GC_BATCH_SIZE)):
+            for path in batch:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    continue
+                result.deleted.append(path)
+
+        # Stale previews that were removed are no longer recorded.
+        deleted = set(os.path.normpath(n) for n in result.deleted)
+        for ids in _chunks(previews):
+            stale = [fileinfo_id for fileinfo_id, preview_path in FileInfo.select(
+                FileInfo.id, FileInfo.preview_path).where(FileInfo.id << ids).tuples()
+                if os.path.normpath(os.path.join(root, preview_path)) in deleted]
+            if stale:
+                FileInfo.update(preview_path=None).where(FileInfo.id << stale).execute()
+
+    return result
+
+
 def delete_page_fileinfo(page):
     '''
     Deletes the fileinfo entry associated with a specific page.
@@ -528,6 +709,15 @@ def generate_archive_context(context_list, original_pageset, **ka):
         except BaseException:
             raise BaseException("A page or a fileinfo object must be provided.", Exception)
 
+    # Archive fileinfos are resolved from the archive membership index
+    # where it has been built.
+    if fileinfo is not None:
+        blog = fileinfo.template_mapping.template.blog
+        if archive_membership_indexed(blog):
+            return original_pageset.select().where(
+                Page.id << PageArchiveFileInfo.select(PageArchiveFileInfo.page).where(
+                    PageArchiveFileInfo.fileinfo == fileinfo))
+
     tag_context = original_pageset
 
     date_counter = {
@@ -576,8 +766,10 @@ def year_context(fileinfo, original_page, tag_context, date_counter):
         day=1,
         )
 
+    # Publication dates are stored as naive UTC dates,
+    # so the bounds are compared as naive UTC dates too.
     year_start_tz = Page._date_to_utc(None, blog.timezone,
-        year_start)
+        year_start).replace(tzinfo=None)
 
     year_end = datetime.datetime(
         year=year_context,
@@ -589,7 +781,7 @@ def year_context(fileinfo, original_page, tag_context, date_counter):
         )
 
     year_end_tz = Page._date_to_utc(None, blog.timezone,
-        year_end)
+        year_end).replace(tzinfo=None)
 
     tag_context_next = tag_context.select().where(
         Page.publication_date >= year_start_tz,
@@ -625,7 +817,7 @@ def month_context(fileinfo, original_page, tag_context, date_counter):
         day=1)
 
     month_start_tz = Page._date_to_utc(None, blog.timezone,
-        month_start)
+        month_start).replace(tzinfo=None)
 
     month_end = datetime.datetime(
         year=date_counter["year"],
@@ -636,7 +828,7 @@ def month_context(fileinfo, original_page, tag_context, date_counter):
         second=59)
 
     month_end_tz = Page._date_to_utc(None, blog.timezone,
-        month_end)
+        month_end).replace(tzinfo=None)
 
     tag_context_next = tag_context.select().where(
         Page.publication_date >= month_start_tz,
@@ -647,6 +839,43 @@ def month_context(fileinfo, original_page, tag_context, date_counter):
 
     return tag_context_next, date_counter
 
+def day_context(fileinfo, original_page, tag_context, date_counter):
+
+    if date_counter["month"] is None:
+        raise ArchiveMappingFormatException("An archive mapping was encountered that had a day value before a month value.", Exception)
+
+    if fileinfo is None:
+        day_context = original_page.publication_date_tz.day
+        blog = original_page.blog
+    else:
+        day_context = fileinfo.day
+        blog = fileinfo.template_mapping.template.blog
+
+    day_start = datetime.datetime(
+        year=date_counter["year"],
+        month=date_counter["month"],
+        day=day_context)
+
+    day_start_tz = Page._date_to_utc(None, blog.timezone,
+        day_start).replace(tzinfo=None)
+
+    day_end = day_start.replace(
+        hour=23,
+        minute=59,
+        second=59)
+
+    day_end_tz = Page._date_to_utc(None, blog.timezone,
+        day_end).replace(tzinfo=None)
+
+    tag_context_next = tag_context.select().where(
+        Page.publication_date >= day_start_tz,
+        Page.publication_date <= day_end_tz
+        )
+
+    date_counter["day"] = day_context
+
+    return tag_context_next, date_counter
+
 #     tag_context_next = tag_context.select().where(
 #         Page.publication_date.month << month_context)
 #
@@ -715,6 +944,11 @@ archive_functions = {
         "context":month_context,
         'format':lambda x:'{:02d}'.format(x)
         },
+    "D":{
+        "mapping":lambda x:x.publication_date_tz.day,
+        "context":day_context,
+        'format':lambda x:'{:02d}'.format(x)
+        },
     "A":{
         "mapping":lambda x:x.user.id,
         "context":author_context,
@@ -758,6 +992,20 @@ def replace_mapping_tags(string):
     return string
 
 
+@lru_cache(maxsize=256)
+def compile_mapping_path(path_string):
+    '''
+    Returns a mapping's path string, with its mapping tags replaced,
+    compiled to a code object for eval().
+    Results are cached by path string, so a changed path string
+    is simply compiled anew.
+
+    :param path_string:
+        The path string from a template mapping.
+    '''
+    return compile(replace_mapping_tags(path_string), '<mapping>', 'eval')
+
+
 def build_mapping_xrefs(mapping_list):
 
     import re
@@ -776,10 +1024,9 @@ def build_mapping_xrefs(mapping_list):
         # (re.compile('page\.primary_category.?'), 'P'),
         )
 
-    map_types = {}
+    templates = OrderedDict()
 
     for mapping in mapping_list:
-        purge_fileinfos(mapping.fileinfos)
 
         match_pos = []
 
@@ -795,23 +1042,14 @@ def build_mapping_xrefs(mapping_list):
         mapping.archive_xref = context_string
         mapping.save()
 
-        map_types[mapping.template.template_type] = ""
+        templates.setdefault(mapping.template.id, mapping.template)
 
-    # TODO: make all these actions queueable
+    # The fileinfos for the mappings are brought up to date by a queued
+    # job for each template; see reconcile_mapping_fileinfos().
 
-    if 'Page' in map_types:
-        # build_pages_fileinfos(mapping.template.blog.pages)
-        pass
-    if 'Archive' in map_types:
-        # TODO: eventually build only the mappings for the affected template, not all of them
-        pass
-        # build_archives_fileinfos(mapping.template.blog.published_pages)
-    if 'Index' in map_types:
-        # TODO: eventually build only the mappings for the affected template, not all of them
-        build_indexes_fileinfos(mapping.template.blog.index_templates)
-    if 'Include' in map_types:
-        # TODO: eventually build only the mappings for the affected template, not all of them
-        build_indexes_fileinfos(mapping.template.blog.ssi_templates)
+    from core.cms.queue import queue_mapping_fileinfos
+    for template in templates.values():
+        queue_mapping_fileinfos(template)
 
 
 def purge_fileinfos(fileinfos):
@@ -823,6 +1061,622 @@ def purge_fileinfos(fileinfos):
     '''
     context_purge = FileInfoContext.delete().where(FileInfoContext.fileinfo << fileinfos)
     n = context_purge.execute()
+    FileInfoDependency.delete().where(FileInfoDependency.fileinfo << fileinfos).execute()
+    PageArchiveFileInfo.delete().where(PageArchiveFileInfo.fileinfo << fileinfos).execute()
     purge = FileInfo.delete().where(FileInfo.id << fileinfos)
     m = purge.execute()
     return m, n
+
+
+def clear_fingerprints(blog):
+    '''
+    Clears the render fingerprints of all of a blog's fileinfos,
+    so that each of them is rendered again the next time it's published,
+    even if none of its inputs have changed.
+
+    :param blog:
+        The blog whose fileinfos are to be cleared.
+    '''
+    mappings = TemplateMapping.select(TemplateMapping.id).join(Template).where(
+        Template.blog == blog)
+    return FileInfo.update(fingerprint=None).where(
+        FileInfo.template_mapping << mappings).execute()
+
+
+def clear_fileinfo_fingerprints(fileinfo_ids):
+    '''
+    Clears the render fingerprints of a set of fileinfos,
+    so that each of them is rendered again the next time it's published.
+
+    :param fileinfo_ids:
+        An iterable of fileinfo IDs.
+    '''
+    cleared = 0
+    for ids in _chunks(fileinfo_ids):
+        cleared += FileInfo.update(fingerprint=None).where(
+            FileInfo.id << ids).execute()
+    return cleared
+
+
+# Bulk fileinfo building.
+# These functions compute in memory the fileinfos that a blog, or a batch
+# of its pages, should have, as a dictionary of sitewide file paths to
+# (row, contexts) tuples. row holds the FileInfo column values and
+# contexts the (object, ref) pairs for its FileInfoContext rows.
+# apply_fileinfo_rows() then brings the tables in line with them
+# using set-based statements.
+
+# Maximum number of keys in a single IN clause issued by the bulk builders.
+BULK_KEY_CHUNK_SIZE = 500
+# Maximum number of rows written by a single insert.
+BULK_INSERT_CHUNK_SIZE = 100
+
+
+def _chunks(items, size=BULK_KEY_CHUNK_SIZE):
+    items = list(items)
+    for n in range(0, len(items), size):
+        yield items[n:n + size]
+
+
+def _fileinfo_row(blog, mapping, path_string, page=None, mapping_sort=None):
+    return {'page':page,
+        'template_mapping':mapping.id,
+        'file_path':path_string,
+        'sitewide_file_path':blog.path + '/' + path_string,
+        'url':blog.url + "/" + path_string,
+        'mapping_sort':mapping_sort}
+
+
+def blog_mappings(blog, template_types):
+    '''
+    Returns a list of the template mappings for a blog's templates
+    of the given types.
+
+    :param blog:
+        The blog to get template mappings for.
+    :param template_types:
+        An iterable of template types, from core.models.template_type.
+    '''
+    return list(TemplateMapping.select().where(
+        TemplateMapping.template << Template.select(Template.id).where(
+            Template.blog == blog,
+            Template.template_type << list(template_types)).tuples()))
+
+
+def page_fileinfo_rows(pages, mappings):
+    '''
+    Computes, without writing anything, the page fileinfos for a set of pages.
+
+    :param pages:
+        An iterable of Page objects.
+    :param mappings:
+        The page template mappings to use, e.g. from blog_mappings().
+    '''
+    rows = OrderedDict()
+
+    for page in pages:
+        tags = publishing_tags(page=page)
+        date = page.publication_date_tz
+        for mapping in mappings:
+            path_string = generate_date_mapping(date.date(), tags, mapping.path_code)
+            if path_string == '' or path_string is None:
+                continue
+            row = _fileinfo_row(page.blog, mapping, path_string,
+                page.id, str(date))
+            if row['sitewide_file_path'] not in rows:
+                rows[row['sitewide_file_path']] = (row, ())
+
+    return rows
+
+
+def _archive_paths(page, paths_list):
+    if type(paths_list) in (list,):
+        return [(page.proxy(n[0]), n[1]) for n in paths_list if n is not None]
+    return ((page, paths_list),)
+
+
+def archive_values(pages):
+    '''
+    Returns the archive context values of a set of pages, read with
+    a few grouped queries: a dictionary of page IDs to dictionaries of
+    archive_xref types (year, month, day, author, primary category,
+    categories, tags) to lists of values.
+
+    :param pages:
+        An iterable of Page objects.
+    '''
+    values = {}
+    for page in pages:
+        date = page.publication_date_tz
+        values[page.id] = {'Y':[date.year], 'M':[date.month], 'D':[date.day],
+            'A':[page._data.get('user')], 'C':[], 'c':[], 'T':[]}
+
+    for ids in _chunks(values):
+        for page_id, category_id, primary in PageCategory.select(
+                PageCategory.page, PageCategory.category, PageCategory.primary).where(
+                PageCategory.page << ids).tuples():
+            values[page_id]['c'].append(category_id)
+            if primary and not values[page_id]['C']:
+                values[page_id]['C'].append(category_id)
+        for page_id, tag_id in TagAssociation.select(
+                TagAssociation.page, TagAssociation.tag).where(
+                TagAssociation.page << ids).tuples():
+            values[page_id]['T'].append(tag_id)
+
+    return values
+
+
+def archive_fileinfo_rows(pages, mappings):
+    '''
+    Computes, without writing anything, the archive fileinfos
+    that a set of published pages appear in.
+
+    Pages are grouped by the values of each mapping's archive contexts
+    (year, month, day, category, tag, author), read for all the pages with
+    a few grouped queries. A mapping's path is then evaluated for one
+    page in each group, rather than for every page.
+
+    :param pages:
+        An iterable of published Page objects.
+    :param mappings:
+        The archive template mappings to use, e.g. from blog_mappings().
+    '''
+    pages = list(pages)
+    rows = OrderedDict()
+    values = archive_values(pages)
+
+    # The first page found for each mapping and set of context values.
+    representatives = OrderedDict()
+    for mapping in mappings:
+        xref = mapping.archive_xref or ''
+        for page in pages:
+            for key in product(*(values[page.id][r] for r in xref)):
+                representatives.setdefault((mapping.id, key), page)
+
+    mappings = dict((n.id, n) for n in mappings)
+    evaluated = set()
+    page_tags = {}
+
+    for (mapping_id, key), page in representatives.items():
+        if (mapping_id, page.id) in evaluated:
+            continue
+        evaluated.add((mapping_id, page.id))
+        mapping = mappings[mapping_id]
+
+        if page.id not in page_tags:
+            page_tags[page.id] = publishing_tags(page=page)
+        tags = page_tags[page.id]
+
+        try:
+            paths_list = eval(mapping.path_code, tags.namespace)
+        except Exception:
+            paths_list = None
+
+        for p, path in _archive_paths(page, paths_list):
+            path_string = generate_date_mapping(p.publication_date_tz,
+                tags, path, do_eval=False)
+            if path_string == '' or path_string is None:
+                continue
+
+            xref = mapping.archive_xref or ''
+            try:
+                archive_context = [archive_functions[r]["format"](
+                    archive_functions[r]["mapping"](p)) for r in xref]
+            except Exception:
+                continue
+
+            row = _fileinfo_row(p.blog, mapping, path_string,
+                mapping_sort='/'.join(archive_context))
+            if row['sitewide_file_path'] not in rows:
+                rows[row['sitewide_file_path']] = (row,
+                    tuple((r, int(t)) for r, t in zip(xref, archive_context)))
+
+    return rows
+
+
+def index_fileinfo_rows(blog, mappings):
+    '''
+    Computes, without writing anything, the fileinfos for
+    a blog's index or include templates.
+
+    :param blog:
+        The blog the mappings belong to.
+    :param mappings:
+        The index or include template mappings to use.
+    '''
+    rows = OrderedDict()
+    tags = publishing_tags(blog_id=blog.id)
+
+    for mapping in mappings:
+        path_string = eval(mapping.path_code, tags.namespace)
+        if path_string == '' or path_string is None:
+            continue
+        row = _fileinfo_row(blog, mapping, path_string)
+        if row['sitewide_file_path'] not in rows:
+            rows[row['sitewide_file_path']] = (row, ())
+
+    return rows
+
+
+def store_canonical_paths(rows):
+    '''
+    Stores on each page the file path from its default page fileinfo,
+    for the page fileinfos in a set of computed rows.
+    See add_page_fileinfo().
+
+    :param rows:
+        Computed fileinfo rows, e.g. from page_fileinfo_rows().
+    '''
+    mapping_ids = set(row['template_mapping'] for row, contexts in rows.values()
+        if row['page'] is not None)
+
+    default_mappings = set()
+    for ids in _chunks(mapping_ids):
+        default_mappings.update(n for n, in TemplateMapping.select(TemplateMapping.id).join(
+            Template, on=(TemplateMapping.template == Template.id)).where(
+            TemplateMapping.id << ids,
+            TemplateMapping.is_default == True,
+            Template.template_type == template_type.page,
+            Template.default_type == archive_type.page).tuples())
+
+    canonical = dict((row['page'], row['file_path'])
+        for row, contexts in rows.values()
+        if row['page'] is not None and row['template_mapping'] in default_mappings)
+
+    for ids in _chunks(canonical):
+        for page_id, file_path in Page.select(Page.id,
+                Page.canonical_file_path).where(
+                Page.id << ids).tuples():
+            if canonical[page_id] != file_path:
+                Page.update(canonical_file_path=canonical[page_id]).where(
+                    Page.id == page_id).execute()
+
+
+def apply_fileinfo_rows(rows, existing=None):
+    '''
+    Brings the FileInfo and FileInfoContext tables in line with a set of
+    computed fileinfo rows, with bulk inserts and set-based deletes.
+    Fileinfos that are unchanged are left alone, so they keep their
+    digests and fingerprints.
+
+    Returns a Struct with the IDs of the fileinfos inserted and updated,
+    the sitewide file paths of the fileinfos deleted,
+    and the number of fileinfos left unchanged.
+
+    :param rows:
+        Computed fileinfo rows, e.g. from page_fileinfo_rows().
+    :param existing:
+        A FileInfo query for the fileinfos the rows replace, e.g. blog.fileinfos.
+        Any of these with no matching row are deleted. If this is None,
+        existing fileinfos are matched by path and nothing is deleted.
+
+    If a row's path is already used by a fileinfo that the rows don't replace,
+    i.e. one outside of existing, or, if existing is None, one for another
+    page or mapping, FileInfoCollision is raised, with the same message
+    as add_page_fileinfo(), before anything is written.
+    '''
+    fields = ('page', 'template_mapping', 'file_path', 'url', 'mapping_sort')
+    columns = [FileInfo.id, FileInfo.sitewide_file_path] + [getattr(FileInfo, n) for n in fields]
+
+    current = {}
+    if existing is None:
+        for paths in _chunks(rows):
+            for n in FileInfo.select(*columns).where(
+                    FileInfo.sitewide_file_path << paths).tuples():
+                current[n[1]] = (n[0], dict(zip(fields, n[2:])))
+    else:
+        for n in existing.select(*columns).tuples():
+            current[n[1]] = (n[0], dict(zip(fields, n[2:])))
+
+    current_contexts = {}
+    for ids in _chunks(n[0] for n in current.values()):
+        for fileinfo_id, obj, ref in FileInfoContext.select(FileInfoContext.fileinfo,
+                FileInfoContext.object, FileInfoContext.ref).where(
+                FileInfoContext.fileinfo << ids).tuples():
+            current_contexts.setdefault(fileinfo_id, set()).add((obj, ref))
+
+    result = Struct()
+    result.inserted, result.updated, result.deleted, result.unchanged = [], [], [], 0
+
+    to_delete, to_insert, to_update, new_contexts = [], [], [], {}
+
+    for path, (row, contexts) in rows.items():
+        if path not in current:
+            to_insert.append((row, contexts))
+            continue
+        fileinfo_id, values = current.pop(path)
+        if existing is None and (values['template_mapping'], values['page']) != (
+                row['template_mapping'], row['page']):
+            raise fileinfo_collision(
+                TemplateMapping.get(TemplateMapping.id == row['template_mapping']), path)
+        if values['template_mapping'] != row['template_mapping']:
+            to_delete.append((fileinfo_id, path))
+            to_insert.append((row, contexts))
+            continue
+        changed = False
+        if any(values[n] != row[n] for n in fields):
+            to_update.append((fileinfo_id, row))
+            changed = True
+        if set(contexts) != current_contexts.get(fileinfo_id, set()):
+            new_contexts[fileinfo_id] = contexts
+            changed = True
+        if changed:
+            result.updated.append(fileinfo_id)
+        else:
+            result.unchanged += 1
+
+    if existing is not None:
+        to_delete.extend((n[0], path) for path, n in current.items())
+
+    # Paths are unique across the whole FileInfo table, so new rows are checked
+    # against every fileinfo, not only the ones they replace.
+    replaced = set(n[0] for n in to_delete)
+    for chunk in _chunks([n[0] for n in to_insert]):
+        for fileinfo_id, path in FileInfo.select(FileInfo.id, FileInfo.sitewide_file_path).where(
+                FileInfo.sitewide_file_path << [row['sitewide_file_path'] for row in chunk]).tuples():
+            if fileinfo_id not in replaced:
+                row = rows[path][0]
+                raise fileinfo_collision(
+                    TemplateMapping.get(TemplateMapping.id == row['template_mapping']), path)
+
+    with db.atomic():
+
+        from core.cms.queue import job_type
+
+        for chunk in _chunks(to_delete):
+            ids = [n[0] for n in chunk]
+            Queue.delete().where(Queue.is_control == False,
+                Queue.job_type != job_type.mapping,
+                Queue.data_integer << ids).execute()
+            purge_fileinfos(ids)
+            result.deleted.extend(n[1] for n in chunk)
+
+        now = datetime.datetime.utcnow()
+        for fileinfo_id, row in to_update:
+            FileInfo.update(modified_date=now, **dict((n, row[n]) for n in fields)).where(
+                FileInfo.id == fileinfo_id).execute()
+
+        for chunk in _chunks(to_insert, BULK_INSERT_CHUNK_SIZE):
+            FileInfo.insert_many(n[0] for n in chunk).execute()
+            inserted = dict(FileInfo.select(FileInfo.sitewide_file_path, FileInfo.id).where(
+                FileInfo.sitewide_file_path << [n[0]['sitewide_file_path'] for n in chunk]).tuples())
+            for row, contexts in chunk:
+                fileinfo_id = inserted[row['sitewide_file_path']]
+                result.inserted.append(fileinfo_id)
+                if contexts:
+                    new_contexts[fileinfo_id] = contexts
+
+        for ids in _chunks(new_contexts):
+            FileInfoContext.delete().where(FileInfoContext.fileinfo << ids).execute()
+        context_rows = [{'fileinfo':fileinfo_id, 'object':obj, 'ref':ref}
+            for fileinfo_id, contexts in new_contexts.items()
+            for obj, ref in contexts]
+        for chunk in _chunks(context_rows, BULK_INSERT_CHUNK_SIZE):
+            FileInfoContext.insert_many(chunk).execute()
+
+        store_canonical_paths(rows)
+
+    return result
+
+
+def build_blog_fileinfos(blog):
+    '''
+    Rebuilds all the fileinfos for a blog in bulk: page fileinfos
+    for all its pages, archive fileinfos for its published pages,
+    and fileinfos for its index and server-side include templates.
+    Any other fileinfos for the blog are deleted,
+    and the blog's next/previous page index is rebuilt.
+    Returns the Struct from apply_fileinfo_rows().
+
+    :param blog:
+        The blog to rebuild fileinfos for.
+    '''
+    rows = OrderedDict()
+
+    with IdentityMap():
+        for part in (
+            index_fileinfo_rows(blog, blog_mappings(blog, (template_type.include,))),
+            page_fileinfo_rows(blog.pages.iterator(),
+                blog_mappings(blog, (template_type.page,))),
+            archive_fileinfo_rows(blog.pages.published.iterator(),
+                blog_mappings(blog, (template_type.archive,))),
+            index_fileinfo_rows(blog, blog_mappings(blog, (template_type.index,))),
+            ):
+            for path, row in part.items():
+                rows.setdefault(path, row)
+
+    result = apply_fileinfo_rows(rows, blog.fileinfos)
+    update_archive_membership(blog)
+    PageNeighbor.rebuild(blog)
+
+    return result
+
+
+def build_pages_fileinfos_bulk(blog, pages):
+    '''
+    Builds in bulk the page fileinfos for a batch of a blog's pages,
+    and the archive fileinfos for those of them that are published.
+    Existing fileinfos are updated in place; none are deleted.
+    Returns the Struct from apply_fileinfo_rows().
+
+    :param blog:
+        The blog the pages belong to.
+    :param pages:
+        An iterable of Page objects.
+    '''
+    pages = list(pages)
+    rows = OrderedDict()
+
+    with IdentityMap():
+        for part in (
+            page_fileinfo_rows(pages, blog_mappings(blog, (template_type.page,))),
+            archive_fileinfo_rows((n for n in pages if n.status == page_status.published),
+                blog_mappings(blog, (template_type.archive,))),
+            ):
+            for path, row in part.items():
+                rows.setdefault(path, row)
+
+    result = apply_fileinfo_rows(rows)
+    update_archive_membership(blog, pages)
+
+    return result
+
+
+def update_page_fileinfos(page):
+    '''
+    Brings the fileinfos for a single page in line with its current
+    basename, date, categories and tags, touching only the rows that
+    differ. Page fileinfos that no longer apply are deleted, along with
+    their queued jobs; unchanged fileinfos and their queued jobs are kept.
+    Archive fileinfos the page needs, if it's published, are added.
+    Returns the Struct from apply_fileinfo_rows() for the page fileinfos.
+
+    :param page:
+        The page to update fileinfos for.
+    '''
+    blog = page.blog
+
+    with IdentityMap():
+        page_rows = page_fileinfo_rows((page,),
+            blog_mappings(blog, (template_type.page,)))
+        if page.status == page_status.published:
+            archive_rows = archive_fileinfo_rows((page,),
+                blog_mappings(blog, (template_type.archive,)))
+        else:
+            archive_rows = OrderedDict()
+
+    result = apply_fileinfo_rows(page_rows,
+        FileInfo.select().where(FileInfo.page == page))
+    apply_fileinfo_rows(archive_rows)
+
+    return result
+
+
+def archive_membership_indexed(blog):
+    '''
+    Returns True if the archive membership index has been built for a blog.
+
+    :param blog:
+        The blog to check.
+    '''
+    return PageArchiveFileInfo.select().where(
+        PageArchiveFileInfo.blog == blog).exists()
+
+
+def update_archive_membership(blog, pages=None):
+    '''
+    Updates the archive membership index (PageArchiveFileInfo)
+    for a set of a blog's pages, by matching each page's archive
+    context values against the contexts of the blog's archive fileinfos.
+    Unpublished pages are removed from the index.
+
+    :param blog:
+        The blog the pages belong to.
+    :param pages:
+        An iterable of Page objects. If this is None, or the blog
+        hasn't been indexed yet, the index is rebuilt for all of
+        the blog's published pages.
+    '''
+    mappings = blog_mappings(blog, (template_type.archive,))
+    xrefs = dict((n.id, n.archive_xref or '') for n in mappings)
+
+    mapping_fileinfos = []
+    for ids in _chunks(xrefs):
+        mapping_fileinfos.extend(FileInfo.select(FileInfo.id, FileInfo.template_mapping).where(
+            FileInfo.template_mapping << ids).tuples())
+
+    if pages is not None and (not mapping_fileinfos or archive_membership_indexed(blog)):
+        pages = list(pages)
+        delete_ids = [n.id for n in pages]
+        pages = [n for n in pages if n.status == page_status.published]
+    else:
+        pages = None
+        delete_ids = None
+
+    contexts = {}
+    for ids in _chunks(n[0] for n in mapping_fileinfos):
+        for fileinfo_id, obj, ref in FileInfoContext.select(FileInfoContext.fileinfo,
+                FileInfoContext.object, FileInfoContext.ref).where(
+                FileInfoContext.fileinfo << ids).order_by(FileInfoContext.id.asc()).tuples():
+            contexts.setdefault(fileinfo_id, {}).setdefault(obj, ref)
+
+    # Archive fileinfos by mapping and context values.
+    fileinfos = {}
+    for fileinfo_id, mapping_id in mapping_fileinfos:
+        key = tuple(contexts.get(fileinfo_id, {}).get(r) for r in xrefs[mapping_id])
+        fileinfos.setdefault((mapping_id, key), fileinfo_id)
+
+    with IdentityMap():
+        if pages is None:
+            pages = list(blog.pages.published.iterator())
+        values = archive_values(pages)
+
+    members = set()
+    for page in pages:
+        for mapping_id, xref in xrefs.items():
+            for key in product(*(values[page.id][r] for r in xref)):
+                fileinfo_id = fileinfos.get((mapping_id, key))
+                if fileinfo_id is not None:
+                    members.add((page.id, fileinfo_id))
+
+    rows = [{'page':page_id, 'fileinfo':fileinfo_id, 'blog':blog.id}
+        for page_id, fileinfo_id in sorted(members)]
+
+    with db.atomic():
+        if delete_ids is None:
+            PageArchiveFileInfo.delete().where(PageArchiveFileInfo.blog == blog).execute()
+        else:
+            for ids in _chunks(delete_ids):
+                PageArchiveFileInfo.delete().where(PageArchiveFileInfo.page << ids).execute()
+        for chunk in _chunks(rows, BULK_INSERT_CHUNK_SIZE):
+            PageArchiveFileInfo.insert_many(chunk).execute()
+
+
+def reconcile_mapping_fileinfos(template, pages=None):
+    '''
+    Brings the fileinfos for a template's mappings in line with their
+    current path expressions, e.g. after a mapping has been edited.
+    Fileinfos whose paths are unchanged are left alone; fileinfos for
+    paths that no longer apply are deleted, along with their queued jobs
+    and the files they published. Returns the Struct from
+    apply_fileinfo_rows(), whose inserted and updated fileinfos are
+    the ones that need to be republished.
+
+    :param template:
+        The template whose mappings are to be reconciled.
+    :param pages:
+        For a page template, the batch of pages to reconcile the
+        fileinfos for. Other template types are reconciled in full
+        and ignore this.
+    '''
+    blog = template.blog
+    mappings = list(template.mappings)
+    mapping_ids = [n.id for n in mappings]
+    existing = FileInfo.select().where(FileInfo.template_mapping << mapping_ids)
+
+    with IdentityMap():
+        if template.template_type == template_type.page:
+            pages = list(pages)
+            rows = page_fileinfo_rows(pages, mappings)
+            existing = existing.where(FileInfo.page << [n.id for n in pages])
+        elif template.template_type == template_type.archive:
+            rows = archive_fileinfo_rows(blog.pages.published.iterator(), mappings)
+        else:
+            rows = index_fileinfo_rows(blog, mappings)
+
+    result = apply_fileinfo_rows(rows, existing)
+
+    if template.template_type == template_type.archive:
+        update_archive_membership(blog)
+    elif template.template_type == template_type.include:
+        # The include's file path is kept in the blog's template registry.
+        from . import invalidate_cache
+        invalidate_cache(blog)
+
+    # A path that was deleted and inserted again has only changed mappings,
+    # so its file is left to be overwritten when it's republished.
+    for path in result.deleted:
+        if path not in rows and os.path.isfile(path):
+            os.remove(path)
+
+    return result
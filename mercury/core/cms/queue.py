@@ -1,4 +1,7 @@
 import os
+import hashlib
+import datetime
+import itertools
 
 from core.utils import generate_date_mapping, date_format
 from core.error import NoArchiveForFileInfo
@@ -6,20 +9,23 @@ from core.log import logger
 from core.libs.peewee import OperationalError
 
 from core.models import (Page, Template, TemplateMapping, template_type,
-    FileInfo, template_tags, Struct, publishing_mode, Queue)
+    FileInfo, template_tags, Struct, publishing_mode, Queue, Blog, db,
+    FileInfoDependency, dependency_type, page_status, IdentityMap, get_mapped,
+    TemplateProfile, PageNeighbor)
+from core.template import ReadTracker, RenderProfile, FragmentCache
+from core.db.instrument import query_scope, current_scope
 
 from .fileinfo import (generate_page_tags, delete_fileinfo_files, build_pages_fileinfos,
-    build_archives_fileinfos, build_indexes_fileinfos, eval_paths, build_archives_fileinfos_by_mappings)
-from . import generate_page_text
+    build_archives_fileinfos, build_indexes_fileinfos, eval_paths, build_archives_fileinfos_by_mappings,
+    build_pages_fileinfos_bulk, reconcile_mapping_fileinfos, clear_fileinfo_fingerprints)
+from . import generate_page_text, render_fingerprint
 
-from settings import MAX_BATCH_OPS, LOOP_TIMEOUT
+from settings import (MAX_BATCH_OPS, LOOP_TIMEOUT,
+    WRITER_THREADS, WRITER_QUEUE_SIZE)
 import time
 
-from threading import Thread
-t = Thread()
-t.daemon = True
+from threading import Thread, Lock
 from queue import Queue as Q
-write_queue = Q()
 
 job_type = Struct()
 job_type.page = 'Page'
@@ -28,6 +34,7 @@ job_type.archive = 'Archive'
 job_type.include = 'Include'
 job_type.insert = 'Insert'
 job_type.control = 'Control'
+job_type.mapping = 'Mapping'
 
 job_type.description = {
     job_type.page: 'Page entry',
@@ -35,18 +42,38 @@ job_type.description = {
     job_type.archive: 'Archive entry',
     job_type.include: 'Include file',
     job_type.insert: 'Queue insert job',
-    job_type.control: 'Queue publishing job'
+    job_type.control: 'Queue publishing job',
+    job_type.mapping: 'Template mapping update'
     }
 
 job_type.action = {
-    job_type.page: lambda x:build_page(x),
-    job_type.index: lambda x:build_page(x),
-    job_type.archive: lambda x:build_page(x),
-    job_type.include: lambda x:build_page(x),
+    job_type.page: lambda x, **ka:build_page(x, **ka),
+    job_type.index: lambda x, **ka:build_page(x, **ka),
+    job_type.archive: lambda x, **ka:build_page(x, **ka),
+    job_type.include: lambda x, **ka:build_page(x, **ka),
     }
 
 
-def queue_page_actions(pages, no_neighbors=False, no_archive=False):
+def push_jobs(jobs, force=True):
+    '''
+    Pushes a list of jobs for fileinfos into the queue in one batch.
+
+    :param jobs:
+        An iterable of jobs, as used by Queue.push_many.
+    :param force:
+        By default, the render fingerprints of the jobs' fileinfos are
+        cleared, so each of them is rendered again even if none of the
+        inputs in its fingerprint have changed, e.g. because it was queued
+        for a change to some other object it reads. Set this to False,
+        as for a republish, to skip rendering files whose inputs are unchanged.
+    '''
+    jobs = list(jobs)
+    if force:
+        clear_fileinfo_fingerprints(n['data_integer'] for n in jobs)
+    return Queue.push_many(jobs)
+
+
+def queue_page_actions(pages, no_neighbors=False, no_archive=False, force=True):
     '''
     Pushes a Page object along with all its related items into the queue for publication.
     This includes any archive indices associated with the page, and the page's next and
@@ -54,6 +81,9 @@ def queue_page_actions(pages, no_neighbors=False, no_archive=False):
 
     Note that this will only queue items that are actually set to be published.
 
+    All the jobs for the pages are collected first and then written to the
+    queue in one batch.
+
     :param page:
         The Page object whose actions are to be queued.
     :param no_neighbors:
@@ -62,85 +92,117 @@ def queue_page_actions(pages, no_neighbors=False, no_archive=False):
     :param no_archive:
         Set to True to suppress generation of archive pages associated with this page. Also
         useful for mass-queued actions.
+    :param force:
+        Set to False to skip rendering files whose render fingerprints
+        are unchanged. See push_jobs().
     '''
     if pages is None:
         return
 
-    for page in pages:
-        if page is None:
-            continue
+    jobs = []
 
-        try:
+    with IdentityMap():
 
-            blog, site = page.blog, page.blog.site
+        for page in pages:
+            if page is None:
+                continue
 
-            for f in page.fileinfos:
-                if f.template_mapping.template.publishing_mode != publishing_mode.do_not_publish:
-                    Queue.push(job_type=job_type.page,
-                        blog=blog,
-                        site=site,
-                        priority=8,
-                        data_integer=f.id)
+            try:
 
-            if no_archive is False:
-                queue_page_archive_actions(page)
+                queue_page_fileinfo_actions(page, jobs)
 
-            if no_neighbors is False:
+                if no_archive is False:
+                    queue_page_archive_actions(page, jobs)
 
-                next_page = page.next_page
-                previous_page = page.previous_page
+                if no_neighbors is False:
 
-                if next_page is not None:
+                    for neighbor in (page.next_page, page.previous_page):
 
-                    for f in next_page.fileinfos:
+                        if neighbor is None:
+                            continue
 
-                        if f.template_mapping.template.publishing_mode != publishing_mode.do_not_publish:
+                        if queue_page_fileinfo_actions(neighbor, jobs) > 0:
+                            queue_page_archive_actions(neighbor, jobs)
 
-                            Queue.push(job_type=job_type.page,
-                                blog=blog,
-                                site=site,
-                                priority=8,
-                                data_integer=f.id)
+            except OperationalError as e:
+                raise e
+            except Exception as e:
+                from core.error import QueueAddError
+                raise QueueAddError('Page {} could not be queued: '.format(
+                    page.for_log,
+                    e))
 
-                            queue_page_archive_actions(next_page)
+        push_jobs(jobs, force)
 
-                if previous_page is not None:
 
-                    for f in previous_page.fileinfos:
+def queue_page_fileinfo_actions(page, jobs):
+    '''
+    Adds to a list of queue jobs the page fileinfos for a given page,
+    except for those whose templates are set to not be published.
+    Returns the number of jobs added.
 
-                        if f.template_mapping.template.publishing_mode != publishing_mode.do_not_publish:
+    :param page:
+        The page object whose fileinfos are to be queued.
+    :param jobs:
+        The list of jobs to add to, as used by Queue.push_many.
+    '''
 
-                            Queue.push(job_type=job_type.page,
-                                blog=blog,
-                                site=site,
-                                priority=8,
-                                data_integer=f.id)
+    blog = page.blog
 
-                            queue_page_archive_actions(previous_page)
+    fileinfos = page.fileinfos.select(FileInfo.id).join(TemplateMapping).join(Template).where(
+        Template.publishing_mode != publishing_mode.do_not_publish).tuples()
 
-        except OperationalError as e:
-            raise e
-        except Exception as e:
-            from core.error import QueueAddError
-            raise QueueAddError('Page {} could not be queued: '.format(
-                page.for_log,
-                e))
+    n = 0
+
+    for fileinfo_id, in fileinfos:
+        jobs.append({'job_type':job_type.page,
+            'blog':blog,
+            'site':blog.site,
+            'priority':8,
+            'data_integer':fileinfo_id})
+        n += 1
+
+    return n
 
 
-def build_page(queue_entry, async_write=False):
+def build_page(queue_entry, writer=None, stats=None):
+    '''
+    Renders the fileinfo referred to by a queue job and writes it to disk.
+    The file is not rendered if its render fingerprint matches the one
+    stored for the fileinfo, and not rewritten if its contents match
+    the stored digest.
+
+    :param queue_entry:
+        The queue job to build.
+    :param writer:
+        A FileWriter to hand the rendered file to. If this is None,
+        the file is written before this function returns.
+    :param stats:
+        A PublishStats object to record the outcome in.
+        If this is None, any new digest is saved immediately.
+    '''
+    save_stats = stats is None
+    if save_stats:
+        stats = PublishStats()
+
     try:
-        fileinfo = FileInfo.get(FileInfo.id == queue_entry.data_integer)
+        fileinfo = get_mapped(FileInfo, queue_entry.data_integer)
         blog = queue_entry.blog
         page_tags = generate_page_tags(fileinfo, blog)
-        file_page_text = generate_page_text(fileinfo, page_tags)
-        if async_write:
-            if not t.is_alive:
-                t.target = write_file_queue
-                t.args = (write_queue,)
-                t.start()
-            write_queue.put_nowait((file_page_text, blog.path, fileinfo.file_path))
+        fingerprint = render_fingerprint(fileinfo, page_tags)
+        with ReadTracker() as tracker, RenderProfile(stats.renders):
+            file_page_text = generate_page_text(fileinfo, page_tags, fingerprint)
+        if file_page_text is None:
+            stats.skipped += 1
         else:
-            write_file(file_page_text, blog.path, fileinfo.file_path)
+            stats.dependencies[fileinfo.id] = tracker.reads
+            if writer is not None:
+                writer.put(queue_entry.id, file_page_text, blog.path, fileinfo.file_path,
+                    fileinfo.id, fileinfo.digest, fingerprint)
+            else:
+                digest = write_file(file_page_text, blog.path, fileinfo.file_path,
+                    fileinfo.digest)
+                stats.record(fileinfo.id, digest, fingerprint)
 
     except FileInfo.DoesNotExist as e:
         raise Exception('''Fileinfo {} could not be found in the system.
@@ -151,7 +213,7 @@ It may refer to a fileinfo that was deleted by another action. ({})'''.format(qu
             fileinfo.id,
             fileinfo.file_path)
             )
-        delete_fileinfo_files((fileinfo,))
+        stats.deleted += len(delete_fileinfo_files((fileinfo,)))
         # fileinfo.delete_instance(recursive=True)
         # FIXME: for now we leave this out
         # because deletes do not coalesce properly in the queue (I think)
@@ -165,18 +227,210 @@ It may refer to a fileinfo that was deleted by another action. ({})'''.format(qu
             fileinfo.file_path,
             e))
 
+    if save_stats:
+        stats.save()
 
-def write_file_queue(q):
-    while 1:
-        a, b, c = q.get()
-        write_file(a, b, c)
-        q.task_done()
 
+class PublishStats():
+    '''
+    Counts the files written, left unchanged, skipped without rendering,
+    and deleted during a publishing run, and collects the new digests and
+    render fingerprints of built files, along with the objects each
+    render read, so they can be saved to their fileinfos in one pass.
+    Render times, queries and output sizes are also collected
+    by template; see core.template.RenderProfile.
+    '''
+
+    def __init__(self):
+        self.written = 0
+        self.unchanged = 0
+        self.skipped = 0
+        self.deleted = 0
+        self.updates = {}
+        self.dependencies = {}
+        self.renders = {}
+
+    def record(self, fileinfo_id, digest, fingerprint=None):
+        '''
+        Records the result of a call to write_file.
+
+        :param fileinfo_id:
+            The ID of the fileinfo that was written.
+        :param digest:
+            The digest returned by write_file; None if the file was unchanged.
+        :param fingerprint:
+            The render fingerprint the file was built from.
+        '''
+        update = {}
+
+        if digest is None:
+            self.unchanged += 1
+        else:
+            self.written += 1
+            update['digest'] = digest
+
+        if fingerprint is not None:
+            update['fingerprint'] = fingerprint
+
+        if update:
+            self.updates[fileinfo_id] = update
+
+    def merge(self, other):
+        '''
+        Adds the counts and updates from another PublishStats object,
+        e.g., one returned by a publishing worker.
+        '''
+        self.written += other.written
+        self.unchanged += other.unchanged
+        self.skipped += other.skipped
+        self.deleted += other.deleted
+        self.updates.update(other.updates)
+        self.dependencies.update(other.dependencies)
+        for name, figures in other.renders.items():
+            entry = self.renders.setdefault(name, [0, 0.0, 0, 0])
+            for n, value in enumerate(figures):
+                entry[n] += value
+
+    def save(self):
+        '''
+        Saves the collected digests, fingerprints and dependencies
+        to their fileinfos.
+        '''
+        if self.dependencies:
+            FileInfoDependency.record(self.dependencies)
+            self.dependencies = {}
+        if not self.updates:
+            return
+        with db.atomic():
+            for fileinfo_id, update in self.updates.items():
+                FileInfo.update(**update).where(
+                    FileInfo.id == fileinfo_id).execute()
+        self.updates = {}
+
+    def save_renders(self, blog, run):
+        '''
+        Adds the collected render figures to the blog's template profiles.
+
+        :param blog:
+            The blog that was published.
+        :param run:
+            A string identifying the publishing run, so that figures
+            from several batches of the same run are summed up.
+        '''
+        TemplateProfile.record(blog, run, self.renders)
+        self.renders = {}
+
+    def __str__(self):
+        return "{} written, {} unchanged ({} not rendered), {} deleted".format(
+            self.written,
+            self.unchanged + self.skipped,
+            self.skipped,
+            self.deleted)
+
+
+class FileWriter():
+    '''
+    Writes rendered files to disk from a pool of background threads,
+    so that disk I/O overlaps with template rendering.
 
-def write_file(file_text, blog_path, file_path):
+    Rendered files are put into a bounded queue; when the writers fall
+    behind, put() blocks until there is room. Write errors are collected
+    by queue job ID and returned from join().
+    '''
+
+    def __init__(self, threads=None, max_pending=None, stats=None):
+        '''
+        :param threads:
+            The number of writer threads. Defaults to WRITER_THREADS.
+        :param max_pending:
+            The number of rendered files that can wait to be written
+            before put() blocks. Defaults to WRITER_QUEUE_SIZE.
+        :param stats:
+            A PublishStats object to record written files in.
+        '''
+        if threads is None:
+            threads = int(WRITER_THREADS)
+        if max_pending is None:
+            max_pending = int(WRITER_QUEUE_SIZE)
+
+        self.queue = Q(maxsize=max_pending)
+        self.stats = stats if stats is not None else PublishStats()
+        self.errors = {}
+        self.lock = Lock()
+        self.threads = []
+
+        for n in range(max(threads, 1)):
+            t = Thread(target=self._run)
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+
+    def put(self, job_id, file_text, blog_path, file_path, fileinfo_id, digest=None,
+            fingerprint=None):
+        '''
+        Queues a rendered file for writing.
+
+        :param job_id:
+            The ID of the queue job that produced the file.
+            Any write error is reported under this ID.
+        :param fileinfo_id:
+            The ID of the fileinfo the file was rendered from.
+        :param digest:
+            The fileinfo's stored digest, as passed to write_file.
+        :param fingerprint:
+            The render fingerprint the file was built from.
+        '''
+        self.queue.put((job_id, file_text, blog_path, file_path, fileinfo_id, digest,
+            fingerprint))
+
+    def _run(self):
+        while 1:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    break
+                (job_id, file_text, blog_path, file_path, fileinfo_id, digest,
+                    fingerprint) = item
+                try:
+                    digest = write_file(file_text, blog_path, file_path, digest)
+                except Exception as e:
+                    with self.lock:
+                        self.errors[job_id] = 'Error writing file {}: {}'.format(
+                            file_path, e)
+                else:
+                    with self.lock:
+                        self.stats.record(fileinfo_id, digest, fingerprint)
+            finally:
+                self.queue.task_done()
+
+    def join(self):
+        '''
+        Waits for all queued files to be written and stops the writer threads.
+        Returns a dictionary of queue job IDs to write errors.
+        '''
+        for t in self.threads:
+            self.queue.put(None)
+        for t in self.threads:
+            t.join()
+        return self.errors
+
+
+def file_digest(encoded_text):
+    '''
+    Returns the digest used to detect unchanged output for a published file.
+
+    :param encoded_text:
+        The file's contents, as bytes.
+    '''
+    return hashlib.sha1(encoded_text).hexdigest()
+
+
+def write_file(file_text, blog_path, file_path, digest=None):
     '''
     Builds a single file based on a fileinfo entry f for a given blog.
-    Returns details about the built file.
+    Returns the digest of the written file, or None if the file already
+    exists and its contents match the digest passed in, in which case
+    it is not rewritten.
 
     This does _not_ perform any checking for the page's publication status,
     nor does it perform any other higher-level security.
@@ -188,12 +442,19 @@ def write_file(file_text, blog_path, file_path):
         The fileinfo object to use.
     :param blog:
         The blog object to use as the context for the fileinfo.
+    :param digest:
+        The digest of the last output written for this file, if any.
     '''
 
     file_pathname = blog_path + "/" + file_path
 
     encoded_page = file_text.encode('utf8')
 
+    new_digest = file_digest(encoded_page)
+
+    if new_digest == digest and os.path.isfile(file_pathname):
+        return None
+
     split_path = file_path.rsplit('/', 1)
 
     if len(split_path) > 1:
@@ -202,13 +463,15 @@ def write_file(file_text, blog_path, file_path):
         path_to_check = blog_path
 
     if os.path.isdir(path_to_check) is False:
-        os.makedirs(path_to_check)
+        os.makedirs(path_to_check, exist_ok=True)
 
     with open(file_pathname, "wb") as output_file:
         output_file.write(encoded_page)
 
+    return new_digest
+
 
-def process_queue_publish(queue_control, blog):
+def process_queue_publish(queue_control, blog, workers=None):
     '''
     Processes the publishing queue for a given blog.
     Takes in a queue_control entry, and returns an integer of the number of
@@ -219,17 +482,33 @@ def process_queue_publish(queue_control, blog):
         The queue_control entry, from the queue, to use for this publishing queue run.
     :param blog:
         The blog object that is in context for this job.
+    :param workers:
+        The number of worker processes to publish with. By default, or with
+        one worker, jobs are built in this process. See publish_with_workers
+        for what's required of callers that use more than one.
     '''
     # from . import invalidate_cache
     # invalidate_cache()
 
+    if workers is None:
+        workers = 1
+
     queue_control.lock()
 
+    # Identifies this publishing run, i.e., this control job,
+    # across all the batches it's processed in.
+    run = '{}@{}'.format(queue_control.id, queue_control.date_touched)
+
+    # Mapping jobs are run first, so the files they queue
+    # are published in this same run.
+    mapping_jobs = process_mapping_jobs(blog)
+
     queue_original = Queue.select().order_by(Queue.priority.desc(),
         Queue.date_touched.desc()).where(Queue.blog == blog,
-        Queue.is_control == False)
+        Queue.is_control == False,
+        Queue.job_type != job_type.mapping)
 
-    queue = queue_original.limit(MAX_BATCH_OPS).naive()
+    queue = queue_original.limit(MAX_BATCH_OPS * max(workers, 1)).naive()
 
     queue_original_length = queue_original.count()
     queue_length = queue.count()
@@ -243,18 +522,42 @@ def process_queue_publish(queue_control, blog):
             queue_control.blog.id,
             queue_original_length))
 
-    removed_jobs = []
+    stats = PublishStats()
 
-    start = time.clock()
+    if workers > 1:
+        removed_jobs = publish_with_workers(queue, blog, workers, stats, run)
+    else:
+        removed_jobs = []
 
-    for q in queue:
-        job_type.action[q.job_type](q)
-        removed_jobs.append(q.id)
+        writer = FileWriter(stats=stats) if int(WRITER_THREADS) > 0 else None
 
-        if (time.clock() - start) > LOOP_TIMEOUT:
-            break
+        start = time.clock()
+
+        try:
+            with IdentityMap() as identity_map, run_fragments(run):
+                preload_jobs(identity_map, queue)
+
+                for q in queue:
+                    job_type.action[q.job_type](q, writer=writer, stats=stats)
+                    removed_jobs.append(q.id)
+
+                    if (time.clock() - start) > LOOP_TIMEOUT:
+                        break
+        finally:
+            errors = writer.join() if writer is not None else {}
+            stats.save()
+
+        removed_jobs = [n for n in removed_jobs if n not in errors]
 
-    Queue.remove(removed_jobs)
+        Queue.remove(removed_jobs)
+
+        if errors:
+            raise Exception('; '.join('Queue job #{}: {}'.format(n, errors[n])
+                for n in errors))
+
+    # Render figures are summed up across all the batches of a run,
+    # i.e., for as long as this control job exists.
+    stats.save_renders(blog, run)
 
     # we don't need to have an entirely new job!
     # we should recycle the existing one, yes?
@@ -265,36 +568,253 @@ def process_queue_publish(queue_control, blog):
         # Queue.is_control == True)
 
     queue_original_length -= len(removed_jobs)
-    new_queue_control.data_integer = queue_original_length
+    new_queue_control.data_integer = queue_original_length + mapping_jobs
 
     end_queue = time.clock()
 
     total_time = end_queue - start_queue
 
+    # Query counts, if the QUERY_STATS setting is enabled.
+    # With more than one worker, only the queries made in this process are counted.
+    queries = current_scope('queue')
+    queries = '; queries: {}'.format(queries.summary()) if queries is not None else ''
+
     if new_queue_control.data_integer <= 0:
         new_queue_control.delete_instance()
-        logger.info("Queue job #{} @ {} (blog #{}) finished ({:.4f} secs).".format(
+        logger.info("Queue job #{} @ {} (blog #{}) finished ({:.4f} secs; files: {}{}).".format(
             new_queue_control.id,
             date_format(new_queue_control.date_touched),
             new_queue_control.blog.id,
-            total_time))
+            total_time,
+            stats,
+            queries))
 
     else:
         # new_queue_control.is_running = False
         # new_queue_control.save()
         new_queue_control.unlock()
-        logger.info("Queue job #{} @ {} (blog #{}) processed {} items ({:.4f} secs, {} remaining).".format(
+        logger.info("Queue job #{} @ {} (blog #{}) processed {} items ({:.4f} secs, {} remaining; files: {}{}).".format(
             new_queue_control.id,
             date_format(new_queue_control.date_touched),
             new_queue_control.blog.id,
             len(removed_jobs),
             total_time,
             queue_original_length,
+            stats,
+            queries,
             ))
 
     return new_queue_control.data_integer
 
 
+def preload_jobs(identity_map, queue_entries):
+    '''
+    Loads the fileinfos for a batch of queue jobs into an identity map,
+    along with their archive contexts, template mappings, templates,
+    and blogs, using a few bulk queries instead of several queries per job.
+
+    :param identity_map:
+        The IdentityMap to load into.
+    :param queue_entries:
+        The queue jobs to be published.
+    '''
+    fileinfos = identity_map.preload(FileInfo,
+        (q.data_integer for q in queue_entries))
+    FileInfo.load_contexts(fileinfos)
+    mappings = identity_map.preload_related(fileinfos, FileInfo.template_mapping)
+    templates = identity_map.preload_related(mappings, TemplateMapping.template)
+    identity_map.preload_related(templates, Template.blog)
+
+
+# Pool of publishing worker processes, kept alive between queue passes
+# so that each worker's template cache and connection stay warm.
+
+_worker_pool = None
+_worker_pool_size = 0
+
+# Per-worker identity map, so workers don't reload the blog, templates and
+# so on for every job. It is kept only for a single batch, as in
+# process_queue_publish, so objects edited during a long publishing run
+# are picked up by the next batch.
+
+_worker_map = None
+_worker_batch = None
+
+# Identifies each batch sent to the worker pool by this process.
+
+_batch_ids = itertools.count(1)
+
+# Memoized include output for the publishing run in progress in this process.
+
+_run_fragments = {}
+
+
+def run_fragments(run):
+    '''
+    Returns the FragmentCache for a publishing run, discarding
+    the one for any earlier run.
+
+    :param run:
+        A string identifying the publishing run.
+    '''
+    try:
+        return _run_fragments[run]
+    except KeyError:
+        _run_fragments.clear()
+        _run_fragments[run] = FragmentCache()
+        return _run_fragments[run]
+
+
+def _publish_worker_init():
+    '''
+    Prepares a freshly spawned publishing worker.
+    Each worker has its own database connection and its own template cache.
+    '''
+    from core.models import db
+    from . import Cache
+    Cache.clear()
+    db.connect()
+
+
+def _publish_worker(job):
+    '''
+    Builds a single queued job inside a worker process.
+    Returns a tuple of the queue job's ID, an error string (if any),
+    and a PublishStats object for the job. Digests are not saved
+    by the worker; the parent process saves them.
+
+    :param job:
+        A tuple of (queue id, job type, data integer, blog id, run, batch),
+        as produced by publish_with_workers.
+    '''
+    global _worker_map, _worker_batch
+
+    queue_id, queue_job_type, data_integer, blog_id, run, batch = job
+
+    if batch != _worker_batch:
+        _worker_map = IdentityMap()
+        _worker_batch = batch
+
+    stats = PublishStats()
+
+    try:
+        with _worker_map, run_fragments(run):
+            queue_entry = Queue(id=queue_id,
+                job_type=queue_job_type,
+                data_integer=data_integer,
+                blog=get_mapped(Blog, blog_id))
+            job_type.action[queue_job_type](queue_entry, stats=stats)
+    except Exception as e:
+        return (queue_id, str(e), stats)
+
+    return (queue_id, None, stats)
+
+
+def publish_pool(workers):
+    '''
+    Returns the pool of publishing worker processes, creating it if needed.
+    Workers are spawned rather than forked, so that no database state
+    is shared with the parent process.
+
+    :param workers:
+        The number of worker processes in the pool.
+    '''
+    global _worker_pool, _worker_pool_size
+
+    if _worker_pool is not None and _worker_pool_size != workers:
+        close_publish_pool()
+
+    if _worker_pool is None:
+        import multiprocessing
+        _worker_pool = multiprocessing.get_context('spawn').Pool(
+            workers,
+            initializer=_publish_worker_init)
+        _worker_pool_size = workers
+
+    return _worker_pool
+
+
+def close_publish_pool():
+    '''
+    Shuts down the pool of publishing worker processes, if any.
+    '''
+    global _worker_pool, _worker_pool_size
+
+    if _worker_pool is not None:
+        _worker_pool.close()
+        _worker_pool.join()
+        _worker_pool = None
+        _worker_pool_size = 0
+
+
+def publish_with_workers(queue, blog, workers, stats=None, run=None):
+    '''
+    Sends a batch of claimed queue jobs to the publishing worker pool.
+    Jobs are handed out in rounds, one round per MAX_BATCH_OPS jobs per worker;
+    finished jobs are removed from the queue after each round.
+    Returns a list of the IDs of the jobs that were completed.
+
+    The workers have database connections of their own, so callers must
+    not run this inside a transaction: the workers couldn't see what the
+    transaction has written, and would be left waiting on its locks.
+    Each round's results are written in a transaction of their own.
+
+    :param queue:
+        The queue jobs to publish.
+    :param blog:
+        The blog object that is in context for these jobs.
+    :param workers:
+        The number of worker processes to publish with.
+    :param stats:
+        A PublishStats object to add the workers' results to.
+    :param run:
+        A string identifying the publishing run, so workers can
+        reuse memoized include output across batches of the run.
+    '''
+    if db.transaction_depth() > 0:
+        from core.error import DatabaseError
+        raise DatabaseError('Publishing with worker processes cannot be run inside a transaction.')
+
+    if stats is None:
+        stats = PublishStats()
+
+    pool = publish_pool(workers)
+
+    batch = '{}:{}'.format(os.getpid(), next(_batch_ids))
+
+    jobs = [(q.id, q.job_type, q.data_integer, blog.id, run, batch) for q in queue]
+
+    removed_jobs = []
+    round_size = workers * 4
+
+    start = time.clock()
+
+    for n in range(0, len(jobs), round_size):
+        finished = []
+        errors = []
+
+        for queue_id, error, job_stats in pool.imap_unordered(_publish_worker,
+                jobs[n:n + round_size]):
+            if error is None:
+                finished.append(queue_id)
+                stats.merge(job_stats)
+            else:
+                errors.append('Queue job #{}: {}'.format(queue_id, error))
+
+        with db.atomic():
+            stats.save()
+            Queue.remove(finished)
+        removed_jobs.extend(finished)
+
+        if errors:
+            raise Exception('; '.join(errors))
+
+        if (time.clock() - start) > LOOP_TIMEOUT:
+            break
+
+    return removed_jobs
+
+
 def process_queue_insert(queue_control, blog):
 
     # Queue for building fileinfo data
@@ -309,21 +829,27 @@ def process_queue_insert(queue_control, blog):
     result = 0
 
     if queue_control.data_string == 'page_fileinfos':
-        page_list = blog.pages.order_by(Page.id.desc())
-        index = page_list.count() - queue_control.data_integer
-        n = 0
-        while n < MAX_BATCH_OPS and index < page_list.count():
-            build_pages_fileinfos((page_list[index],))
-            build_archives_fileinfos((page_list[index],))
-            index += 1
-            n += 1
-
-        if index >= page_list.count():
+        # Pages are processed in ID order. The ID of the last page processed
+        # is kept in the control job, so each batch starts with an indexed
+        # lookup instead of an offset into the whole page list.
+        page_list = blog.pages.select().where(
+            Page.id > (queue_control.cursor or 0)).order_by(
+            Page.id.asc()).limit(MAX_BATCH_OPS)
+
+        batch = list(page_list.iterator())
+        build_pages_fileinfos_bulk(blog, batch)
+        n = len(batch)
+
+        if n < MAX_BATCH_OPS:
+            # Every page has been visited, so the next/previous index
+            # is built here rather than when it's first read.
+            PageNeighbor.rebuild(blog)
             queue_control.delete_instance()
+            result = 0
         else:
+            queue_control.cursor = batch[-1].id
             queue_control.data_integer -= n
-
-        result = page_list.count() - index
+            result = queue_control.data_integer
 
     if queue_control.data_string == 'index_fileinfos':
         index_list = blog.templates(template_type.index)
@@ -351,9 +877,131 @@ def process_queue_insert(queue_control, blog):
     return result
 
 
-def process_queue(blog):
+def queue_mapping_fileinfos(template):
+    '''
+    Pushes to the queue a job that reconciles the fileinfos
+    for a template's mappings with their current path expressions,
+    and queues the files that were added or moved for publishing.
+    This is an ordinary job, not a control job, so it doesn't lock
+    the blog against editing; it's run at the start of the blog's
+    next publishing pass. See process_mapping_jobs().
+    If such a job is already queued for the template, it is restarted.
+
+    :param template:
+        The template whose mappings have changed.
+    '''
+
+    if template.template_type not in job_type.action:
+        return None
+
+    blog = template.blog
+
+    try:
+        queue_job = Queue.get(Queue.blog == blog,
+            Queue.job_type == job_type.mapping,
+            Queue.data_integer == template.id)
+    except Queue.DoesNotExist:
+        queue_job = Queue(job_type=job_type.mapping,
+            is_control=False,
+            data_integer=template.id,
+            blog=blog,
+            site=blog.site)
+
+    queue_job.data_string = '{}: {}'.format(job_type.mapping, template.for_log)
+    queue_job.cursor = None
+    queue_job.date_touched = datetime.datetime.utcnow()
+    queue_job.save()
+
+    return queue_job
+
+
+def process_mapping_jobs(blog):
+    '''
+    Runs a batch of each of the mapping jobs queued for a blog
+    by queue_mapping_fileinfos(), and pushes the files that were added
+    or moved to the publishing queue. Finished jobs are removed.
+    Returns the number of mapping jobs left in the queue.
+
+    :param blog:
+        The blog whose mapping jobs are to be run.
+    '''
+
+    remaining = 0
+
+    for queue_job in Queue.select().where(Queue.blog == blog,
+            Queue.job_type == job_type.mapping).order_by(Queue.id.asc()):
+
+        try:
+            template = Template.get(Template.id == queue_job.data_integer)
+        except Template.DoesNotExist:
+            queue_job.delete_instance()
+            continue
+
+        if template.template_type == template_type.page:
+            # Page fileinfos are reconciled in batches of pages, in ID order,
+            # so the job can be resumed from the last page processed.
+            page_list = template.blog.pages.select().where(
+                Page.id > (queue_job.cursor or 0)).order_by(
+                Page.id.asc()).limit(MAX_BATCH_OPS)
+            batch = list(page_list.iterator())
+            reconciled = reconcile_mapping_fileinfos(template, batch)
+            finished = len(batch) < MAX_BATCH_OPS
+        else:
+            reconciled = reconcile_mapping_fileinfos(template)
+            finished = True
+
+        queue_mapping_jobs(template, reconciled.inserted + reconciled.updated)
+
+        if finished:
+            queue_job.delete_instance()
+        else:
+            queue_job.cursor = batch[-1].id
+            queue_job.save()
+            remaining += 1
+
+    return remaining
+
+
+def queue_mapping_jobs(template, fileinfo_ids):
+    '''
+    Pushes to the publishing queue the fileinfos, from a template's mappings,
+    that were added or changed when the mappings were reconciled.
+    Only published pages are queued, and nothing is queued
+    for templates that are set not to publish.
+
+    :param template:
+        The template the fileinfos belong to.
+    :param fileinfo_ids:
+        A list of fileinfo IDs.
+    '''
+
+    if not fileinfo_ids or template.publishing_mode == publishing_mode.do_not_publish:
+        return 0
+
+    blog = template.blog
+    published_pages = Page.select(Page.id).where(Page.blog == blog,
+        Page.status == page_status.published)
+
+    fileinfos = FileInfo.select(FileInfo.id).where(
+        FileInfo.id << fileinfo_ids,
+        ((FileInfo.page >> None) | (FileInfo.page << published_pages))).tuples()
+
+    return Queue.push_many({'job_type':template.template_type,
+        'blog':blog,
+        'site':blog.site,
+        'data_integer':f} for f, in fileinfos)
+
+
+def process_queue(blog, workers=None):
     '''
     Processes the jobs currently in the queue for the selected blog.
+
+    :param blog:
+        The blog object whose queue is to be processed.
+    :param workers:
+        The number of worker processes to publish with.
+        By default, jobs are built in this process.
+        See process_queue_publish.
     '''
 
     queue_control = Queue.acquire(blog, True)
@@ -361,40 +1009,51 @@ def process_queue(blog):
     if queue_control is None:
         return 0
 
-    if queue_control.job_type == job_type.control:
-        process_queue_publish(queue_control, blog)
-    elif queue_control.job_type == job_type.insert:
-        process_queue_insert(queue_control, blog)
+    with query_scope('queue', 'Queue job #{} ({}, blog #{})'.format(
+            queue_control.id, queue_control.job_type, blog.id)):
+        if queue_control.job_type == job_type.control:
+            process_queue_publish(queue_control, blog, workers)
+        elif queue_control.job_type == job_type.insert:
+            process_queue_insert(queue_control, blog)
 
     return Queue.job_counts(blog=blog)
 
 
-def queue_page_archive_actions(page):
+def queue_page_archive_actions(page, jobs=None, force=True):
     '''
     Pushes to the publishing queue all the page archives for a given page object.
 
     :param page:
         The page object whose archives will be pushed to the publishing queue.
+    :param jobs:
+        If supplied, the jobs are added to this list instead of being
+        pushed to the queue, so the caller can push them in one batch.
+    :param force:
+        Set to False to skip rendering files whose render fingerprints
+        are unchanged. See push_jobs().
     '''
 
-    #===========================================================================
-    # NOTE: I tried to speed this up by checking the list of fileinfos
-    # related to mappings for the page (if any), and then pushing those
-    # if they exist, but I haven't seen evidence it does anything tangible
-    # for performance.
-    # I need to double-check that old mappings are in fact invalidated
-    # when they are changed.
-    #===========================================================================
+    # The archive fileinfos for the page are looked up in the archive
+    # membership index. Templates with no archive fileinfos for the page
+    # there have them built, which also adds them to the index.
+
+    push = jobs is None
+    if push:
+        jobs = []
 
     archive_templates = page.blog.archive_templates
-    tags = template_tags(page=page)
+
+    members = {}
+    for n in page.archive_fileinfos:
+        members.setdefault(n._data.get('template_mapping'), []).append(n)
 
     for n in archive_templates:
         try:
             if n.publishing_mode != publishing_mode.do_not_publish:
-                fileinfo_mappings = FileInfo.select().where(FileInfo.page == page,
-                                                FileInfo.template_mapping << n.mappings)
-                if fileinfo_mappings.count() == 0:
+                fileinfo_mappings = []
+                for mapping_id, in n.mappings.select(TemplateMapping.id).tuples():
+                    fileinfo_mappings.extend(members.get(mapping_id, ()))
+                if len(fileinfo_mappings) == 0:
                     fileinfo_mappings=build_archives_fileinfos_by_mappings(n,(page,))
                 if len(fileinfo_mappings)==0:
                     logger.info('No archive fileinfos could be built for page {} with template {}'.format(
@@ -402,11 +1061,11 @@ def queue_page_archive_actions(page):
                         n.for_log))
                 else:
                     for fileinfo_mapping in fileinfo_mappings:
-                        Queue.push(job_type=job_type.archive,
-                                blog=page.blog,
-                                site=page.blog.site,
-                                priority=7,
-                                data_integer=fileinfo_mapping.id)
+                        jobs.append({'job_type':job_type.archive,
+                                'blog':page.blog,
+                                'site':page.blog.site,
+                                'priority':7,
+                                'data_integer':fileinfo_mapping.id})
         except Exception as e:
             from core.error import QueueAddError
             raise QueueAddError('Archive template {} for page {} could not be queued: '.format(
@@ -414,13 +1073,96 @@ def queue_page_archive_actions(page):
                 page.for_log,
                 e))
 
+    if push:
+        push_jobs(jobs, force)
+
 
-def queue_ssi_actions(blog):
+def queue_dependent_actions(blog, pages=(), categories=(), tags=(), collection=False):
+    '''
+    Pushes to the publishing queue the fileinfos whose last render read
+    any of the given pages, or the page listings of the given categories,
+    tags, or blog. Index and include fileinfos that have not been built
+    since dependency tracking was added are pushed as well, since
+    nothing is known about what they read. The fileinfos are always
+    rendered again, since what changed isn't part of their render fingerprints.
+
+    Index templates are only pushed if they are set to Immediate publishing,
+    as with queue_index_actions, and page templates are only pushed
+    for published pages.
+
+    :param blog:
+        The blog whose fileinfos are to be queued.
+    :param pages:
+        Pages (or page IDs) whose readers are to be queued.
+    :param categories:
+        Categories (or category IDs) whose page listing readers are to be queued.
+    :param tags:
+        Tags (or tag IDs) whose page listing readers are to be queued.
+    :param collection:
+        Set to True to also queue the readers of the blog's page listings,
+        e.g., when a page is published, unpublished, or moved in time.
+    '''
+
+    conditions = None
+
+    for obj, refs in ((dependency_type.page, pages),
+            (dependency_type.category, categories),
+            (dependency_type.tag, tags),
+            (dependency_type.blog, (blog,) if collection else ())):
+
+        refs = [getattr(n, 'id', n) for n in refs if n is not None]
+        if not refs:
+            continue
+
+        condition = (FileInfoDependency.object == obj) & (FileInfoDependency.ref << refs)
+        conditions = condition if conditions is None else (conditions | condition)
+
+    tracked = FileInfoDependency.select(FileInfoDependency.fileinfo).where(
+        FileInfoDependency.object == dependency_type.tracked)
+
+    affected = ((Template.template_type << (template_type.index, template_type.include))
+        & ~(FileInfo.id << tracked))
+
+    if conditions is not None:
+        dependents = FileInfoDependency.select(FileInfoDependency.fileinfo).where(conditions)
+        affected = affected | (FileInfo.id << dependents)
+
+    published_pages = Page.select(Page.id).where(Page.blog == blog,
+        Page.status == page_status.published)
+
+    fileinfos = FileInfo.select(FileInfo.id, Template.template_type).join(
+        TemplateMapping).join(Template).where(
+        Template.blog == blog,
+        ((FileInfo.page >> None) | (FileInfo.page << published_pages)),
+        Template.template_type << list(job_type.action),
+        Template.publishing_mode != publishing_mode.do_not_publish,
+        ((Template.template_type != template_type.index) |
+            (Template.publishing_mode == publishing_mode.immediate)),
+        affected).tuples()
+
+    priorities = {
+        job_type.include:10,
+        job_type.page:8,
+        job_type.archive:7,
+        job_type.index:1,
+        }
+
+    push_jobs(({'job_type':t,
+        'priority':priorities.get(t, 9),
+        'blog':blog,
+        'site':blog.site,
+        'data_integer':f} for f, t in fileinfos))
+
+
+def queue_ssi_actions(blog, force=True):
     '''
     Pushes to the publishing queue all the SSIs for a given blog.
 
     :param blog:
         The blog object whose SSI templates will be pushed to the queue.
+    :param force:
+        Set to False to skip rendering files whose render fingerprints
+        are unchanged. See push_jobs().
     '''
 
     templates = blog.ssi_templates.select()
@@ -428,17 +1170,19 @@ def queue_ssi_actions(blog):
     if templates.count() == 0:
         return None
 
-    for n in templates:
-        for f in n.fileinfos:
-            Queue.push(
-                job_type=job_type.include,
-                priority=10,
-                blog=blog,
-                site=blog.site,
-                data_integer=f.id)
+    mappings = TemplateMapping.select().where(TemplateMapping.template << templates)
+
+    fileinfos = FileInfo.select(FileInfo.id).where(
+        FileInfo.template_mapping << mappings).tuples()
 
+    push_jobs(({'job_type':job_type.include,
+        'priority':10,
+        'blog':blog,
+        'site':blog.site,
+        'data_integer':f} for f, in fileinfos), force)
 
-def queue_index_actions(blog, include_manual=False):
+
+def queue_index_actions(blog, include_manual=False, force=True):
     '''
     Pushes to the publishing queue all the index pages for a given blog
     that are marked for Immediate publishing.
@@ -449,6 +1193,9 @@ def queue_index_actions(blog, include_manual=False):
         If set to True, all templates, including those set to the Manual publishing mode,
         will be pushed to the queue. Default is False, since those templates are not
         pushed in most publishing actions.
+    :param force:
+        Set to False to skip rendering files whose render fingerprints
+        are unchanged. See push_jobs().
     '''
 
     templates = blog.index_templates.select().where(
@@ -464,12 +1211,11 @@ def queue_index_actions(blog, include_manual=False):
 
     mappings = TemplateMapping.select().where(TemplateMapping.template << templates)
 
-    fileinfos = FileInfo.select().where(FileInfo.template_mapping << mappings)
-
-    for f in fileinfos:
-        Queue.push(job_type=job_type.index,
-            priority=1,
-            blog=blog,
-            site=blog.site,
-            data_integer=f.id)
+    fileinfos = FileInfo.select(FileInfo.id).where(
+        FileInfo.template_mapping << mappings).tuples()
 
+    push_jobs(({'job_type':job_type.index,
+        'priority':1,
+        'blog':blog,
+        'site':blog.site,
+        'data_integer':f} for f, in fileinfos), force)
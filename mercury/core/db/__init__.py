@@ -9,7 +9,7 @@ class InitDBClass():
             'TagAssociation', 'Category', 'Theme', 'Template',
             'TemplateRevision', 'TemplateMapping', 'Media', 'FileInfo',
             'Queue', 'Permission', 'MediaAssociation', 'PageRevision',
-            'FileInfoContext', 'Plugin', 'Log', 'PluginData', 'ThemeData'
+            'FileInfoContext', 'FileInfoDependency', 'PageNeighbor', 'PageArchiveFileInfo', 'TemplateProfile', 'Plugin', 'Log', 'PluginData', 'ThemeData'
             )
 
         modules = []
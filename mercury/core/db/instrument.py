@@ -0,0 +1,310 @@
+'''
+Opt-in instrumentation for database queries.
+
+When the QUERY_STATS setting is enabled, every statement run through
+SqliteDB.execute_sql while a scope is open is counted and timed.
+Scopes are opened for each request, each queue job and each template render,
+and can be nested; a statement is recorded in every scope open at the time.
+Statements are grouped by shape, i.e., with their literal values removed,
+and a shape executed more than QUERY_STATS_REPEAT_LIMIT times in one scope
+is flagged as a likely N+1 pattern.
+
+Reports for the outermost scopes are kept in QUERY_STATS_FILE_PATH,
+so that those from other processes (e.g., the scheduled-tasks script)
+can be seen on the /system/queries page.
+'''
+
+import os, re, json, datetime, threading
+
+from contextlib import contextmanager
+
+import settings
+
+_local = threading.local()
+_file_lock = threading.Lock()
+
+# Number of shapes, slowest first, kept in a stored report.
+REPORT_SHAPES = 20
+
+_shape_patterns = (
+    (re.compile(r"'(?:[^']|'')*'"), '?'),
+    (re.compile(r'\b\d+(?:\.\d+)?\b'), '?'),
+    (re.compile(r'\?(?:\s*,\s*\?)+'), '?, ...'),
+    (re.compile(r'\s+'), ' '),
+    )
+
+
+def enabled():
+    '''
+    Returns True if query instrumentation is turned on.
+    '''
+    return settings.QUERY_STATS is True
+
+
+def active():
+    '''
+    Returns True if a scope is open in this thread, or queries are
+    being counted, i.e., if statements are being recorded.
+    '''
+    return bool(getattr(_local, 'scopes', None)) or getattr(_local, 'counting', 0) > 0
+
+
+def timing():
+    '''
+    Returns True if statements are being timed in this thread, i.e., if
+    a scope is open. Scopes are only opened when QUERY_STATS is enabled;
+    statements that are only counted (see count_queries()) aren't timed.
+    '''
+    return bool(getattr(_local, 'scopes', None))
+
+
+def count_queries(enable=True):
+    '''
+    Turns query counting on or off for this thread, whether or not
+    QUERY_STATS is enabled. Calls can be nested; counting stays on
+    until each call that turned it on is matched by one that turns it off.
+    See query_count().
+
+    :param enable:
+        True to turn counting on, False to turn it off.
+    '''
+    _local.counting = getattr(_local, 'counting', 0) + (1 if enable else -1)
+
+
+def query_count():
+    '''
+    Returns the number of statements recorded in this thread so far.
+    '''
+    return getattr(_local, 'count', 0)
+
+
+def query_shape(sql):
+    '''
+    Returns a statement with its literal values and the length
+    of its parameter lists removed, so statements that differ
+    only in their values can be grouped together.
+
+    :param sql:
+        The SQL statement.
+    '''
+    for pattern, replacement in _shape_patterns:
+        sql = pattern.sub(replacement, sql)
+    return sql.strip()
+
+
+def _repeat_limit():
+    return int(settings.QUERY_STATS_REPEAT_LIMIT)
+
+
+class QueryScope():
+    '''
+    The queries counted and timed for a single request, queue job or render.
+    Scopes nested in this one, e.g. the renders in a queue job,
+    are summed up by kind and name in its children.
+    '''
+
+    def __init__(self, kind, name):
+        self.kind = kind
+        self.name = name
+        self.date = datetime.datetime.utcnow()
+        self.count = 0
+        self.time = 0.0
+        self.shapes = {}
+        self.children = {}
+
+    def record(self, sql, elapsed):
+        shape = query_shape(sql)
+        entry = self.shapes.setdefault(shape, [0, 0.0])
+        entry[0] += 1
+        entry[1] += elapsed
+        self.count += 1
+        self.time += elapsed
+
+    def repeated(self):
+        '''
+        Returns a list of (shape, count) for the shapes executed
+        more than QUERY_STATS_REPEAT_LIMIT times in this scope.
+        '''
+        limit = _repeat_limit()
+        return sorted(((shape, n[0]) for shape, n in self.shapes.items()
+            if n[0] > limit), key=lambda x: x[1], reverse=True)
+
+    def add_child(self, scope):
+        child = self.children.setdefault((scope.kind, scope.name),
+            {'kind':scope.kind, 'name':scope.name, 'runs':0,
+             'count':0, 'time':0.0, 'repeated':{}})
+        child['runs'] += 1
+        child['count'] += scope.count
+        child['time'] += scope.time
+        for shape, n in scope.repeated():
+            child['repeated'][shape] = max(n, child['repeated'].get(shape, 0))
+
+    def summary(self):
+        '''
+        Returns a one-line summary of the queries in this scope.
+        '''
+        repeated = self.repeated()
+        return '{} queries in {:.4f} secs, {} shapes{}'.format(
+            self.count, self.time, len(self.shapes),
+            ', {} repeated'.format(len(repeated)) if repeated else '')
+
+    def report(self):
+        '''
+        Returns a dictionary describing this scope, for storage as JSON.
+        '''
+        shapes = sorted(self.shapes.items(), key=lambda x: x[1][1], reverse=True)
+        return {'kind':self.kind,
+            'name':self.name,
+            'date':self.date.isoformat(),
+            'count':self.count,
+            'time':self.time,
+            'summary':self.summary(),
+            'shapes':[(shape, n[0], n[1]) for shape, n in shapes[:REPORT_SHAPES]],
+            'repeated':self.repeated(),
+            'children':sorted(({'kind':n['kind'], 'name':n['name'], 'runs':n['runs'],
+                'count':n['count'], 'time':n['time'],
+                'repeated':sorted(n['repeated'].items(), key=lambda x: x[1], reverse=True)}
+                for n in self.children.values()), key=lambda x: x['time'], reverse=True)}
+
+
+def count(sql):
+    '''
+    Counts a statement without timing it, for when queries are being
+    counted but no scope is open.
+
+    :param sql:
+        The SQL statement that was executed.
+    '''
+    _local.count = getattr(_local, 'count', 0) + 1
+
+
+def record(sql, elapsed):
+    '''
+    Records a statement in each scope open in this thread.
+
+    :param sql:
+        The SQL statement that was executed.
+    :param elapsed:
+        The time, in seconds, it took to execute.
+    '''
+    _local.count = getattr(_local, 'count', 0) + 1
+    for scope in getattr(_local, 'scopes', ()):
+        scope.record(sql, elapsed)
+
+
+def begin_scope(kind, name, nested=False):
+    '''
+    Opens a scope, nested in any scope already open in this thread.
+    Returns the scope, or None if instrumentation is turned off.
+    Every scope that is opened must be closed with end_scope().
+
+    :param kind:
+        The kind of scope, e.g. 'request', 'queue' or 'render'.
+    :param name:
+        A name for the scope, e.g. the request path.
+    :param nested:
+        If True, the scope is only opened inside another scope,
+        e.g. so renders in publishing worker processes
+        aren't each stored as a report of their own.
+    '''
+    if not enabled() or (nested and not active()):
+        return None
+    scope = QueryScope(kind, name)
+    if not hasattr(_local, 'scopes'):
+        _local.scopes = []
+    _local.scopes.append(scope)
+    return scope
+
+
+def end_scope(scope):
+    '''
+    Closes a scope opened with begin_scope(), along with any scopes
+    opened in it that were left open, e.g. by an exception.
+    A nested scope is summed up in the scope it was opened in;
+    an outermost scope is stored as a report.
+
+    :param scope:
+        The scope to close. If this is None, nothing is done.
+    '''
+    scopes = getattr(_local, 'scopes', [])
+    if scope is None or scope not in scopes:
+        return
+    while scopes:
+        closed = scopes.pop()
+        if scopes:
+            scopes[-1].add_child(closed)
+        else:
+            save_report(closed)
+        if closed is scope:
+            break
+
+
+@contextmanager
+def query_scope(kind, name, nested=False):
+    '''
+    Opens a scope for the duration of a with block.
+    See begin_scope().
+    '''
+    scope = begin_scope(kind, name, nested)
+    try:
+        yield scope
+    finally:
+        end_scope(scope)
+
+
+def current_scope(kind=None):
+    '''
+    Returns the innermost scope open in this thread, or None.
+
+    :param kind:
+        If supplied, the innermost open scope of this kind.
+    '''
+    for scope in reversed(getattr(_local, 'scopes', ())):
+        if kind is None or scope.kind == kind:
+            return scope
+    return None
+
+
+def _report_path():
+    return settings.APPLICATION_PATH + settings.QUERY_STATS_FILE_PATH
+
+
+def save_report(scope):
+    '''
+    Adds the report for a scope to the stored reports,
+    keeping only the most recent QUERY_STATS_HISTORY of them.
+
+    :param scope:
+        The scope to store a report for.
+    '''
+    with _file_lock:
+        reports = load_reports()
+        reports.insert(0, scope.report())
+        del reports[int(settings.QUERY_STATS_HISTORY):]
+        path = _report_path()
+        temp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(reports, f)
+        os.replace(temp_path, path)
+
+
+def load_reports():
+    '''
+    Returns the stored scope reports, most recent first.
+    '''
+    try:
+        with open(_report_path(), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return []
+
+
+def clear_reports():
+    '''
+    Removes all stored scope reports.
+    '''
+    with _file_lock:
+        try:
+            os.remove(_report_path())
+        except FileNotFoundError:
+            pass
@@ -7,7 +7,9 @@ _stderr = bottle._stderr
 
 import os
 
-from . import InitDBClass
+from time import clock
+
+from . import InitDBClass, instrument
 
 from core.libs.playhouse.sqlite_ext import FTSModel, SqliteExtDatabase, TextField
 
@@ -18,6 +20,19 @@ class SqliteDB(SqliteExtDatabase, InitDBClass):
         pass
         # self.execute_sql('PRAGMA read_uncommitted = True;PRAGMA busy_timeout = 30000;PRAGMA schema.journal_mode=WAL;')
 
+    def execute_sql(self, sql, params=None, require_commit=True):
+        if not instrument.active():
+            return super().execute_sql(sql, params, require_commit)
+        if not instrument.timing():
+            # Only counted, e.g. for a template render profile.
+            instrument.count(sql)
+            return super().execute_sql(sql, params, require_commit)
+        start = clock()
+        try:
+            return super().execute_sql(sql, params, require_commit)
+        finally:
+            instrument.record(sql, clock() - start)
+
     def db_is_locked(self):
         return "database is locked"
 
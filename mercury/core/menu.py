@@ -44,7 +44,7 @@ menus = {
         'menu': (
             'system_div',
             'dashboard_label', 'system_queue', 'system_log', 'system_plugins',
-            'system_info',
+            'system_info', 'system_queries',
             'themes_div', 'system_manage_themes',
             'sites_div', 'manage_sites', 'create_site',
             'users_div', 'system_manage_users', 'system_create_user')
@@ -111,6 +111,12 @@ menus = {
         'text': lambda x: 'System information',
         'hover':'Information about this application',
         'parent':'system_menu'},
+    'system_queries': {
+        'type': 'label',
+        'path': lambda x: BASE_URL + '/system/queries',
+        'text': lambda x: 'Database queries',
+        'hover':'Query counts and timings, if QUERY_STATS is enabled',
+        'parent':'system_menu'},
     'sites_div': {
         'type': 'divider',
         'text': lambda x: 'Sites',
@@ -1,18 +1,20 @@
 import datetime, sys
 
 from core.utils import date_format, html_escape, csrf_tag, csrf_hash, trunc, create_basename_core
-from core.template import tpl
+from core.template import tpl, track_read, rendering, TemplateNamespace
 
 from settings import (DB_TYPE, DESKTOP_MODE, BASE_URL_ROOT, BASE_URL, DB_TYPE_NAME,
         SECRET_KEY, ENFORCED_CHARFIELD_CONSTRAINT, DEFAULT_THEME, LOOP_TIMEOUT)
 
 from core.libs.bottle import request, url, _stderr
-from core.libs.peewee import DeleteQuery, fn, SelectQuery  # , BaseModel as _BaseModel
+from core.libs.peewee import DeleteQuery, fn, SelectQuery, RelationDescriptor, JOIN_LEFT_OUTER  # , BaseModel as _BaseModel
 
 from core.libs.playhouse.sqlite_ext import (Model, PrimaryKeyField, CharField,
-   TextField, IntegerField, BooleanField, ForeignKeyField, DateTimeField, Check)
+   TextField, IntegerField, BooleanField, DateTimeField, FloatField, Check)
+from core.libs.playhouse.sqlite_ext import ForeignKeyField as _ForeignKeyField
 
 from functools import wraps
+import threading
 
 import settings as _settings
 
@@ -117,6 +119,18 @@ for n in page_status_list:
     page_status.modes[n[2]] = n[1]
     page_status.id[n[1]] = n[2]
 
+# Types of object recorded in the FileInfoDependency index.
+# Page reads are recorded per page; blog, category and tag reads
+# are recorded when a template reads that object's list of pages.
+
+dependency_type = Struct()
+dependency_type.page = 'P'
+dependency_type.blog = 'B'
+dependency_type.category = 'C'
+dependency_type.tag = 'T'
+# Marks a fileinfo that has been built with dependency tracking.
+dependency_type.tracked = '*'
+
 
 class EnforcedCharField(CharField):
 
@@ -144,6 +158,20 @@ class EnforcedCharField(CharField):
 
 class Pages(SelectQuery):
 
+    _prefetched_result = None
+
+    def __iter__(self):
+        # Pages iterated by an executing template have their related
+        # objects loaded in bulk, as templates usually read them per page.
+        if (not rendering() or self._explicit_selection
+                or self._tuples or self._dicts):
+            return super().__iter__()
+        result = self.execute()
+        if result is not self._prefetched_result:
+            prefetch_pages(list(result))
+            self._prefetched_result = result
+        return iter(result)
+
     @property
     def published(self):
         return self.where(Page.status == page_status.published)
@@ -163,11 +191,303 @@ class Pages(SelectQuery):
 #             return n.where(getattr(Page, prop).contains(value))
 
 
+class FileInfos(SelectQuery):
+    '''
+    A query of fileinfos that loads the archive context
+    for all of them when it's iterated. See FileInfo.load_contexts().
+    '''
+
+    _loaded_result = None
+
+    def __iter__(self):
+        if self._explicit_selection or self._tuples or self._dicts:
+            return super().__iter__()
+        result = self.execute()
+        if result is not self._loaded_result:
+            FileInfo.load_contexts(list(result))
+            self._loaded_result = result
+        return iter(result)
+
+
+class PrefetchedRows(list):
+    '''
+    The rows of a page relation loaded by prefetch_pages(). Iterating,
+    indexing, count() and get() read from memory; any other query method
+    (e.g., where()) runs against the original query.
+    '''
+
+    def __init__(self, rows, query, instance):
+        list.__init__(self, rows)
+        self._query = query
+        self._instance = instance
+
+    def __getattr__(self, name):
+        return getattr(self._query(self._instance), name)
+
+    def count(self):
+        return len(self)
+
+    def exists(self):
+        return len(self) > 0
+
+    def get(self):
+        if self:
+            return self[0]
+        return self._query(self._instance).get()
+
+
+def prefetchable(rows=False):
+    '''
+    Decorator for Page properties whose value can be loaded in bulk
+    by prefetch_pages(). The property returns the prefetched value,
+    if there is one, instead of querying.
+
+    :param rows:
+        True if the property returns a query, in which case the prefetched
+        rows are returned as PrefetchedRows.
+    '''
+    def decorator(func):
+        name = func.__name__
+        @wraps(func)
+        def wrapper(self):
+            prefetched = self._prefetched
+            if prefetched is None or name not in prefetched:
+                return func(self)
+            if rows:
+                return PrefetchedRows(prefetched[name], func, self)
+            return prefetched[name]
+        return wrapper
+    return decorator
+
+
+# Maximum number of keys in a single IN clause issued by prefetch_pages().
+PREFETCH_CHUNK_SIZE = 500
+
+def _chunked(keys):
+    keys = list(keys)
+    for n in range(0, len(keys), PREFETCH_CHUNK_SIZE):
+        yield keys[n:n + PREFETCH_CHUNK_SIZE]
+
+
+def prefetch_pages(pages):
+    '''
+    Loads the tags, media, primary category, author and permalink
+    (where it isn't stored on the page)
+    for a set of pages with a handful of grouped queries,
+    so that reading them for each page doesn't issue any queries.
+
+    :param pages:
+        An iterable of Page instances.
+    '''
+    pages = dict((n.id, n) for n in pages
+        if n.id is not None and n._prefetched is None)
+    if not pages:
+        return
+
+    prefetched = dict((n, {'tags':[], 'media':[]}) for n in pages)
+    sample = next(iter(pages.values()))
+
+    for name, association, field, model in (
+        ('tags', TagAssociation, TagAssociation.tag, Tag),
+        ('media', MediaAssociation, MediaAssociation.media, Media)):
+
+        # The rows are sorted by the database, with the same ORDER BY
+        # as the relation's own query, so they come back in the same order.
+        order = getattr(sample, name)._order_by or ()
+
+        for ids in _chunked(pages):
+            for n in model.select(model, association.page.alias('prefetch_page')).join(
+                    association, on=(field == model.id)).where(
+                    association.page << ids).distinct().order_by(*order).naive():
+                prefetched[n.prefetch_page][name].append(n)
+
+    primary = {}
+    for ids in _chunked(pages):
+        primary.update(PageCategory.select(PageCategory.page, PageCategory.category).where(
+            PageCategory.page << ids, PageCategory.primary == True).tuples())
+    for ids in _chunked(set(primary.values())):
+        categories = dict((n.id, n) for n in Category.select().where(Category.id << ids))
+        for page_id, category_id in primary.items():
+            if category_id in categories:
+                prefetched[page_id]['primary_category'] = categories[category_id]
+
+    for ids in _chunked(set(n._data.get('user') for n in pages.values())):
+        users = dict((n.id, n) for n in User.select().where(User.id << ids))
+        for page in pages.values():
+            if page._data.get('user') in users:
+                page._obj_cache['user'] = users[page._data['user']]
+
+    blogs = {}
+    for page in pages.values():
+        if page.canonical_file_path is None:
+            blogs.setdefault(page._data.get('blog'), []).append(page.id)
+
+    for blog_id, page_ids in blogs.items():
+        blog = pages[page_ids[0]].blog
+        try:
+            mapping = Template.get(Template.blog == blog_id,
+                Template.template_type == template_type.page,
+                Template.default_type == archive_type.page).default_mapping
+        except (Template.DoesNotExist, TemplateMapping.DoesNotExist):
+            continue
+        for ids in _chunked(page_ids):
+            for page_id, file_path in FileInfo.select(FileInfo.page, FileInfo.file_path).where(
+                    FileInfo.page << ids, FileInfo.template_mapping == mapping).tuples():
+                prefetched[page_id]['permalink'] = blog.url + "/" + file_path
+
+    for page_id, page in pages.items():
+        page._prefetched = prefetched[page_id]
+
+
+# The IdentityMap active in the current thread, if any.
+_identity_map = threading.local()
+
+
+class IdentityMap():
+    '''
+    Scoped map of model instances by primary key, used as a context manager
+    around a batch of work (e.g., a publishing run). While it is active,
+    foreign keys to the mapped models, and their load() methods, return
+    the instance already in the map instead of issuing a SELECT, and
+    rows can be loaded into the map in bulk with preload().
+
+    Only use this where the mapped rows are not modified by the work
+    being done, as changes to them will not be seen until it exits.
+    '''
+
+    def __init__(self, models=None):
+        '''
+        :param models:
+            The model classes to map. Defaults to the models that are
+            rarely changed while pages are queued or published.
+        '''
+        if models is None:
+            models = (Site, Theme, Blog, User, Category, Template, TemplateMapping)
+        self.models = set(models)
+        self.instances = {}
+        self.values = {}
+
+    def __enter__(self):
+        self._previous = getattr(_identity_map, 'current', None)
+        _identity_map.current = self
+        return self
+
+    def __exit__(self, *a):
+        _identity_map.current = self._previous
+
+    def get(self, model, pk):
+        '''
+        Returns the instance of a model with a given primary key,
+        loading it if it is not already mapped.
+        '''
+        instances = self.instances.setdefault(model, {})
+        try:
+            return instances[pk]
+        except KeyError:
+            instance = model.get(model._meta.primary_key == pk)
+            instances[pk] = instance
+            return instance
+
+    def preload(self, model, pks):
+        '''
+        Loads into the map, with one query per chunk of keys, the rows of
+        a model that are not already mapped. Returns the instances for all
+        the given keys that exist.
+
+        :param model:
+            The model class to load. It doesn't need to be one of the
+            models mapped for foreign keys.
+        :param pks:
+            An iterable of primary key values.
+        '''
+        instances = self.instances.setdefault(model, {})
+        pks = set(n for n in pks if n is not None)
+        missing = list(pks - set(instances))
+
+        for n in range(0, len(missing), 500):
+            for instance in model.select().where(
+                    model._meta.primary_key << missing[n:n + 500]):
+                instances[instance._get_pk_value()] = instance
+
+        return [instances[n] for n in pks if n in instances]
+
+    def preload_related(self, instances, field):
+        '''
+        Loads into the map the rows referred to by a foreign key
+        on a set of instances. Returns the related instances.
+
+        :param instances:
+            The instances whose foreign key is to be followed.
+        :param field:
+            The ForeignKeyField to follow, e.g. FileInfo.template_mapping.
+        '''
+        return self.preload(field.rel_model,
+            (n._data.get(field.name) for n in instances))
+
+
+def mapped_value(key, function):
+    '''
+    Returns the value of a function, computed only once for as long as
+    the active IdentityMap, if any, is active, e.g. a digest of rows
+    that the mapped instances were loaded from.
+
+    :param key:
+        A hashable key for the value.
+    :param function:
+        A function that takes no arguments and returns the value.
+    '''
+    identity_map = getattr(_identity_map, 'current', None)
+    if identity_map is None:
+        return function()
+    try:
+        return identity_map.values[key]
+    except KeyError:
+        value = identity_map.values[key] = function()
+        return value
+
+
+def get_mapped(model, pk):
+    '''
+    Returns the instance of a model with a given primary key,
+    from the active IdentityMap if there is one and it maps that model.
+    Raises model.DoesNotExist if there is no such row.
+    '''
+    identity_map = getattr(_identity_map, 'current', None)
+    if identity_map is not None and (model in identity_map.models or
+            model in identity_map.instances):
+        return identity_map.get(model, pk)
+    return model.get(model._meta.primary_key == pk)
+
+
+class MappedRelationDescriptor(RelationDescriptor):
+    '''
+    Resolves foreign keys from the active IdentityMap, if any.
+    '''
+    def get_object_or_id(self, instance):
+        rel_id = instance._data.get(self.att_name)
+        if rel_id is not None and self.att_name not in instance._obj_cache:
+            identity_map = getattr(_identity_map, 'current', None)
+            if (identity_map is not None and self.rel_model in identity_map.models
+                    and self.field.to_field is self.rel_model._meta.primary_key):
+                instance._obj_cache[self.att_name] = identity_map.get(
+                    self.rel_model, rel_id)
+        return super().get_object_or_id(instance)
+
+
+class ForeignKeyField(_ForeignKeyField):
+
+    def _get_descriptor(self):
+        return MappedRelationDescriptor(self, self.rel_model)
+
+
 class BaseModel(Model):
 
     class Meta:
         database = db
 
+    # The dependency_type recorded when a template reads this object's pages.
+    _pages_dependency = None
+
     def delete_instance(self, *a, **ka):
         no_kv_del = ka.pop('no_kv_del', False)
         if not no_kv_del:
@@ -184,6 +504,8 @@ class BaseModel(Model):
             n.__class__ = Pages
         except Exception:
             return None
+        if self._pages_dependency is not None:
+            track_read(self._pages_dependency, self.id)
         return n
 
     @classmethod
@@ -723,7 +1045,7 @@ class Theme(BaseModel):
     @classmethod
     def load(cls, theme_id=None):
         try:
-            theme = Theme.get(Theme.id == theme_id)
+            theme = get_mapped(Theme, theme_id)
         except Theme.DoesNotExist as e:
             raise Theme.DoesNotExist('Theme #{} does not exist.'.format(theme_id), e)
         return theme
@@ -774,7 +1096,7 @@ class Site(SiteBase, ConnectionBase):
     @classmethod
     def load(cls, site_id=None):
         try:
-            site = Site.get(Site.id == site_id)
+            site = get_mapped(Site, site_id)
         except Site.DoesNotExist as e:
             raise Site.DoesNotExist('Site #{} does not exist'.format(site_id), e)
         return site
@@ -866,6 +1188,14 @@ class Blog(SiteBase):
     timezone = TextField(null=True, default='UTC')
     set_timezone = None
 
+    _pages_dependency = dependency_type.blog
+
+    def save(self, *a, **ka):
+        # Cached templates hold the blog's settings, so drop them.
+        from core.cms import invalidate_cache
+        invalidate_cache(self)
+        return super().save(*a, **ka)
+
     # def theme_apply_to_blog(theme, blog, user):
     def apply_theme(self, theme, user):
 
@@ -944,6 +1274,7 @@ class Blog(SiteBase):
 
     def archives(self, name):
         archives = self.archive(name).get().fileinfos_published.order_by(FileInfo.mapping_sort.desc())
+        archives.__class__ = FileInfos
         return archives
 
     @property
@@ -1008,6 +1339,8 @@ class Blog(SiteBase):
         revisions_to_delete = TemplateRevision.delete().where(TemplateRevision.template_id << self.templates())
         t = revisions_to_delete.execute()
 
+        TemplateProfile.delete().where(TemplateProfile.template << self.templates()).execute()
+
         templates_to_delete = Template.delete().where(Template.id << self.templates())
         n = templates_to_delete.execute()
 
@@ -1128,7 +1461,7 @@ class Blog(SiteBase):
     @classmethod
     def load(cls, blog_id=None):
         try:
-            blog = Blog.get(Blog.id == blog_id)
+            blog = get_mapped(Blog, blog_id)
         except Blog.DoesNotExist as e:
             raise Blog.DoesNotExist('Blog #{} does not exist'.format(blog_id), e)
         return blog
@@ -1278,11 +1611,10 @@ class Blog(SiteBase):
         return self
 
     def ssi(self, ssi_name):
-        ssi = self.templates(template_type.include).select().where(
-            Template.title == ssi_name).get()
+        from core.cms import template_registry
         return '<!--#include virtual="/{}{}" -->'.format(
             self.subdir,
-            ssi.default_mapping.fileinfos.get().file_path)
+            template_registry(self).ssi_path(ssi_name))
 
     @property
     def ssi_templates(self):
@@ -1429,6 +1761,8 @@ class Category(BaseModel):
 
     security = 'is_blog_admin'
 
+    _pages_dependency = dependency_type.category
+
     def save(self, *a, **ka):
         if self.basename is None:
             self.basename = create_basename_core(self.title)
@@ -1547,10 +1881,29 @@ class Page(BaseModel, DateMod):
     status = CharField(max_length=32, index=True, default=page_status.unpublished)
     tag_text = TextField(null=True)
     currently_edited_by = IntegerField(null=True)
+    # File path of the page's default fileinfo, relative to the blog,
+    # stored by add_page_fileinfo() so permalink needs no fileinfo query.
+    # The URL is built from it when read, so it follows changes to the blog's URL.
+    canonical_file_path = EnforcedCharField(null=True, default=None)
     author = user
 
     security = 'is_page_editor'
 
+    # Related objects loaded in bulk by prefetch_pages(), if any.
+    _prefetched = None
+
+    # The fields that order the page among its neighbors, as loaded or last saved.
+    _neighbor_key = None
+
+    def prepared(self):
+        # A page left-joined to a missing row (e.g., by PageNeighbor.lookup()) has no ID.
+        if self.id is not None:
+            track_read(dependency_type.page, self.id)
+        self._neighbor_key = self._neighbor_fields()
+
+    def _neighbor_fields(self):
+        return (self.status, self.publication_date, self._data.get('blog'))
+
     def clear_categories(self):
         return PageCategory.delete().where(PageCategory.page == self).execute()
 
@@ -1658,6 +2011,7 @@ class Page(BaseModel, DateMod):
         return self.tags.where(Tag.is_hidden == True)
 
     @property
+    @prefetchable(rows=True)
     def tags(self):
         return Tag.select().where(
             Tag.id << TagAssociation.select(TagAssociation.tag).where(
@@ -1793,12 +2147,15 @@ class Page(BaseModel, DateMod):
         return default_fileinfo
 
     @property
+    @prefetchable()
     def permalink(self):
         '''
         Returns the permalink or canonical URL associated with the page.
-        Derived from the default fileinfo.
+        Derived from the default fileinfo, if it hasn't been stored on the page.
         '''
-        if self.id is not None:
+        if self.canonical_file_path is not None:
+            permalink = self.blog.url + "/" + self.canonical_file_path
+        elif self.id is not None:
             f_info = self.default_fileinfo
             permalink = self.blog.url + "/" + f_info.file_path
         else:
@@ -1841,11 +2198,22 @@ class Page(BaseModel, DateMod):
         return PageCategory.select().where(PageCategory.page == self)
 
     @property
+    def archive_fileinfos(self):
+        '''
+        Returns the archive fileinfos this page appears in,
+        from the archive membership index.
+        '''
+        return FileInfo.select().where(FileInfo.id << PageArchiveFileInfo.select(
+            PageArchiveFileInfo.fileinfo).where(PageArchiveFileInfo.page == self))
+
+    @property
+    @prefetchable()
     def primary_category(self):
 
         return self.categories.where(PageCategory.primary == True).limit(1).get().category
 
     @property
+    @prefetchable(rows=True)
     def media(self):
         '''
         Returns iterable of all Media types associated with an entry.
@@ -1854,7 +2222,7 @@ class Page(BaseModel, DateMod):
         media_association = MediaAssociation.select(MediaAssociation.media).where(
             MediaAssociation.page == self.id)
 
-        media = Media.select().where(Media.id << media_association)
+        media = Media.select().where(Media.id << media_association).order_by(Media.id)
 
         return media
 
@@ -1865,8 +2233,10 @@ class Page(BaseModel, DateMod):
         so that it can be filtered by some other method.
         This allows any number of next/previous methods to be built.
         '''
-        next_all = self.blog.pages.published.where(
-                Page.blog == self.blog, Page.id != self.id,
+        # The blog's pages are read through _pages so that neighbor lookups
+        # don't register as a read of the whole blog's page listing.
+        next_all = self.blog._pages.where(
+                Page.status == page_status.published, Page.id != self.id,
                 ((Page.publication_date > self.publication_date) |
                 ((Page.publication_date == self.publication_date) & (Page.id > self.id)))).order_by(
                 Page.publication_date.asc(), Page.id.asc())
@@ -1879,8 +2249,8 @@ class Page(BaseModel, DateMod):
         Returns all pages in this blog earlier than the current one
         so that it can be filtered by some other method.
         '''
-        prev_all = self.blog.pages.published.where(
-Page.blog == self.blog, Page.id != self.id,
+        prev_all = self.blog._pages.where(
+                Page.status == page_status.published, Page.id != self.id,
                 ((Page.publication_date < self.publication_date) |
                 ((Page.publication_date == self.publication_date) & (Page.id < self.id)))).order_by(
                 Page.publication_date.desc(), Page.id.desc())
@@ -1899,18 +2269,34 @@ Page.blog == self.blog, Page.id != self.id,
         Returns an iterable of all previous pages across categories for this page.
         '''
 
+    @property
+    def neighbors(self):
+        '''
+        Returns this page's row in the PageNeighbor index,
+        or None if the page is not indexed (e.g., it's unpublished).
+        '''
+        return PageNeighbor.lookup(self)
+
+    def _neighbor(self, field, fallback):
+        neighbors = PageNeighbor.lookup(self, field)
+        if neighbors is not None:
+            if getattr(neighbors, field.name) is None:
+                return None
+            if neighbors.neighbor.id is not None:
+                return neighbors.neighbor
+            # Otherwise the index points at a page that has since been removed.
+        try:
+            return getattr(self, fallback).get()
+        except Page.DoesNotExist:
+            return None
+
     @property
     def next_page(self):
         '''
         Returns the next published page in the blog, in ascending chronological order.
         This ignores all categories.
         '''
-
-        try:
-            next_page = self.next_all.get()
-        except Page.DoesNotExist:
-            next_page = None
-        return next_page
+        return self._neighbor(PageNeighbor.next_page, 'next_all')
 
     @property
     def previous_page(self):
@@ -1919,11 +2305,7 @@ Page.blog == self.blog, Page.id != self.id,
         This ignores all categories.
         '''
 
-        try:
-            previous_page = self.prev_all.get()
-        except Page.DoesNotExist:
-            previous_page = None
-        return previous_page
+        return self._neighbor(PageNeighbor.previous_page, 'prev_all')
 
     @property
     def next_in_categories(self, categories=None, _all=False):
@@ -1963,7 +2345,18 @@ Page.blog == self.blog, Page.id != self.id,
             page_revision = PageRevision.copy(self)
             revision_save_result = page_revision.save(user, self, backup_only, change_note)
 
+        # Fields are always assigned when a page is saved from the editor,
+        # so the values loaded with the page are compared rather than relying on _dirty.
+        neighbor_key = self._neighbor_fields()
+        neighbors_changed = self.id is None or neighbor_key != self._neighbor_key
+
         page_save_result = Model.save(self) if backup_only is False else None
+        self._prefetched = None
+
+        if backup_only is False:
+            if neighbors_changed:
+                PageNeighbor.update_page(self)
+            self._neighbor_key = neighbor_key
 
         if revision_save_result is not None:
             logger.info("Page {} edited by user {}.".format(
@@ -2079,6 +2472,127 @@ class PageCategory(BaseModel):
         pass
 
 
+class PageNeighbor(BaseModel):
+    '''
+    Materialized next/previous links between the published pages in a blog,
+    in the same order as Page.next_all and Page.prev_all.
+    Built in one sorted pass by rebuild(), when a blog's fileinfos are rebuilt
+    or its first page is saved, and kept current by update_page()
+    whenever a page's status or publication date changes.
+    Reading the index never writes to it.
+    '''
+    page = ForeignKeyField(Page, null=False, unique=True, index=True)
+    blog = ForeignKeyField(Blog, null=False, index=True)
+    next_page = IntegerField(null=True)
+    previous_page = IntegerField(null=True)
+
+    # Maximum number of rows written by a single insert in rebuild().
+    rebuild_chunk_size = 100
+
+    @classmethod
+    def rebuild(cls, blog):
+        '''
+        Recomputes the neighbor index for an entire blog.
+
+        :param blog:
+            The blog to index.
+        '''
+        page_ids = [page_id for page_id, in Page.select(Page.id).where(
+            Page.blog == blog,
+            Page.status == page_status.published).order_by(
+                Page.publication_date.asc(), Page.id.asc()).tuples()]
+
+        last = len(page_ids) - 1
+
+        rows = [{'page':page_id,
+            'blog':blog.id,
+            'previous_page':page_ids[n - 1] if n > 0 else None,
+            'next_page':page_ids[n + 1] if n < last else None}
+            for n, page_id in enumerate(page_ids)]
+
+        with db.atomic():
+            cls.delete().where(cls.blog == blog).execute()
+            for n in range(0, len(rows), cls.rebuild_chunk_size):
+                cls.insert_many(rows[n:n + cls.rebuild_chunk_size]).execute()
+
+    @classmethod
+    def lookup(cls, page, field=None):
+        '''
+        Returns the index row for a page, or None if the page is not published
+        or has no row, e.g. because the blog hasn't been indexed yet.
+        Callers then fall back to the ordered queries in Page.next_all
+        and Page.prev_all.
+
+        :param page:
+            The page to look up.
+        :param field:
+            Either next_page or previous_page. If given, the page it points to
+            is joined in the same query and returned as the row's neighbor,
+            whose ID is None if that page no longer exists.
+        '''
+        if page.id is None or page.status != page_status.published:
+            return None
+        query = cls.select()
+        if field is not None:
+            query = cls.select(cls, Page).join(Page, JOIN_LEFT_OUTER,
+                on=(field == Page.id).alias('neighbor'))
+        try:
+            return query.where(cls.page == page.id).get()
+        except cls.DoesNotExist:
+            return None
+
+    @classmethod
+    def update_page(cls, page):
+        '''
+        Moves a single page within the index after its status,
+        publication date or blog has changed.
+        Only the page's old and new neighbors are updated.
+
+        :param page:
+            The page that was saved.
+        '''
+        with db.atomic():
+            cls._unlink(page)
+            if page.status == page_status.published:
+                if cls.select().where(cls.blog == page.blog).exists():
+                    cls._link(page)
+                else:
+                    cls.rebuild(page.blog)
+
+    @classmethod
+    def _unlink(cls, page):
+        try:
+            row = cls.get(cls.page == page)
+        except cls.DoesNotExist:
+            return
+        if row.previous_page is not None:
+            cls.update(next_page=row.next_page).where(
+                cls.page == row.previous_page).execute()
+        if row.next_page is not None:
+            cls.update(previous_page=row.previous_page).where(
+                cls.page == row.next_page).execute()
+        row.delete_instance()
+
+    @classmethod
+    def _link(cls, page):
+        neighbors = {}
+        for field, query in (('previous_page', page.prev_all),
+            ('next_page', page.next_all)):
+            try:
+                neighbors[field] = query.select(Page.id).tuples().get()[0]
+            except Page.DoesNotExist:
+                neighbors[field] = None
+
+        cls.create(page=page, blog=page.blog, **neighbors)
+
+        if neighbors['previous_page'] is not None:
+            cls.update(next_page=page.id).where(
+                cls.page == neighbors['previous_page']).execute()
+        if neighbors['next_page'] is not None:
+            cls.update(previous_page=page.id).where(
+                cls.page == neighbors['next_page']).execute()
+
+
 class System(BaseModel):
 
     # we can consolidate this
@@ -2150,6 +2664,8 @@ class Tag(BaseModel):
     blog = ForeignKeyField(Blog, null=False, index=True)
     is_hidden = BooleanField(default=False, index=True)
 
+    _pages_dependency = dependency_type.tag
+
     tag_template = '''
     <span class='tag-block'><button {new} data-tag="{id}" id="tag_{id}" title="See details for tag '{tag_esc}'"
     type="button" class="btn btn-{btn_type} btn-xs tag-title">{tag}</button><button id="tag_del_{id}"
@@ -2312,15 +2828,20 @@ class Template(BaseModel, DateMod):
                 TemplateRevision.template_id == self.id)
         delete_revisions.execute()
 
+        TemplateProfile.delete().where(TemplateProfile.template == self.id).execute()
+
         t2 = Template.delete().where(Template.id == self.id)
         t2.execute()
 
+        from core.cms import invalidate_cache
+        invalidate_cache(self.blog)
+
         return BaseModel.delete_instance(self, *a, **ka)
 
     @classmethod
     def load(cls, template_id=None):
         try:
-            template = Template.get(Template.id == template_id)
+            template = get_mapped(Template, template_id)
         except Template.DoesNotExist as e:
             raise Template.DoesNotExist('Template #{} does not exist'.format(template_id), e)
 
@@ -2330,6 +2851,8 @@ class Template(BaseModel, DateMod):
         from types import ModuleType
         my_code = self.body
         m = ModuleType('new_module')
+        if isinstance(tags, TemplateNamespace):
+            tags = tags.resolved()
         m.__dict__.update(tags)
         exec(my_code, m.__dict__)
         return m
@@ -2410,6 +2933,9 @@ class Template(BaseModel, DateMod):
                 self.for_log,
                 user.for_log))
 
+        from core.cms import invalidate_cache
+        invalidate_cache(self.blog)
+
         return (page_save_result, revision_save_result)
 
     @property
@@ -2455,6 +2981,17 @@ class Template(BaseModel, DateMod):
             TemplateMapping.is_default == True).get()
         return default_mapping
 
+    @property
+    def render_profile(self):
+        '''
+        Returns the render profile from the most recent publishing run
+        that used the template, or None if there isn't one.
+        '''
+        try:
+            return TemplateProfile.get(TemplateProfile.template == self.id)
+        except TemplateProfile.DoesNotExist:
+            return None
+
 
 class TemplateRevision(Template, RevisionMixin):
     template_id = IntegerField(null=False)
@@ -2542,6 +3079,16 @@ class TemplateMapping(BaseModel):
 
         return fileinfos
 
+    @property
+    def path_code(self):
+        '''
+        Returns the compiled path expression for this mapping.
+        Compiled code is cached by path string, so it's only
+        recompiled when the path string changes.
+        '''
+        from core.cms.fileinfo import compile_mapping_path
+        return compile_mapping_path(self.path_string)
+
     @property
     def fileinfos_published(self):
 
@@ -2575,6 +3122,77 @@ class TemplateMapping(BaseModel):
     def last_in_mapping(self):
         pass
 
+
+class TemplateProfile(BaseModel):
+    '''
+    The render times, query counts and output sizes recorded for a template,
+    summed up over the most recent publishing run that used it.
+    Templates loaded as includes, SSIs or modules are recorded under their
+    own names, and their figures are also counted in the templates that load them.
+    '''
+
+    template = ForeignKeyField(Template, null=False, unique=True)
+    blog = ForeignKeyField(Blog, null=False, index=True)
+    # Identifies the publishing run the figures are from.
+    run = EnforcedCharField(null=False)
+    calls = IntegerField(default=0)
+    render_time = FloatField(default=0.0)
+    queries = IntegerField(default=0)
+    output_size = IntegerField(default=0)
+    date = DateTimeField(default=datetime.datetime.utcnow)
+
+    @property
+    def average_time(self):
+        return self.render_time / self.calls if self.calls else 0.0
+
+    @property
+    def average_queries(self):
+        return self.queries / self.calls if self.calls else 0.0
+
+    @classmethod
+    def record(cls, blog, run, renders):
+        '''
+        Adds the figures from a batch of renders to the profiles of a blog's
+        templates. Figures from an earlier publishing run are replaced.
+
+        :param blog:
+            The blog the templates belong to.
+        :param run:
+            A string identifying the publishing run.
+        :param renders:
+            A dictionary of template titles to lists of
+            [calls, seconds, queries, output size], as collected by
+            core.template.RenderProfile.
+        '''
+        if not renders:
+            return
+
+        templates = Template.select(Template.id, Template.title).where(
+            Template.blog == blog, Template.title << list(renders)).tuples()
+
+        existing = dict(cls.select(cls.template, cls.run).where(
+            cls.blog == blog).tuples())
+
+        now = datetime.datetime.utcnow()
+
+        with db.atomic():
+            for template_id, title in templates:
+                calls, render_time, queries, output_size = renders[title]
+                if existing.get(template_id) == run:
+                    cls.update(calls=cls.calls + calls,
+                        render_time=cls.render_time + render_time,
+                        queries=cls.queries + queries,
+                        output_size=cls.output_size + output_size,
+                        date=now).where(cls.template == template_id).execute()
+                elif template_id in existing:
+                    cls.update(run=run, calls=calls, render_time=render_time,
+                        queries=queries, output_size=output_size,
+                        date=now).where(cls.template == template_id).execute()
+                else:
+                    cls.insert(template=template_id, blog=blog, run=run, calls=calls,
+                        render_time=render_time, queries=queries,
+                        output_size=output_size, date=now).execute()
+
 ##########################
 
 
@@ -2735,6 +3353,12 @@ class FileInfo(BaseModel):
     modified_date = DateTimeField(default=datetime.datetime.utcnow)
     mapping_sort = EnforcedCharField(null=True, default=None, index=True)
     preview_path = TextField(null=True, index=True, default=None)
+    # Digest of the output last written for this fileinfo,
+    # used to skip rewriting files whose contents have not changed.
+    digest = EnforcedCharField(max_length=40, null=True, default=None)
+    # Fingerprint of the inputs the file was last rendered from,
+    # used to skip rendering when none of them have changed.
+    fingerprint = EnforcedCharField(max_length=40, null=True, default=None)
 
     # eventually we'll add "pages" as a property
     # which will perform the lookup we need
@@ -2790,18 +3414,11 @@ class FileInfo(BaseModel):
 
     @property
     def xref(self):
-        xref = TemplateMapping.select().where(
-            TemplateMapping.id == self.template_mapping).get()
-        return xref
+        return self.template_mapping
 
     @property
     def author(self):
-        try:
-            author = self.context.select().where(FileInfoContext.object == "A").get()
-            author = author.ref
-        except FileInfoContext.DoesNotExist:
-            author = None
-        return author
+        return self.context_values.get("A")
 
     @property
     def context(self):
@@ -2809,36 +3426,65 @@ class FileInfo(BaseModel):
             FileInfoContext.fileinfo == self).order_by(FileInfoContext.id.asc())
         return context
 
+    # Archive context loaded by context_values or load_contexts().
+    _context_values = None
+
+    @property
+    def context_values(self):
+        '''
+        Returns this fileinfo's archive context as a dictionary
+        of FileInfoContext object types to refs. The context is loaded
+        with a single query and kept for the life of the instance.
+        '''
+        if self._context_values is None:
+            FileInfo.load_contexts((self,))
+        return self._context_values
+
+    @classmethod
+    def load_contexts(cls, fileinfos):
+        '''
+        Loads the archive context for a list of fileinfos with one
+        query per 500 fileinfos, so that reading their year, month,
+        category, tags or author doesn't issue any queries.
+
+        :param fileinfos:
+            An iterable of FileInfo objects.
+        '''
+        fileinfos = dict((n.id, n) for n in fileinfos
+            if n._context_values is None)
+        contexts = dict((n, {}) for n in fileinfos)
+        fileinfo_ids = list(fileinfos)
+
+        for n in range(0, len(fileinfo_ids), 500):
+            for fileinfo_id, obj, ref in FileInfoContext.select(
+                    FileInfoContext.fileinfo, FileInfoContext.object,
+                    FileInfoContext.ref).where(
+                    FileInfoContext.fileinfo << fileinfo_ids[n:n + 500]).order_by(
+                    FileInfoContext.id.asc()).tuples():
+                contexts[fileinfo_id].setdefault(obj, ref)
+
+        for fileinfo_id, fileinfo in fileinfos.items():
+            fileinfo._context_values = contexts[fileinfo_id]
+
     @property
     def date(self):
         return datetime.date(self.year, self.month, 1)
 
     @property
     def year(self):
-        try:
-            year = self.context.select().where(FileInfoContext.object == "Y").get()
-            year = year.ref
-        except FileInfoContext.DoesNotExist:
-            year = None
-        return year
+        return self.context_values.get("Y")
 
     @property
     def month(self):
-        try:
-            month = self.context.select().where(FileInfoContext.object == "M").get()
-            month = month.ref
-        except FileInfoContext.DoesNotExist:
-            month = None
-        return month
+        return self.context_values.get("M")
+
+    @property
+    def day(self):
+        return self.context_values.get("D")
 
     @property
     def category(self):
-        try:
-            category = self.context.select().where(FileInfoContext.object == "c").get()
-            category = category.ref
-        except FileInfoContext.DoesNotExist:
-            category = None
-        return category
+        return self.context_values.get("c")
 
     @property
     def tag(self):
@@ -2846,28 +3492,22 @@ class FileInfo(BaseModel):
 
     @property
     def tags(self):
-        try:
-            category = self.context.select().where(FileInfoContext.object == "T").get()
-            category = category.ref
-        except FileInfoContext.DoesNotExist:
-            category = None
-        return category
+        return self.context_values.get("T")
 
 class PageArchiveFileInfo(BaseModel):
     '''
-    Stores which pages have what fileinfo entries.
-    This handles the page itself as well as the page's archives.
-    
-    modify:
-    add_page_fileinfo
-    build_archives_fileinfos_by_mappings
-    build_archives_fileinfos
-
-    and most anywhere else where we refer to a fileinfo by page
-    so this is a fairly major reworking.
+    Archive membership index: stores which archive fileinfos
+    each published page appears in.
+
+    Maintained by core.cms.fileinfo.update_archive_membership(),
+    which is called by the archive fileinfo builders and when a page
+    is saved or unpublished. A blog with no rows here has not been
+    indexed yet, and its archives are resolved with the archive
+    context queries instead.
     '''
     page = ForeignKeyField(Page, null=False, index=True)
     fileinfo = ForeignKeyField(FileInfo, null=False, index=True)
+    blog = ForeignKeyField(Blog, null=False, index=True)
 
 class FileInfoContext(BaseModel):
     fileinfo = ForeignKeyField(FileInfo, null=False, index=True)
@@ -2875,6 +3515,47 @@ class FileInfoContext(BaseModel):
     ref = IntegerField(null=True)
 
 
+class FileInfoDependency(BaseModel):
+    '''
+    Reverse index of the objects each fileinfo read the last time
+    it was rendered, so that a change to an object only queues
+    the fileinfos that depend on it.
+    '''
+    fileinfo = ForeignKeyField(FileInfo, null=False, index=True)
+    object = CharField(max_length=1, index=True)
+    ref = IntegerField(null=True, index=True)
+
+    # Maximum number of rows written by a single insert in record().
+    record_chunk_size = 100
+
+    @classmethod
+    def record(cls, dependencies):
+        '''
+        Replaces the recorded dependencies for a set of fileinfos.
+
+        :param dependencies:
+            A dictionary of fileinfo IDs to sets of (object, ref) pairs,
+            as recorded by core.template.ReadTracker.
+        '''
+        fileinfo_ids = list(dependencies)
+
+        rows = []
+        for fileinfo_id, reads in dependencies.items():
+            rows.append({'fileinfo':fileinfo_id,
+                'object':dependency_type.tracked,
+                'ref':None})
+            rows.extend({'fileinfo':fileinfo_id,
+                'object':obj,
+                'ref':ref} for obj, ref in reads)
+
+        with db.atomic():
+            for n in range(0, len(fileinfo_ids), cls.record_chunk_size * 4):
+                cls.delete().where(
+                    cls.fileinfo << fileinfo_ids[n:n + cls.record_chunk_size * 4]).execute()
+            for n in range(0, len(rows), cls.record_chunk_size):
+                cls.insert_many(rows[n:n + cls.record_chunk_size]).execute()
+
+
 class Queue(BaseModel):
     job_type = CharField(null=False, max_length=16, index=True)
     is_control = BooleanField(null=False, default=False, index=True)
@@ -2883,6 +3564,9 @@ class Queue(BaseModel):
     priority = IntegerField(default=9, index=True)
     data_string = TextField(null=True)
     data_integer = IntegerField(null=True, index=True)
+    # For a control job that works through a list of objects in batches,
+    # the ID of the last object processed.
+    cursor = IntegerField(null=True, default=None)
     date_touched = DateTimeField(default=datetime.datetime.utcnow)
     blog = ForeignKeyField(Blog, index=True, null=False)
     site = ForeignKeyField(Site, index=True, null=False)
@@ -2963,6 +3647,74 @@ class Queue(BaseModel):
         queue_job.save()
         return True
 
+    # Maximum number of rows written by a single insert in push_many.
+    # Keeps each statement under SQLite's limit on bound variables.
+    push_chunk_size = 100
+
+    @classmethod
+    def push_many(cls, jobs):
+        '''
+        Inserts a batch of job items into the work queue.
+        Jobs are deduplicated in memory on (job_type, data_integer, blog),
+        jobs that are already in the queue are dropped, and the rest are
+        written in chunks. Returns the number of jobs inserted.
+
+        :param jobs:
+            An iterable of dictionaries, each of which takes the same
+            keyword arguments as Queue.push (job_type, data_integer,
+            blog, site, priority). Control jobs should use Queue.push.
+        '''
+
+        pending = {}
+
+        for job in jobs:
+            blog_id = getattr(job['blog'], 'id', job['blog'])
+            key = (job['job_type'], int(job['data_integer']), blog_id)
+            if key in pending:
+                continue
+            pending[key] = {
+                'job_type':job['job_type'],
+                'data_integer':key[1],
+                'blog':blog_id,
+                'site':getattr(job['site'], 'id', job['site']),
+                'priority':job.get('priority', 9),
+                'is_control':False,
+                }
+
+        if not pending:
+            return 0
+
+        data_integers = list(set(key[1] for key in pending))
+        blog_ids = list(set(key[2] for key in pending))
+        chunk = cls.push_chunk_size * 4
+        file_paths = {}
+
+        for n in range(0, len(data_integers), chunk):
+            existing = cls.select(cls.job_type, cls.data_integer, cls.blog).where(
+                cls.is_control == False,
+                cls.blog << blog_ids,
+                cls.data_integer << data_integers[n:n + chunk]).tuples()
+            for key in existing:
+                pending.pop(key, None)
+
+            file_paths.update(FileInfo.select(FileInfo.id, FileInfo.file_path).where(
+                FileInfo.id << data_integers[n:n + chunk]).tuples())
+
+        rows = list(pending.values())
+        date_touched = datetime.datetime.utcnow()
+
+        for row in rows:
+            row['date_touched'] = date_touched
+            row['data_string'] = "{}: {}".format(
+                row['job_type'],
+                file_paths.get(row['data_integer'], row['data_integer']))
+
+        with db.atomic():
+            for n in range(0, len(rows), cls.push_chunk_size):
+                cls.insert_many(rows[n:n + cls.push_chunk_size]).execute()
+
+        return len(rows)
+
     # TODO: MOVE THIS TO THE QUEUE MODEL
     @classmethod
     def remove(cls, queue_deletes):
@@ -3274,29 +4026,94 @@ class ThemeData(AuxData):
             ThemeData.theme == Theme.get().where(
                 Theme.title == theme_title))
 
-# We should eventually convert this to a class where the attributes
-# are generated as needed on demand, not all at once. If possible
+from core import utils as _utils
 
 
-from core import utils as _utils
+class _TagsBase(object):
+    pass
 
+# The descriptor for the instance dictionary that TemplateTags.__dict__ wraps.
+_tags_dict = _TagsBase.__dict__['__dict__']
 
-class TemplateTags(object):
+
+class TemplateTags(_TagsBase):
     # Class for the template tags that are used in page templates.
     # Also used for building many other things.
 
     tags_init = ("blog", "page", "authors", "site", "user", "media",
         "template", "archive")
 
+    # Attributes that are only computed when first read.
+    # Each one is produced by the method named _get_<attribute>.
+    lazy_attributes = ("request", "sites", "csrf_token", "csrf",
+        "queue", "queue_count")
+
+    def __getattr__(self, name):
+        if name not in self.lazy_attributes:
+            raise AttributeError(name)
+        value = getattr(self, '_get_' + name)()
+        setattr(self, name, value)
+        return value
+
+    @property
+    def __dict__(self):
+        # Tags are handed to the admin interface's templates as
+        # **tags.__dict__, so any lazy attributes not yet read are computed here.
+        # Use namespace instead to keep them from being computed.
+        tags = _tags_dict.__get__(self)
+        for name in self.lazy_attributes:
+            if name not in tags:
+                getattr(self, name)
+        return tags
+
+    @property
+    def namespace(self):
+        '''
+        Returns the tags as a TemplateNamespace, for rendering a MetalTemplate
+        or evaluating a mapping, in which lazy attributes are only
+        computed if they're read.
+        '''
+        namespace = TemplateNamespace(_tags_dict.__get__(self))
+        namespace.lazy = self
+        return namespace
+
+    def _get_request(self):
+        return request
+
+    def _get_sites(self):
+        return Site.select()
+
+    def _get_csrf(self):
+        if self.user is not None:
+            return csrf_hash(self.user.last_login)
+        return csrf_hash(SECRET_KEY)
+
+    def _get_csrf_token(self):
+        if self.user is not None:
+            return csrf_tag(self.user.last_login)
+        return csrf_tag(SECRET_KEY)
+
+    def _get_queue(self):
+        if self.blog:
+            return Queue.select().where(Queue.blog == self.blog)
+        elif self.site:
+            return Queue.select().where(Queue.site == self.site)
+        return Queue.select()
+
+    def _get_queue_count(self):
+        if self.blog:
+            return Queue.job_counts(blog=self.blog)
+        elif self.site:
+            return Queue.job_counts(site=self.site)
+        return Queue.job_counts()
+
     def __init__(self, **ka):
 
         for key in self.tags_init:
             setattr(self, key, None)
 
-        self.request = request
         self.settings = _settings
         self.utils = _utils
-        self.sites = Site.select()
         self.status_modes = page_status
 
         self.tags = template_tags
@@ -3322,12 +4139,6 @@ class TemplateTags(object):
 
         if 'user' in ka:
             self.user = ka['user']
-            token = self.user.last_login
-        else:
-            token = SECRET_KEY
-
-        self.csrf_token = csrf_tag(token)
-        self.csrf = csrf_hash(token)
 
         if 'media_id' in ka:
             self.media = Media.load(ka['media_id'])
@@ -3366,18 +4177,6 @@ class TemplateTags(object):
         else:
             self.site = ka.get('site', self.site)
 
-        # Set queue for context
-        if self.blog:
-            self.queue = Queue.select().where(Queue.blog == self.blog)
-            self.queue_count = Queue.job_counts(blog=self.blog)
-
-        elif self.site:
-            self.queue = Queue.select().where(Queue.site == self.site)
-            self.queue_count = Queue.job_counts(site=self.site)
-        else:
-            self.queue = Queue.select()
-            self.queue_count = Queue.job_counts()
-
         if 'archive' in ka:
             # this whole thing is no good we need to rethink it
             # what's the point?
@@ -3450,5 +4249,27 @@ class TemplateTags(object):
 
 template_tags = TemplateTags
 
+
+class PublishingTags(TemplateTags):
+    '''
+    Template tags for publishing pages, archives, indexes and includes,
+    and for building their file paths. The queue, request and CSRF state
+    that only the admin interface uses are always None.
+    '''
+
+    lazy_attributes = ("sites",)
+
+    def __init__(self, **ka):
+        super().__init__(**ka)
+        # Defined, so that templates that refer to them still render.
+        self.request = None
+        self.csrf = None
+        self.csrf_token = None
+        self.queue = None
+        self.queue_count = None
+
+
+publishing_tags = PublishingTags
+
 # def template_tags(**ka):
 #     return TemplateTags(**ka)
@@ -6,7 +6,7 @@ def recreate_database():
 	from core.models import (db, User, Site, Blog, Page, PageCategory,
 		KeyValue, Tag, TagAssociation, Category,
 		Theme, Template, TemplateRevision, TemplateMapping, Media, FileInfo,
-		Queue, Permission, MediaAssociation, PageRevision, FileInfoContext, Plugin, Log, PluginData,
+		Queue, Permission, MediaAssociation, PageRevision, FileInfoContext, FileInfoDependency, PageNeighbor, PageArchiveFileInfo, TemplateProfile, Plugin, Log, PluginData,
 		ThemeData)
 
 	db.connect()
@@ -16,14 +16,14 @@ def recreate_database():
 		db.drop_tables((User, Site, Blog, Page, PageCategory,
 			KeyValue, Tag, TagAssociation, Category,
 			Theme, Template, TemplateRevision, TemplateMapping, Media, FileInfo,
-			Queue, Permission, MediaAssociation, PageRevision, FileInfoContext, Plugin, Log, PluginData,
+			Queue, Permission, MediaAssociation, PageRevision, FileInfoContext, FileInfoDependency, PageNeighbor, PageArchiveFileInfo, TemplateProfile, Plugin, Log, PluginData,
 			ThemeData),
 			safe=True)
 
 		db.create_tables((User, Site, Blog, Page, PageCategory,
 			KeyValue, Tag, TagAssociation, Category,
 			Theme, Template, TemplateRevision, TemplateMapping, Media, FileInfo,
-			Queue, Permission, MediaAssociation, PageRevision, FileInfoContext, Plugin, Log, PluginData,
+			Queue, Permission, MediaAssociation, PageRevision, FileInfoContext, FileInfoDependency, PageNeighbor, PageArchiveFileInfo, TemplateProfile, Plugin, Log, PluginData,
 			ThemeData),
 			safe=False)
 
@@ -5,6 +5,7 @@ from core.error import (UserNotFound, CSRFTokenNotFound)
 from core.libs.bottle import (Bottle, static_file, request, response, abort)
 from core.models import (db, Page, Blog, Theme, Media, FileInfo)
 from core.utils import csrf_hash, raise_request_limit
+from core.db.instrument import begin_scope, end_scope
 from settings import (BASE_PATH, DESKTOP_MODE, STATIC_PATH, PRODUCT_NAME,
                       APPLICATION_PATH, DEFAULT_LOCAL_ADDRESS, DEFAULT_LOCAL_PORT,
                       SECRET_KEY, BASE_URL_PROTOCOL)
@@ -14,6 +15,24 @@ _route = app.route
 _hook = app.hook
 
 
+@_hook('before_request')
+def query_stats_begin():
+    '''
+    Opens a scope for counting and timing the request's database queries,
+    if the QUERY_STATS setting is enabled.
+    '''
+    request.environ['mercury.query_scope'] = begin_scope('request',
+        '{} {}'.format(request.method, request.path))
+
+
+@_hook('after_request')
+def query_stats_end():
+    '''
+    Closes the request's query scope and stores its report.
+    '''
+    end_scope(request.environ.get('mercury.query_scope'))
+
+
 @_hook('before_request')
 def strip_path():
     '''
@@ -175,6 +194,15 @@ def system_queue():
     return system.system_queue()
 
 
+@_route(BASE_PATH + "/system/queries")
+def system_queries():
+    '''
+    Route for perusing recorded database query statistics
+    '''
+    from core.ui import system
+    return system.system_queries()
+
+
 @_route(BASE_PATH + "/system/themes")
 def system_themes():
     from core.ui import system
@@ -1269,11 +1297,10 @@ def queue_archive_template_fast(template_id, action, pass_id=0):
 
         r.body = "Adding {}".format(pass_id * 50)
 
-        for f in fileinfos:
-            Queue.push(job_type=cms.queue.job_type.archive,
-                    blog=blog,
-                    site=blog.site,
-                    data_integer=f.id)
+        Queue.push_many({'job_type':cms.queue.job_type.archive,
+                'blog':blog,
+                'site':blog.site,
+                'data_integer':f.id} for f in fileinfos)
 
         pass_id += 1
 
@@ -1315,11 +1342,11 @@ def queue_archive_template_all(template_id, action, pass_id=0):
 
         r.body = "Adding {}".format(pass_id * 50)
 
-        for f in fileinfo.build_archives_fileinfos_by_mappings(template, pages):
-            Queue.push(job_type=queue.job_type.archive,
-                    blog=blog,
-                    site=blog.site,
-                    data_integer=f.id)
+        Queue.push_many({'job_type':queue.job_type.archive,
+                'blog':blog,
+                'site':blog.site,
+                'data_integer':f.id}
+            for f in fileinfo.build_archives_fileinfos_by_mappings(template, pages))
 
         pass_id += 1
 
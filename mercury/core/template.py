@@ -1,5 +1,289 @@
 from core.libs.bottle import SimpleTemplate, cached_property
+from core.libs import bottle
 from functools import partial
+import threading, hashlib, marshal, os, tempfile, re, dis, types, builtins
+from importlib.util import MAGIC_NUMBER
+from time import perf_counter
+
+from core.db.instrument import count_queries, query_count
+
+from settings import (APPLICATION_PATH, TEMPLATE_CACHE_FILE_PATH,
+    TEMPLATE_CODE_CACHE, TEMPLATE_CODE_CACHE_SIZE, FRAGMENT_CACHE)
+
+# Change this whenever MetalTemplate changes how template source
+# is translated, so that code cached by older versions is not reused.
+TRANSLATOR_VERSION = '1'
+
+TEMPLATE_CACHE_PATH = APPLICATION_PATH + TEMPLATE_CACHE_FILE_PATH
+
+# Per-thread read tracking state: the active ReadTracker, if any,
+# how deeply nested the thread currently is in MetalTemplate.execute,
+# and the template registries checked for the outermost render.
+_tracking = threading.local()
+
+class ReadTracker():
+    '''
+    Records which database objects templates read while they execute,
+    as a set of (object, ref) pairs. Use as a context manager around
+    a render; reads made outside of MetalTemplate.execute are ignored.
+    '''
+
+    def __init__(self):
+        self.reads = set()
+
+    def __enter__(self):
+        self._previous = getattr(_tracking, 'tracker', None)
+        _tracking.tracker = self
+        return self
+
+    def __exit__(self, *a):
+        _tracking.tracker = self._previous
+
+class RenderProfile():
+    '''
+    Records the wall time, database queries and output size of each named
+    template executed while it is active, summed up by template name as
+    [calls, seconds, queries, output size]. Figures for a template include
+    those of the includes, SSIs and modules it loads.
+    Use as a context manager around a render, like ReadTracker.
+    '''
+
+    def __init__(self, templates=None):
+        '''
+        :param templates:
+            A dictionary to record the figures in, e.g. to sum up
+            several renders. Defaults to a new dictionary.
+        '''
+        self.templates = templates if templates is not None else {}
+
+    def __enter__(self):
+        self._previous = getattr(_tracking, 'profile', None)
+        _tracking.profile = self
+        count_queries(True)
+        return self
+
+    def __exit__(self, *a):
+        count_queries(False)
+        _tracking.profile = self._previous
+
+    def record(self, name, seconds, queries, output_size):
+        entry = self.templates.setdefault(name, [0, 0.0, 0, 0])
+        entry[0] += 1
+        entry[1] += seconds
+        entry[2] += queries
+        entry[3] += output_size
+
+class FragmentCache():
+    '''
+    Memoizes the output of includes for as long as it is active, e.g. for
+    a publishing run, so an include whose output doesn't depend on the page
+    being rendered is only rendered once. See MetalTemplate.fragment_scope.
+    Use as a context manager around renders; it can be re-entered,
+    e.g. once for each batch of a run.
+    '''
+
+    def __init__(self, size=None):
+        from core.cms import LRUCache
+        self.fragments = LRUCache(size)
+
+    def __enter__(self):
+        self._previous = getattr(_tracking, 'fragments', None)
+        _tracking.fragments = self.fragments
+        return self
+
+    def __exit__(self, *a):
+        _tracking.fragments = self._previous
+
+def track_read(obj, ref):
+    '''
+    Records a read in the active ReadTracker, if a template is executing.
+
+    :param obj:
+        The type of object read, from core.models.dependency_type.
+    :param ref:
+        The ID of the object read.
+    '''
+    if getattr(_tracking, 'depth', 0) > 0:
+        tracker = getattr(_tracking, 'tracker', None)
+        if tracker is not None:
+            tracker.reads.add((obj, ref))
+
+def rendering():
+    '''
+    Returns True if a template is executing in this thread.
+    '''
+    return getattr(_tracking, 'depth', 0) > 0
+
+def checked_registries():
+    '''
+    Returns a dictionary of the template registries checked against the
+    database during the outermost render executing in this thread, by blog ID,
+    or None if no template is executing. See core.cms.template_registry().
+    '''
+    if getattr(_tracking, 'depth', 0) > 0:
+        return _tracking.registries
+    return None
+
+def code_cache_key(source, filename, syntax=None):
+    '''
+    Returns the key for a template's compiled code in the on-disk code cache.
+    Templates with the same source share an entry, e.g., across blogs
+    that use the same theme.
+
+    :param source:
+        The template's source text.
+    :param filename:
+        The filename the code is compiled under.
+    :param syntax:
+        The template's syntax setting, if any.
+    '''
+    key = hashlib.sha1()
+    for n in (bottle.__version__, TRANSLATOR_VERSION, MAGIC_NUMBER.hex(),
+            filename, syntax, source):
+        key.update('{}\0'.format(n).encode('utf8'))
+    return key.hexdigest()
+
+def load_cached_code(key):
+    '''
+    Returns the code object stored in the code cache under a given key,
+    or None if there is no usable entry.
+    '''
+    cache_file = os.path.join(TEMPLATE_CACHE_PATH, key)
+    try:
+        with open(cache_file, 'rb') as f:
+            code = marshal.load(f)
+    except (OSError, EOFError, ValueError, TypeError):
+        return None
+    try:
+        # Refresh the entry's timestamp, so eviction removes
+        # the least recently used entries first.
+        os.utime(cache_file)
+    except OSError:
+        pass
+    return code
+
+def save_cached_code(key, code):
+    '''
+    Stores a code object in the code cache under a given key.
+    The entry is written to a temporary file and renamed into place,
+    so other processes never see a partial entry.
+    Failures are ignored, since the cache is only an optimization.
+    '''
+    try:
+        os.makedirs(TEMPLATE_CACHE_PATH, exist_ok=True)
+        fd, temp_file = tempfile.mkstemp(dir=TEMPLATE_CACHE_PATH, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                marshal.dump(code, f)
+            os.replace(temp_file, os.path.join(TEMPLATE_CACHE_PATH, key))
+        except Exception:
+            os.remove(temp_file)
+            raise
+    except Exception:
+        return
+    evict_cached_code()
+
+def evict_cached_code(max_size=None):
+    '''
+    Removes the least recently used entries from the code cache
+    until it is no larger than TEMPLATE_CODE_CACHE_SIZE bytes.
+    '''
+    if max_size is None:
+        max_size = int(TEMPLATE_CODE_CACHE_SIZE)
+
+    entries = []
+    total_size = 0
+    try:
+        with os.scandir(TEMPLATE_CACHE_PATH) as listing:
+            for n in listing:
+                try:
+                    stat = n.stat()
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, n.path))
+                total_size += stat.st_size
+    except OSError:
+        return
+
+    if total_size <= max_size:
+        return
+
+    entries.sort()
+    for mtime, size, path in entries:
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total_size -= size
+        if total_size <= max_size:
+            break
+
+# Names an include can read and still have its output memoized automatically:
+# builtins, the template helpers that don't depend on the page,
+# and the publishing tags that are the same for every file in a blog.
+FRAGMENT_SAFE_NAMES = frozenset(dir(builtins)) - frozenset(('locals', 'globals',
+    'vars', 'eval', 'exec', 'compile', '__import__', 'open', 'input')) | frozenset((
+    '_stdout', '_printlist', '_str', '_escape', 'ssi', 'module', 'test',
+    'blog', 'site', 'sites', 'settings', 'utils', 'status_modes', 'tags',
+    'search_query', 'search_terms'))
+
+# Opts an include in or out of memoization, e.g. "%# cache: template"
+# memoizes the include's output once for each template that includes it.
+_fragment_directive = re.compile(r'^[ \t]*%[ \t]*#[ \t]*(cache|nocache)\b:?([^\n]*)$', re.M)
+
+def code_reads(co):
+    '''
+    Returns the set of global names a compiled template reads without
+    first assigning them itself, including from nested code.
+    '''
+    loads, stores = set(), set()
+    codes = [co]
+    while codes:
+        code = codes.pop()
+        for n in dis.get_instructions(code):
+            if n.opname in ('LOAD_NAME', 'LOAD_GLOBAL'):
+                loads.add(n.argval)
+            elif n.opname in ('STORE_NAME', 'STORE_GLOBAL'):
+                stores.add(n.argval)
+        codes.extend(n for n in code.co_consts if isinstance(n, types.CodeType))
+    return loads - stores
+
+class TemplateNamespace(dict):
+    '''
+    The variables a template is run with.
+    If a TemplateTags object is attached as the namespace's lazy tags,
+    its lazy attributes are only computed when a template reads them,
+    and are then kept in the namespace.
+    '''
+
+    lazy = None
+
+    def __missing__(self, name):
+        if self.lazy is not None and name in self.lazy.lazy_attributes:
+            value = self[name] = getattr(self.lazy, name)
+            return value
+        raise KeyError(name)
+
+    def __contains__(self, name):
+        return (dict.__contains__(self, name) or
+            (self.lazy is not None and name in self.lazy.lazy_attributes))
+
+    def get(self, name, default=None):
+        try:
+            return self[name]
+        except KeyError:
+            return default
+
+    def resolved(self):
+        '''
+        Returns the namespace as a plain dictionary, with its lazy tags computed,
+        e.g. for the globals of a module template.
+        '''
+        values = dict(self)
+        if self.lazy is not None:
+            for name in self.lazy.lazy_attributes:
+                values[name] = self[name]
+        return values
 
 def tpl_include(tpl):
     return '<!--#include virtual="{}" -->'.format(
@@ -11,27 +295,53 @@ class MetalTemplate(SimpleTemplate):
 
     @cached_property
     def co(self):
-        return compile(self.code, self.filename or self.template_name or '<string>', 'exec')
+        filename = self.filename or self.template_name or '<string>'
+
+        if not TEMPLATE_CODE_CACHE or not isinstance(self.source, str):
+            return compile(self.code, filename, 'exec')
+
+        key = code_cache_key(self.source, filename, self.syntax)
+        co = load_cached_code(key)
+        if co is None:
+            co = compile(self.code, filename, 'exec')
+            save_cached_code(key, co)
+        return co
 
     def __init__(self, *args, **kwargs):
         self.template_name = kwargs.pop('template_name', None)
         super(MetalTemplate, self).__init__(*args, **kwargs)
         self._tags = kwargs.get('tags', None)
         self.blog = self._tags['blog']
-        self.blog_id = '{}_'.format(self.blog.id)
-        from core.models import Template
-        self.T = Template
-        from core.cms import Cache
+        from core.cms import Cache, template_registry
         self.M = Cache.module_cache
         self.I = Cache.include_cache
+        self._registry = template_registry
+
+    def _template(self, name):
+        '''
+        Returns one of the blog's templates, by title,
+        from the blog's template registry.
+        '''
+        return self._registry(self.blog).get(name)
+
+    def _template_version(self, name):
+        '''
+        Returns the ID and modification date of one of the blog's templates,
+        by title. Cached includes, SSIs and modules are keyed by this,
+        so an edited template is never served from an earlier version.
+        '''
+        template = self._template(name)
+        return (template.id, template.modified_date)
 
     def _load_ssi(self, env, ssi_name=None, **kwargs):
+        # The include's file path can change without the template changing.
+        ssi = self.blog.ssi(ssi_name)
+        key = (self.blog.id, 'ssi', ssi_name) + self._template_version(ssi_name) + (ssi,)
         try:
-            tpl = self.I[self.blog_id + ssi_name]
+            tpl = self.I[key]
         except KeyError:
-            ssi = self.blog.ssi(ssi_name)
-            tpl = MetalTemplate(ssi, tags=self._tags, **kwargs)
-            self.I[self.blog_id + ssi_name] = tpl
+            tpl = MetalTemplate(ssi, tags=self._tags, template_name=ssi_name, **kwargs)
+            self.I[key] = tpl
         try:
             n = tpl.execute(env['_stdout'], env)
         except Exception as e:
@@ -39,12 +349,24 @@ class MetalTemplate(SimpleTemplate):
         return n
 
     def _load_module(self, module_name):
+        profile = getattr(_tracking, 'profile', None)
+        if profile is not None:
+            start, queries = perf_counter(), query_count()
+        try:
+            return self._get_module(module_name)
+        finally:
+            if profile is not None:
+                profile.record(module_name, perf_counter() - start,
+                    query_count() - queries, 0)
+
+    def _get_module(self, module_name):
+        version = self._template_version(module_name)
+        key = (self.blog.id, module_name) + version
         try:
-            return self.M[self.blog_id + module_name]
+            return self.M[key]
         except KeyError:
-            module = self.blog.templates().where(
-                self.T.title == module_name).get().as_module(self._tags)
-            self.M[self.blog_id + module_name] = module
+            module = self._template(module_name).as_module(self._tags)
+            self.M[key] = module
             return module
 
 
@@ -54,7 +376,27 @@ class MetalTemplate(SimpleTemplate):
 
     # Copied from the underlying class.
     def execute(self, _stdout, kwargs):
-        env = self.defaults.copy()
+        depth = getattr(_tracking, 'depth', 0)
+        if depth == 0:
+            _tracking.registries = {}
+        _tracking.depth = depth + 1
+        profile = getattr(_tracking, 'profile', None)
+        if profile is not None and self.template_name is not None:
+            start, queries, output_start = perf_counter(), query_count(), len(_stdout)
+        else:
+            profile = None
+        try:
+            return self._execute(_stdout, kwargs)
+        finally:
+            _tracking.depth -= 1
+            if profile is not None:
+                profile.record(self.template_name, perf_counter() - start,
+                    query_count() - queries,
+                    sum(len(n) for n in _stdout[output_start:]))
+
+    def _execute(self, _stdout, kwargs):
+        env = TemplateNamespace(self.defaults)
+        env.lazy = getattr(kwargs, 'lazy', None)
         env.update(kwargs)
         env.update({
             'module':self._load_module,
@@ -73,22 +415,105 @@ class MetalTemplate(SimpleTemplate):
             return self._include(env, subtpl, **rargs)
         return env
 
+    @cached_property
+    def fragment_scope(self):
+        '''
+        For a template used as an include, returns a tuple of the names,
+        besides blog-level tags, that its output depends on, if its output
+        can be memoized by a FragmentCache; otherwise None.
+        A "%# cache: name, ..." line in the template opts it in, keyed on
+        the names listed, and a "%# nocache" line opts it out.
+        Otherwise, if FRAGMENT_CACHE is enabled, an include is memoized
+        if it reads nothing but FRAGMENT_SAFE_NAMES.
+        '''
+        directive = _fragment_directive.search(self.source or '')
+        if directive is not None:
+            if directive.group(1) == 'nocache':
+                return None
+            return tuple(n for n in re.split(r'[\s,]+', directive.group(2)) if n)
+        if FRAGMENT_CACHE is not True:
+            return None
+        if code_reads(self.co) - FRAGMENT_SAFE_NAMES:
+            return None
+        return ()
+
+    def fragment_key(self, env):
+        '''
+        Returns the part of the memoization key for this include that
+        depends on the including template's variables, or None if the
+        include's output can't be memoized in this context.
+        '''
+        scope = self.fragment_scope
+        if scope is None:
+            return None
+        key = tuple((n, getattr(env.get(n), 'id', env.get(n))) for n in scope)
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
     def _include(self, env, _name=None, **kwargs):
+        version = self._template_version(_name)
+        key = (self.blog.id, 'include', _name) + version
         try:
-            tpl = self.I[self.blog_id + _name]
+            tpl = self.I[key]
         except KeyError:
-            template_to_import = self.blog.templates().where(
-                self.T.title == _name).get().body
-            tpl = MetalTemplate(template_to_import, tags=self._tags, **kwargs)
-            self.I[self.blog_id + _name] = tpl
+            template_to_import = self._template(_name).body
+            tpl = MetalTemplate(template_to_import, tags=self._tags, template_name=_name, **kwargs)
+            self.I[key] = tpl
+
+        # Includes called with arguments are never memoized.
+        fragments = getattr(_tracking, 'fragments', None)
+        fragment_key = None
+        if fragments is not None and not kwargs:
+            fragment_key = tpl.fragment_key(env)
+
+        if fragment_key is not None:
+            fragment_key = key + fragment_key
+            try:
+                text, reads = fragments[fragment_key]
+            except KeyError:
+                pass
+            else:
+                # The reads the include made when it was rendered are
+                # recorded again, so the fileinfo's dependencies are complete.
+                env['_stdout'].append(text)
+                tracker = getattr(_tracking, 'tracker', None)
+                if tracker is not None:
+                    tracker.reads |= reads
+                return env
+
         try:
-            n = tpl.execute(env['_stdout'], env)
+            if fragment_key is None:
+                n = tpl.execute(env['_stdout'], env)
+            else:
+                _stdout = env['_stdout']
+                start = len(_stdout)
+                with ReadTracker() as tracker:
+                    n = tpl.execute(_stdout, env)
+                fragments[fragment_key] = (''.join(_stdout[start:]), tracker.reads)
+                if tracker._previous is not None:
+                    tracker._previous.reads |= tracker.reads
         except Exception as e:
             raise Exception(e, _name)
         return n
 
     def render(self, *args, **kwargs):
-        return super(MetalTemplate, self).render(*args, **kwargs)
+        '''
+        Renders the template with the variables supplied.
+        Pass a TemplateNamespace, e.g. from TemplateTags.namespace,
+        as a positional argument to keep its lazy tags from being computed
+        unless the template reads them.
+        '''
+        env = TemplateNamespace()
+        for dictarg in args:
+            env.update(dictarg)
+            env.lazy = getattr(dictarg, 'lazy', env.lazy)
+        env.update(kwargs)
+        stdout = []
+        self.execute(stdout, env)
+        return ''.join(stdout)
 
 def tpl(*args, **ka):
     '''
@@ -108,7 +533,7 @@ def tplt(template, tags):
     Provides detailed error information at the exact line of a template.
     '''
 
-    context = tags.__dict__
+    context = tags.namespace
     try:
         return MetalTemplate(source=template.body, tags=context).render(context)
     except Exception as e:
@@ -497,7 +497,11 @@ def blog_republish(blog_id, pass_id=1, item_id=0):
     r = HTTPResponse()
 
     if pass_id == 1:
-        cms.queue.queue_ssi_actions(blog)
+        # A forced republish renders every file again; otherwise files
+        # whose render fingerprints are unchanged are skipped.
+        if request.query.force:
+            cms.fileinfo.clear_fingerprints(blog)
+        cms.queue.queue_ssi_actions(blog, force=False)
         item_id = 0
 
         data.append("<h3>Queuing <b>{}</b> for republishing, pass {}, item {}</h3><hr>".format(
@@ -506,7 +510,7 @@ def blog_republish(blog_id, pass_id=1, item_id=0):
             item_id))
 
     elif pass_id == 2:
-        cms.queue.queue_index_actions(blog, include_manual=True)
+        cms.queue.queue_index_actions(blog, include_manual=True, force=False)
         item_id = 0
 
         data.append("<h3>Queuing <b>{}</b> for republishing, pass {}, item {}</h3><hr>".format(
@@ -525,7 +529,7 @@ def blog_republish(blog_id, pass_id=1, item_id=0):
             total))
 
         if pages.count() > 0:
-            cms.queue.queue_page_actions(pages, no_neighbors=True)
+            cms.queue.queue_page_actions(pages, no_neighbors=True, force=False)
             item_id += 1
         else:
             item_id = 0
@@ -983,6 +987,8 @@ def blog_apply_theme(blog_id, theme_id):
         from core.models import db
         with db.atomic() as txn:
             blog.apply_theme(theme, user)
+            # The theme's settings aren't covered by render fingerprints.
+            fileinfo.clear_fingerprints(blog)
 
         status = Status(
             type='success',
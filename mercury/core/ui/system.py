@@ -40,6 +40,10 @@ def system_info():
         if n is not '__builtins__':
             settings_list.append((n, s_dict[n]))
 
+    # List template cache usage for this process
+    from core.cms import Cache
+    cache_list = Cache.stats()
+
     # List all plugins
 
     tpl = template('ui/ui_system_info',
@@ -47,6 +51,7 @@ def system_info():
         search_context=(search_contexts['sites'], None),
         environ_list=sorted(environ_list),
         settings_list=sorted(settings_list),
+        cache_list=cache_list,
         **tags.__dict__)
 
     return tpl
@@ -85,6 +90,28 @@ def system_log():
                user=user)
 
 
+@transaction
+def system_queries():
+    user = auth.is_logged_in(request)
+    permission = auth.is_sys_admin(user)
+
+    tags = template_tags(
+        user=user)
+
+    import settings
+    from core.db import instrument
+
+    tpl = template('ui/ui_system_queries',
+        menu=generate_menu('system_queries', None),
+        search_context=(search_contexts['sites'], None),
+        reports=instrument.load_reports(),
+        enabled=instrument.enabled(),
+        repeat_limit=settings.QUERY_STATS_REPEAT_LIMIT,
+        **tags.__dict__)
+
+    return tpl
+
+
 @transaction
 def register_plugin(plugin_path):
     user = auth.is_logged_in(request)
@@ -402,10 +402,10 @@ def template_preview_core(template_id):
     from core.cms import fileinfo
     from core.cms import invalidate_cache
 
-    invalidate_cache()
-
     template = Template.load(template_id)
 
+    invalidate_cache(template.blog)
+
     # TODO: only rebuild mappings if the dirty bit is set
 
     if template.template_type == template_type.index:
@@ -588,13 +588,15 @@ def template_save(request, user, cms_template, blog=None):
             n.id,
             n.path_string))
 
+    # Fileinfos for changed mappings are reconciled by a queued job,
+    # which also queues the files that were added or moved.
     if new_mappings:
         fileinfo.build_mapping_xrefs(new_mappings)
-        build_action = "all"
-    else:
-        build_action = "fast"
+        status.append("Files for changed mappings queued for rebuilding.")
+
+    build_action = "fast"
 
-    invalidate_cache()
+    invalidate_cache(cms_template.blog)
 
     # TODO: eventually everything after this will be removed b/c of AJAX save
     # tags = template_tags(template_id=cms_template.id, user=user)
@@ -627,11 +629,10 @@ def template_save(request, user, cms_template, blog=None):
             # if new_mappings:
                 # cms.build_archives_fileinfos_by_mappings(cms_template)
 
-            for f in cms_template.fileinfos_published:
-                Queue.push(job_type=f.template_mapping.template.template_type,
-                    blog=cms_template.blog,
-                    site=cms_template.blog.site,
-                    data_integer=f.id)
+            Queue.push_many({'job_type':cms_template.template_type,
+                'blog':cms_template.blog,
+                'site':cms_template.blog.site,
+                'data_integer':f.id} for f in cms_template.fileinfos_published)
 
         status.append("{} files regenerated from template and sent to publishing queue.".format(
             cms_template.fileinfos_published.count()))
@@ -332,10 +332,12 @@ def generate_date_mapping(date_value, tags, path_string, do_eval=True):
     using a date value, a tag set, and the supplied path string.
     This is often used for resolving template mappings.
     The tag set is contextual -- e.g., for a blog or a site.
+    The path string can also be a compiled code object,
+    such as TemplateMapping.path_code.
     '''
 
     if do_eval:
-        time_string = eval(path_string, tags.__dict__)
+        time_string = eval(path_string, tags.namespace)
     else:
         time_string = path_string
 
@@ -27,6 +27,7 @@
     
     % if blog is not None:
     <li><a href="{{settings.BASE_URL}}/blog/{{blog.id}}/republish" target="_blank">Republish blog</a></li>
+    <li><a href="{{settings.BASE_URL}}/blog/{{blog.id}}/republish?force=1" target="_blank">Republish blog, rendering every file</a></li>
     <li><a href="{{settings.BASE_URL}}/blog/{{blog.id}}/purge" target="_blank">Purge and republish blog</a></li>
     
     % elif site is not None:
@@ -16,6 +16,17 @@
         {{template.template_ref}}
     </p>
 
+    % profile = template.render_profile
+    % if profile is not None:
+    <label for="render_profile">Last publishing run:</label>
+    <p id="render_profile">
+        avg render {{'{:.0f}'.format(profile.average_time * 1000)}} ms,
+        {{'{:.0f}'.format(profile.average_queries)}} queries,
+        called {{'{:,}'.format(profile.calls)}} times
+        <br/><small>{{'{:,}'.format(profile.output_size // profile.calls if profile.calls else 0)}} characters of output per call; includes the templates it loads</small>
+    </p>
+    % end
+
     <p><small><a id="revision_link" href="#">See earlier revisions</a></small></p>
 
 </div>
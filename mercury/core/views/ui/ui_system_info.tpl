@@ -13,6 +13,21 @@
 	    </div>
 	</div>
 	% end
+<h3>Template cache (this process)</h3>
+    <div class="col-xs-12">
+        <div class="col-xs-3"><b>Cache</b></div>
+        <div class="col-xs-3"><b>Entries</b></div>
+        <div class="col-xs-3"><b>Hits</b></div>
+        <div class="col-xs-3"><b>Misses</b></div>
+    </div>
+    % for n in cache_list:
+    <div class="col-xs-12">
+        <div class="col-xs-3">{{n[0]}}</div>
+        <div class="col-xs-3">{{n[1]}}</div>
+        <div class="col-xs-3">{{n[2]}}</div>
+        <div class="col-xs-3">{{n[3]}}</div>
+    </div>
+    % end
 <h3>Installation information</h3>
     % for n in settings_list:
     <div class="col-xs-12">
@@ -0,0 +1,60 @@
+% include('include/header.tpl')
+% include('include/header_messages.tpl')
+<div class="container">
+<h2>Database queries</h2><hr/>
+% if not enabled:
+<p>Query statistics are not being collected. Set <code>QUERY_STATS</code> to <code>True</code> to collect them.</p>
+% end
+% if not reports:
+<p>No query reports have been recorded.</p>
+% end
+% for r in reports:
+<h4>{{r['name']}} <small>{{r['kind']}}, {{r['date']}}</small></h4>
+<p>{{r['summary']}}</p>
+    % if r['repeated']:
+    <div class="col-xs-12"><b>Repeated more than {{repeat_limit}} times</b></div>
+    % for shape, count in r['repeated']:
+    <div class="col-xs-12">
+        <div class="col-xs-2 text-danger">{{count}}</div>
+        <div class="col-xs-10"><code>{{shape}}</code></div>
+    </div>
+    % end
+    % end
+    % if r['children']:
+    <div class="col-xs-12">
+        <div class="col-xs-6"><b>Nested</b></div>
+        <div class="col-xs-2"><b>Runs</b></div>
+        <div class="col-xs-2"><b>Queries</b></div>
+        <div class="col-xs-2"><b>Secs</b></div>
+    </div>
+    % for c in r['children']:
+    <div class="col-xs-12">
+        <div class="col-xs-6">{{c['kind']}}: {{c['name']}}</div>
+        <div class="col-xs-2">{{c['runs']}}</div>
+        <div class="col-xs-2">{{c['count']}}</div>
+        <div class="col-xs-2">{{'{:.4f}'.format(c['time'])}}</div>
+    </div>
+        % for shape, count in c['repeated']:
+    <div class="col-xs-12">
+        <div class="col-xs-2 col-xs-offset-1 text-danger">{{count}}</div>
+        <div class="col-xs-9"><code>{{shape}}</code></div>
+    </div>
+        % end
+    % end
+    % end
+    <div class="col-xs-12">
+        <div class="col-xs-8"><b>Slowest shapes</b></div>
+        <div class="col-xs-2"><b>Count</b></div>
+        <div class="col-xs-2"><b>Secs</b></div>
+    </div>
+    % for shape, count, secs in r['shapes']:
+    <div class="col-xs-12">
+        <div class="col-xs-8"><code>{{shape}}</code></div>
+        <div class="col-xs-2">{{count}}</div>
+        <div class="col-xs-2">{{'{:.4f}'.format(secs)}}</div>
+    </div>
+    % end
+<div class="clearfix"></div><hr/>
+% end
+</div>
+% include('include/footer.tpl')
@@ -10,20 +10,33 @@ if __name__ == '__main__':
         import settings
 
     from core.models.transaction import transaction
-    from core.cms.queue import process_queue
+    from core.cms.queue import process_queue, close_publish_pool
 
     opts = set()
+    workers = int(settings.PUBLISH_WORKERS)
 
     if len(sys.argv) > 1:
         for n in range(1, len(sys.argv)):
             opts.add(sys.argv[n])
+            if sys.argv[n] == '--workers' and n + 1 < len(sys.argv):
+                workers = int(sys.argv[n + 1])
+            elif sys.argv[n].startswith('--workers='):
+                workers = int(sys.argv[n].split('=', 1)[1])
 
     nowait = True if '--nowait' in opts else False
     clear_job = True if '--clearjob' in opts else False
-
-    @transaction
-    def run(n):
-        return process_queue(n)
+    gc_delete = True if '--gc-delete' in opts else False
+    gc = True if '--gc' in opts or gc_delete else False
+
+    if workers > 1:
+        # Worker processes have database connections of their own,
+        # so they can't publish inside this process's transaction.
+        def run(n):
+            return process_queue(n, workers=workers)
+    else:
+        @transaction
+        def run(n):
+            return process_queue(n)
 
     import datetime
 
@@ -34,6 +47,9 @@ if __name__ == '__main__':
     if nowait:
         print('Ignoring insert wait.')
 
+    if workers > 1:
+        print('Publishing with {} worker processes.'.format(workers))
+
     print ('Looking for scheduled tasks...')
 
     from core.models import Page, page_status, Queue
@@ -71,76 +87,122 @@ if __name__ == '__main__':
         from core.log import logger
         from time import sleep
 
-        for b in blogs_to_check:
+        try:
+            for b in blogs_to_check:
+                try:
+                    n = blogs_to_check[b]
+                    skip = None
+
+                    if clear_job:
+                        Queue.stop(n)
+
+                    if nowait is False and Queue.is_insert_active(n):
+                        skip = 'Insert in progress for blog {}. Skipping this run.'.format(n.id)
+                    elif Queue.control_jobs(n).count() > 0:
+                        skip = 'Job already running for blog {}. Skipping this run.'.format(n.id)
+                    if skip:
+                        print (skip)
+                        scheduled_page_report.append(skip)
+                        continue
+
+                    for p in scheduled_pages.where(Page.blog == b).distinct():
+                        scheduled_page_report.append('Scheduled pages:')
+                        try:
+                            with db.atomic() as txn:
+                                scheduled_page_report.append('{} -- on {}'.format(p.title, p.publication_date))
+                                p.status = page_status.published
+                                p.save(p.user, no_revision=True)
+                                queue_page_actions((p,))
+                                blogs_to_check[p.blog.id] = p.blog
+
+                        except Exception as e:
+                            problem = 'Problem with page {}: {}'.format(n.title, e)
+                            print (problem)
+                            scheduled_page_report.append(problem)
+
+                    queue_index_actions(n)
+                    queue_ssi_actions(n)
+
+                    waiting = Queue.job_counts(blog=n)
+                    waiting_report = '{} jobs waiting for blog {}'.format(waiting, n.id)
+                    print (waiting_report)
+                    scheduled_page_report.append(waiting_report)
+
+                    Queue.start(n)
+
+                    print ("Processing {} jobs for blog '{}'.".format(
+                        waiting, n.name))
+
+                    from time import clock
+                    begin = clock()
+
+                    passes = 1
+
+                    while 1:
+                        sleep(.1)
+                        remaining = run(n)
+                        print ("Pass {}: {} jobs remaining.".format(passes, remaining))
+                        if remaining == 0:
+                            break
+                        passes += 1
+
+                    end = clock()
+
+                    total_time = end - begin
+
+                    time_elapsed = "Total elapsed time: {} seconds".format(int(total_time))
+                    print (time_elapsed)
+                    scheduled_page_report.append(time_elapsed)
+
+                except Exception as e:
+                    problem = 'Problem with blog {}: {}'.format(b, e)
+                    print (problem)
+                    scheduled_page_report.append(problem)
+
+        finally:
+            close_publish_pool()
+
+    if gc:
+        # Look for output files that no fileinfo or media object accounts for.
+        # --gc only reports them; --gc-delete removes them.
+        # Blogs with a queue job underway are skipped, since files may be
+        # written there for fileinfos created after the check began.
+
+        from core.models import Blog
+        from core.cms.fileinfo import collect_orphaned_files
+        from core.error import DeletionError
+        from settings import GC_REPORT_LIMIT
+
+        print ('Looking for orphaned output files...')
+
+        for n in Blog.select():
+            if Queue.control_jobs(n).count() > 0:
+                skip = 'Job running for blog {}. Skipping orphaned file check.'.format(n.id)
+                print (skip)
+                scheduled_page_report.append(skip)
+                continue
+
             try:
-                n = blogs_to_check[b]
-                skip = None
-
-                if clear_job:
-                    Queue.stop(n)
-
-                if nowait is False and Queue.is_insert_active(n):
-                    skip = 'Insert in progress for blog {}. Skipping this run.'.format(n.id)
-                elif Queue.control_jobs(n).count() > 0:
-                    skip = 'Job already running for blog {}. Skipping this run.'.format(n.id)
-                if skip:
-                    print (skip)
-                    scheduled_page_report.append(skip)
-                    continue
-
-                for p in scheduled_pages.where(Page.blog == b).distinct():
-                    scheduled_page_report.append('Scheduled pages:')
-                    try:
-                        with db.atomic() as txn:
-                            scheduled_page_report.append('{} -- on {}'.format(p.title, p.publication_date))
-                            p.status = page_status.published
-                            p.save(p.user, no_revision=True)
-                            queue_page_actions((p,))
-                            blogs_to_check[p.blog.id] = p.blog
-
-                    except Exception as e:
-                        problem = 'Problem with page {}: {}'.format(n.title, e)
-                        print (problem)
-                        scheduled_page_report.append(problem)
-
-                queue_index_actions(n)
-                queue_ssi_actions(n)
-
-                waiting = Queue.job_counts(blog=n)
-                waiting_report = '{} jobs waiting for blog {}'.format(waiting, n.id)
-                print (waiting_report)
-                scheduled_page_report.append(waiting_report)
-
-                Queue.start(n)
-
-                print ("Processing {} jobs for blog '{}'.".format(
-                    waiting, n.name))
-
-                from time import clock
-                begin = clock()
-
-                passes = 1
-
-                while 1:
-                    sleep(.1)
-                    remaining = run(n)
-                    print ("Pass {}: {} jobs remaining.".format(passes, remaining))
-                    if remaining == 0:
-                        break
-                    passes += 1
-
-                end = clock()
-
-                total_time = end - begin
-
-                time_elapsed = "Total elapsed time: {} seconds".format(int(total_time))
-                print (time_elapsed)
-                scheduled_page_report.append(time_elapsed)
-
-            except Exception as e:
-                problem = 'Problem with blog {}: {}'.format(b, e)
-                print (problem)
-                scheduled_page_report.append(problem)
+                orphans = collect_orphaned_files(n, delete=gc_delete)
+            except DeletionError as e:
+                skip = 'Skipping orphaned file check: {}'.format(e)
+                print (skip)
+                scheduled_page_report.append(skip)
+                continue
+
+            gc_report = '{} of {} output files orphaned for blog {}{}'.format(
+                len(orphans.orphans), orphans.checked, n.id,
+                '; {} deleted'.format(len(orphans.deleted)) if gc_delete else '')
+            print (gc_report)
+
+            if orphans.orphans:
+                # Only the first few paths are listed, to keep the emailed report short.
+                listed = orphans.deleted if gc_delete else orphans.orphans
+                limit = int(GC_REPORT_LIMIT)
+                scheduled_page_report.append(gc_report)
+                scheduled_page_report.extend(listed[:limit])
+                if len(listed) > limit:
+                    scheduled_page_report.append('... and {} more.'.format(len(listed) - limit))
 
     if scheduled_page_report:
         message_text = '''
@@ -170,6 +232,7 @@ This is a scheduled-tasks report from the installation of {}.
 
         print ('Reports emailed to {}.'.format(','.join(admins)))
 
+        from core.log import logger
         logger.info("Scheduled job run, processed {} pages.".format(total_pages))
 
     else:
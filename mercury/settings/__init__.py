@@ -21,6 +21,8 @@ PRODUCT_NAME = "Mercury " + __version__
 DATA_FILE_PATH = os.sep + 'data'
 EXPORT_FILE_PATH = _join(DATA_FILE_PATH, 'saved')
 PLUGIN_FILE_PATH = _join(DATA_FILE_PATH, 'plugins')
+TEMPLATE_CACHE_FILE_PATH = _join(DATA_FILE_PATH, 'cache')
+QUERY_STATS_FILE_PATH = _join(DATA_FILE_PATH, 'queries.json')
 
 # Top-level path to the application.
 # Automatically calculated; does not need to be changed.
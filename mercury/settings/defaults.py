@@ -65,6 +65,68 @@ MAX_FILESIZE = 300000
 # about batch operations timing out, but the default should suffice.
 MAX_BATCH_OPS = 50
 
+# Number of worker processes used to publish queued jobs from the
+# scheduled-tasks script. Each worker keeps its own database connection
+# and template cache. Leave this at 1 to publish in a single process.
+# Queue runs started from the web interface always use a single process.
+PUBLISH_WORKERS = 1
+
+# Number of background threads that write published files to disk
+# while the next files are being rendered. Set to 0 to write each file
+# before rendering the next one.
+WRITER_THREADS = 2
+
+# Number of rendered files that can wait for a writer thread before
+# rendering pauses to let the disk catch up.
+WRITER_QUEUE_SIZE = 32
+
+# Number of orphaned output files removed in a single batch
+# by the output file garbage collector. See collect_orphaned_files.
+GC_BATCH_SIZE = 500
+
+# Comma-separated filename patterns in a blog's output directory
+# that the output file garbage collector never treats as orphaned,
+# e.g. hand-placed .htaccess or verification files.
+GC_IGNORE_PATTERNS = '.*'
+
+# Number of orphaned file paths listed for each blog in the emailed
+# scheduled-tasks report; any more are counted but not listed.
+GC_REPORT_LIMIT = 50
+
+# Count and time the database queries made in each request, queue job
+# and template render, and list them at /system/queries.
+# This adds overhead to every query, so leave it off unless you're
+# looking into performance.
+QUERY_STATS = False
+
+# Number of times a query of the same shape can run in a single
+# request, queue job or render before it's flagged as repeated.
+QUERY_STATS_REPEAT_LIMIT = 10
+
+# Number of query reports kept for /system/queries.
+QUERY_STATS_HISTORY = 50
+
+# Keep compiled template code in /data/cache, so that templates
+# don't need to be recompiled for every request when running as CGI.
+TEMPLATE_CODE_CACHE = True
+
+# Maximum size, in bytes, of the compiled template code cache.
+# The least recently used entries are removed when it grows past this.
+TEMPLATE_CODE_CACHE_SIZE = 16000000
+
+# Maximum number of entries kept in each of the in-memory caches
+# of compiled templates, includes and modules.
+TEMPLATE_CACHE_ENTRIES = 500
+
+# Memoize, for the rest of a publishing run, the output of every include
+# that appears to read only blog-level tags, such as headers and footers,
+# instead of rendering it again for every file.
+# Which tags an include reads is inferred from its compiled code, and
+# an include that reads state some other way would be served stale output,
+# so this is off by default. Includes can instead opt in one at a time
+# with a "%# cache" line, or opt out with "%# nocache".
+FRAGMENT_CACHE = False
+
 # Number of items listed on a page in a listing view.
 ITEMS_PER_PAGE = 15
 
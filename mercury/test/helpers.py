@@ -0,0 +1,193 @@
+'''
+Shared set-up for tests that publish a blog.
+
+Like test_setup.py, these tests recreate the configured database,
+so they should only be run against a test installation.
+'''
+
+import unittest
+import os
+import shutil
+import tempfile
+import datetime
+
+import settings
+
+
+class BlogTestCase(unittest.TestCase):
+    '''
+    Creates a site and a blog with the default theme,
+    publishing to a temporary directory, along with a few pages.
+    '''
+
+    # Number of published pages created for the blog.
+    page_count = 4
+
+    def setUp(self):
+        from core.models import init_db, db
+        from core.models import Site, User, Theme
+        from core.auth import role
+        from core.cms import invalidate_cache
+
+        init_db.recreate_database()
+        db.connect()
+        invalidate_cache()
+
+        self.output_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.output_path, True)
+
+        self.site = Site.create(
+            name="Test site",
+            description="The description for the test site.",
+            url="http://localhost/test",
+            path=self.output_path)
+
+        self.user = User(
+            name='Administrator',
+            email='admin.user@test-domain.com',
+            encrypted_password='password')
+        self.user.save_pwd()
+        self.user.add_permission(permission=role.SYS_ADMIN,
+            site=self.site).save()
+
+        theme_path = os.path.join(settings.THEME_FILE_PATH, settings.DEFAULT_THEME)
+        if not os.path.isdir(theme_path):
+            shutil.copytree(os.path.join(settings.APPLICATION_PATH,
+                settings.INSTALL_SRC_PATH, 'themes', settings.DEFAULT_THEME),
+                theme_path)
+
+        self.theme = Theme.install_to_system(settings.DEFAULT_THEME)
+
+        self.blog = self.create_blog("Test blog", self.site.url, self.site.path)
+
+        self.pages = [self.create_page(n) for n in range(self.page_count)]
+
+        from core.cms.fileinfo import build_blog_fileinfos
+        build_blog_fileinfos(self.blog)
+
+    def create_blog(self, name, url, path):
+        '''
+        Creates a blog on the test site with the default theme.
+        '''
+        from core.models import Blog
+
+        blog = Blog(
+            site=self.site,
+            name=name,
+            description="The description for the {}.".format(name.lower()),
+            url=url,
+            path=path,
+            local_path=path,
+            theme=self.theme)
+        blog.setup(self.user, self.theme)
+        return blog
+
+    def create_page(self, n, status=None, blog=None):
+        '''
+        Creates a page, one month after the previous one,
+        in the blog's default category.
+        '''
+        from core.models import Page, PageCategory, page_status
+
+        blog = self.blog if blog is None else blog
+        date = datetime.datetime(2016, 1, 1) + datetime.timedelta(days=31 * n)
+
+        page = Page(
+            title='Page {}'.format(n),
+            basename='page-{}'.format(n),
+            text='<p>Text for page {}.</p>'.format(n),
+            excerpt='Excerpt for page {}.'.format(n),
+            user=self.user,
+            blog=blog,
+            status=page_status.published if status is None else status,
+            publication_date=date,
+            modified_date=date)
+        page.save(self.user)
+
+        PageCategory.create(page=page,
+            category=blog.default_category,
+            primary=True)
+
+        return page
+
+    def create_include(self, title, body):
+        '''
+        Creates an include template in the blog's theme.
+        '''
+        from core.models import Template, template_type, publishing_mode
+        from core.cms import invalidate_cache
+
+        template = Template(blog=self.blog, theme=self.blog.theme,
+            title=title, template_type=template_type.include,
+            publishing_mode=publishing_mode.include, body=body)
+        template.save(self.user)
+        invalidate_cache()
+        return template
+
+    def page_template(self):
+        '''
+        Returns the theme's template for individual pages.
+        '''
+        from core.models import Template, template_type
+
+        return self.blog.templates(template_type.page).where(
+            Template.title == 'Page Template').get()
+
+    def edit_elsewhere(self, template, **fields):
+        '''
+        Updates a template as another process would: directly in the database,
+        so nothing in this process is invalidated.
+        '''
+        from core.models import Template
+
+        Template.update(modified_date=datetime.datetime.utcnow(), **fields).where(
+            Template.id == template.id).execute()
+
+    def render(self, source, tags=None):
+        '''
+        Renders a template's source with the blog's publishing tags,
+        or with the tags given.
+        '''
+        from core.models import PublishingTags
+        from core.template import MetalTemplate
+
+        tags = PublishingTags(blog=self.blog) if tags is None else tags
+        return MetalTemplate(source, tags=tags.namespace).render(tags.namespace)
+
+    def run_queue(self, blog=None, workers=1):
+        '''
+        Starts the blog's queue and runs it until it's empty.
+        '''
+        from core.models import Queue
+        from core.cms import queue
+
+        blog = self.blog if blog is None else blog
+
+        Queue.start(blog)
+        while queue.process_queue(blog, workers=workers):
+            pass
+
+    def publish(self, blog=None, workers=1):
+        '''
+        Queues the whole blog for publishing and runs the queue until it's empty.
+        '''
+        from core.cms import cms
+
+        blog = self.blog if blog is None else blog
+
+        cms.republish_blog(blog)
+        self.run_queue(blog, workers)
+
+    def output_files(self, path=None):
+        '''
+        Returns a dictionary of the files under the output path,
+        relative to it, with their contents.
+        '''
+        path = self.output_path if path is None else path
+        files = {}
+        for root, dirs, names in os.walk(path):
+            for name in names:
+                full_path = os.path.join(root, name)
+                with open(full_path, 'rb') as f:
+                    files[os.path.relpath(full_path, path).replace(os.sep, '/')] = f.read()
+        return files
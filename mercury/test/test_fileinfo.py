@@ -0,0 +1,289 @@
+import unittest
+
+from helpers import BlogTestCase
+
+
+class PermalinkTest(BlogTestCase):
+    '''
+    The page permalink stored with the page's fileinfos.
+    '''
+
+    def test_stored_path_is_blog_relative(self):
+        from core.models import Page
+
+        page = Page.load(self.pages[0].id)
+        self.assertEqual(page.canonical_file_path, page.default_fileinfo.file_path)
+        self.assertEqual(page.permalink,
+            self.blog.url + '/' + page.default_fileinfo.file_path)
+
+    def test_permalink_follows_blog_url(self):
+        from core.models import Blog, Page, prefetch_pages
+
+        Blog.update(url='http://localhost/moved').where(
+            Blog.id == self.blog.id).execute()
+
+        page = Page.load(self.pages[0].id)
+        expected = 'http://localhost/moved/' + page.canonical_file_path
+        self.assertEqual(page.permalink, expected)
+
+        page = Page.load(self.pages[0].id)
+        prefetch_pages([page])
+        self.assertEqual(page.permalink, expected)
+
+
+class FileInfoCollisionTest(BlogTestCase):
+    '''
+    Paths that collide with another page's fileinfo.
+    '''
+
+    def colliding_page(self):
+        # Moved onto the first page's basename and date,
+        # without going through the page editor's checks.
+        from core.models import Page
+        first, second = self.pages[0], self.pages[1]
+        Page.update(basename=first.basename,
+            publication_date=first.publication_date).where(
+            Page.id == second.id).execute()
+        return Page.load(second.id)
+
+    def fileinfo_rows(self):
+        from core.models import FileInfo
+        return sorted(FileInfo.select(FileInfo.id, FileInfo.page,
+            FileInfo.sitewide_file_path).tuples())
+
+    def test_update_page_fileinfos_reports_collision(self):
+        from core.error import FileInfoCollision
+        from core.cms.fileinfo import update_page_fileinfos
+
+        page = self.colliding_page()
+        before = self.fileinfo_rows()
+
+        with self.assertRaises(FileInfoCollision):
+            update_page_fileinfos(page)
+        self.assertEqual(self.fileinfo_rows(), before)
+
+    def test_bulk_builder_reports_collision(self):
+        from core.error import FileInfoCollision
+        from core.models import FileInfo
+        from core.cms.fileinfo import build_pages_fileinfos_bulk
+
+        page = self.colliding_page()
+        FileInfo.delete().where(FileInfo.page == page).execute()
+
+        with self.assertRaises(FileInfoCollision):
+            build_pages_fileinfos_bulk(self.blog, [page])
+
+    def test_collision_message_names_path(self):
+        from core.error import FileInfoCollision
+        from core.cms.fileinfo import update_page_fileinfos
+
+        from core.models import FileInfo
+
+        page = self.colliding_page()
+        paths = [n.sitewide_file_path for n in
+            FileInfo.select().where(FileInfo.page == self.pages[0].id)]
+
+        with self.assertRaises(FileInfoCollision) as raised:
+            update_page_fileinfos(page)
+        self.assertTrue(any('yields a path that already exists in the system: ' + n
+            in str(raised.exception) for n in paths))
+
+
+class FileInfoBuilderTest(BlogTestCase):
+    '''
+    The compiled, bulk and incremental fileinfo builders, checked against
+    the per-page builders they replace.
+    '''
+
+    def setUp(self):
+        super().setUp()
+        from core.models import Tag, TagAssociation
+
+        # Tags shared by every page and by some of them, for the tag archives.
+        for n, page in enumerate(self.pages):
+            for name in ('common', 'tag {}'.format(n % 2)):
+                tag = Tag.get_or_create(tag=name, blog=self.blog)
+                TagAssociation.create(tag=tag, page=page)
+
+    def fileinfo_state(self):
+        '''
+        Returns the fileinfos in the database, with their contexts,
+        by sitewide file path.
+        '''
+        from core.models import FileInfo, FileInfoContext
+
+        contexts = {}
+        for fileinfo_id, obj, ref in FileInfoContext.select(FileInfoContext.fileinfo,
+                FileInfoContext.object, FileInfoContext.ref).tuples():
+            contexts.setdefault(fileinfo_id, set()).add((obj, ref))
+
+        return dict((n.sitewide_file_path, (n.url, n.file_path,
+            n._data['template_mapping'], n._data['page'], n.mapping_sort,
+            contexts.get(n.id, set()))) for n in FileInfo.select())
+
+    def test_compiled_paths_match_path_strings(self):
+        from core.models import Page, template_type
+        from core.cms.fileinfo import (blog_mappings, eval_mapping_paths,
+            replace_mapping_tags)
+
+        mappings = blog_mappings(self.blog, (template_type.page, template_type.archive))
+        pages = [Page.load(n.id) for n in self.pages]
+
+        results = 0
+        for page, tags, mapping, paths in eval_mapping_paths(mappings, pages):
+            self.assertIsNotNone(paths)
+            self.assertEqual(paths,
+                eval(replace_mapping_tags(mapping.path_string), tags.namespace))
+            results += 1
+        self.assertEqual(results, len(mappings) * len(pages))
+
+    def test_edited_path_string_recompiled(self):
+        from core.models import Page, publishing_tags, template_type
+        from core.cms.fileinfo import blog_mappings
+
+        mapping = blog_mappings(self.blog, (template_type.page,))[0]
+        tags = publishing_tags(page=Page.load(self.pages[0].id))
+        first = eval(mapping.path_code, tags.namespace)
+
+        mapping.path_string = "'moved/'+" + mapping.path_string
+        self.assertEqual(eval(mapping.path_code, tags.namespace), 'moved/' + first)
+
+    def build_legacy(self):
+        '''
+        Rebuilds the blog's fileinfos from scratch with the per-page builders.
+        '''
+        from core.models import FileInfo, FileInfoContext, template_type
+        from core.cms.fileinfo import (build_indexes_fileinfos,
+            build_pages_fileinfos, build_archives_fileinfos)
+
+        FileInfoContext.delete().execute()
+        FileInfo.delete().execute()
+        build_indexes_fileinfos(list(self.blog.templates(template_type.include)) +
+            list(self.blog.templates(template_type.index)))
+        build_pages_fileinfos(self.blog.pages)
+        self.assertGreater(build_archives_fileinfos(self.blog.pages.published), 0)
+
+    def test_bulk_matches_legacy_builders(self):
+        from core.cms.fileinfo import build_blog_fileinfos
+
+        build_blog_fileinfos(self.blog)
+        bulk = self.fileinfo_state()
+        self.assertIn(self.blog.path + '/tags/tag-1/index.html', bulk)
+
+        self.build_legacy()
+        self.assertEqual(bulk, self.fileinfo_state())
+
+    def test_bulk_pages_match_legacy_builders(self):
+        from core.models import Page
+        from core.cms.fileinfo import build_pages_fileinfos_bulk
+
+        self.build_legacy()
+        legacy = self.fileinfo_state()
+
+        page = Page.load(self.create_page(self.page_count).id)
+        build_pages_fileinfos_bulk(self.blog, [page])
+        bulk = self.fileinfo_state()
+
+        self.build_legacy()
+        self.assertEqual(bulk, self.fileinfo_state())
+        self.assertGreater(len(bulk), len(legacy))
+
+    def test_day_archives_match_legacy_builders(self):
+        from core.models import TemplateMapping
+        from core.cms.fileinfo import build_blog_fileinfos, build_mapping_xrefs
+
+        mapping = TemplateMapping.get(TemplateMapping.path_string == "'%Y/%m/'+$i ")
+        mapping.path_string = "'%Y/%m/%d/'+$i"
+        build_mapping_xrefs((mapping,))
+        self.assertEqual(mapping.archive_xref, 'YMD')
+
+        build_blog_fileinfos(self.blog)
+        bulk = self.fileinfo_state()
+        self.assertIn(self.blog.path + '/2016/02/01/index.html', bulk)
+        members = self.archive_members()
+        self.assertEqual(members, self.archive_members(indexed=False))
+
+        self.build_legacy()
+        self.assertEqual(bulk, self.fileinfo_state())
+
+    def archive_members(self, indexed=True):
+        '''
+        Returns the IDs of the pages in each of the blog's archive
+        fileinfos, by fileinfo ID, from the archive membership index
+        or else from the archive context queries.
+        '''
+        from unittest import mock
+        from core.models import FileInfo, template_type
+        from core.cms import fileinfo
+        from core.cms.fileinfo import blog_mappings, generate_archive_context_from_fileinfo
+
+        mappings = blog_mappings(self.blog, (template_type.archive,))
+        members = {}
+        with mock.patch.object(fileinfo, 'archive_membership_indexed',
+                side_effect=lambda blog: indexed):
+            for f in FileInfo.select().where(FileInfo.template_mapping << mappings):
+                members[f.id] = set(n.id for n in generate_archive_context_from_fileinfo(
+                    f.xref.archive_xref, self.blog.pages.published, f))
+        return members
+
+    def test_archive_membership_matches_context_queries(self):
+        from core.cms.fileinfo import build_blog_fileinfos
+
+        build_blog_fileinfos(self.blog)
+        members = self.archive_members()
+        self.assertEqual(members, self.archive_members(indexed=False))
+        self.assertIn(set(n.id for n in self.pages), members.values())
+
+    def test_archive_membership_follows_page_changes(self):
+        from core.models import Page, TagAssociation, page_status
+        from core.cms.fileinfo import build_blog_fileinfos, update_archive_membership
+
+        build_blog_fileinfos(self.blog)
+
+        retagged = Page.load(self.pages[0].id)
+        TagAssociation.delete().where(TagAssociation.page == retagged).execute()
+        unpublished = Page.load(self.pages[1].id)
+        unpublished.status = page_status.unpublished
+        unpublished.save(self.user)
+        update_archive_membership(self.blog, [retagged, unpublished])
+
+        members = self.archive_members()
+        self.assertEqual(members, self.archive_members(indexed=False))
+        self.assertFalse(any(unpublished.id in n for n in members.values()))
+
+    def test_page_update_matches_legacy_rebuild(self):
+        from core.models import Page, FileInfo, Tag, TagAssociation, db
+        from core.cms.fileinfo import (build_blog_fileinfos, update_page_fileinfos,
+            delete_page_fileinfo, build_pages_fileinfos, build_archives_fileinfos)
+
+        build_blog_fileinfos(self.blog)
+        ids = dict(FileInfo.select(FileInfo.sitewide_file_path, FileInfo.id).tuples())
+
+        Page.update(basename='renamed').where(Page.id == self.pages[1].id).execute()
+        TagAssociation.delete().where(TagAssociation.page == self.pages[1].id).execute()
+        TagAssociation.create(tag=Tag.create(tag='fresh', blog=self.blog),
+            page=self.pages[1].id)
+        page = Page.load(self.pages[1].id)
+
+        with db.atomic() as txn:
+            # As save_page() did before update_page_fileinfos().
+            delete_page_fileinfo(page)
+            build_archives_fileinfos((page,))
+            build_pages_fileinfos((page,))
+            legacy = self.fileinfo_state()
+            txn.rollback()
+        self.assertEqual(sorted(self.fileinfo_state()), sorted(ids))
+
+        update_page_fileinfos(page)
+        self.assertEqual(self.fileinfo_state(), legacy)
+        self.assertIn(self.blog.path + '/tags/fresh/index.html', legacy)
+
+        # Fileinfos whose paths are unchanged keep their IDs.
+        for path, fileinfo_id in FileInfo.select(FileInfo.sitewide_file_path,
+                FileInfo.id).tuples():
+            if path in ids:
+                self.assertEqual(fileinfo_id, ids[path])
+
+
+if __name__ == '__main__':
+    unittest.main()
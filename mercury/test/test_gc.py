@@ -0,0 +1,102 @@
+import unittest
+import os
+import datetime
+
+from helpers import BlogTestCase
+
+
+class OrphanedFilesTest(BlogTestCase):
+    '''
+    Finding and deleting orphaned output files.
+    '''
+
+    def setUp(self):
+        super().setUp()
+        self.publish()
+
+    def write(self, path, text='orphan'):
+        full_path = os.path.join(self.output_path, path)
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        with open(full_path, 'w') as f:
+            f.write(text)
+        return full_path
+
+    def collect(self, delete=False):
+        from core.cms.fileinfo import collect_orphaned_files
+        return collect_orphaned_files(self.blog, delete=delete)
+
+    def test_published_files_kept(self):
+        published = self.output_files()
+        orphan = self.write('old/orphan.html')
+
+        result = self.collect(delete=True)
+
+        self.assertEqual(result.orphans, [orphan])
+        self.assertEqual(result.deleted, [orphan])
+        self.assertFalse(os.path.exists(orphan))
+        self.assertEqual(self.output_files(), published)
+
+    def test_nested_blog_left_alone(self):
+        nested_path = os.path.join(self.output_path, 'nested')
+        nested = self.create_blog('Nested blog', self.site.url + '/nested', nested_path)
+        self.create_page(20, blog=nested)
+        self.publish(blog=nested)
+
+        nested_files = self.output_files(nested_path)
+        self.assertTrue(nested_files)
+
+        result = self.collect(delete=True)
+
+        self.assertEqual(result.orphans, [])
+        self.assertEqual(self.output_files(nested_path), nested_files)
+
+    def test_shared_directory_refused(self):
+        from core.error import DeletionError
+
+        from core.models import Blog
+
+        second = self.create_blog('Second blog', self.site.url + '/second',
+            os.path.join(self.output_path, 'second'))
+        # Paths are unique, but can name the same directory.
+        Blog.update(path=self.output_path + os.sep).where(Blog.id == second.id).execute()
+        orphan = self.write('old/orphan.html')
+
+        with self.assertRaises(DeletionError):
+            self.collect(delete=True)
+        self.assertTrue(os.path.exists(orphan))
+
+    def make_preview(self, page):
+        fileinfo = page.default_fileinfo
+        preview_path, preview_url = fileinfo.make_preview()
+        return self.write(preview_path, 'preview')
+
+    def test_current_preview_kept(self):
+        from core.models import Page
+
+        page = Page.load(self.pages[0].id)
+        preview = self.make_preview(page)
+
+        result = self.collect(delete=True)
+
+        self.assertNotIn(preview, result.orphans)
+        self.assertTrue(os.path.exists(preview))
+
+    def test_stale_preview_collected(self):
+        from core.models import Page, FileInfo
+
+        page = Page.load(self.pages[0].id)
+        preview = self.make_preview(page)
+
+        # The page was saved again after the preview was written.
+        Page.update(modified_date=datetime.datetime.utcnow() + datetime.timedelta(minutes=1)).where(
+            Page.id == page.id).execute()
+
+        result = self.collect(delete=True)
+
+        self.assertIn(preview, result.orphans)
+        self.assertFalse(os.path.exists(preview))
+        self.assertIsNone(FileInfo.get(FileInfo.id == page.default_fileinfo.id).preview_path)
+
+
+if __name__ == '__main__':
+    unittest.main()
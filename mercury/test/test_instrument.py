@@ -0,0 +1,60 @@
+import unittest
+from unittest import mock
+
+import settings
+
+
+class QueryCountingTest(unittest.TestCase):
+    '''
+    Counting and timing database queries.
+    '''
+
+    def setUp(self):
+        from core.models import db
+        db.connect()
+
+    def execute(self):
+        from core.models import db
+        db.execute_sql('SELECT 1')
+
+    def test_counted_queries_not_timed(self):
+        from core.db import instrument, sqlite
+
+        with mock.patch.object(settings, 'QUERY_STATS', False), \
+                mock.patch.object(sqlite, 'clock') as clock:
+            instrument.count_queries(True)
+            try:
+                before = instrument.query_count()
+                self.execute()
+                self.assertEqual(instrument.query_count(), before + 1)
+            finally:
+                instrument.count_queries(False)
+
+        clock.assert_not_called()
+
+    def test_scoped_queries_timed(self):
+        from core.db import instrument, sqlite
+
+        with mock.patch.object(settings, 'QUERY_STATS', True), \
+                mock.patch.object(instrument, 'save_report'), \
+                mock.patch.object(sqlite, 'clock', return_value=0.0) as clock:
+            with instrument.query_scope('test', 'Timed') as scope:
+                self.execute()
+
+        self.assertEqual(scope.count, 1)
+        self.assertEqual(clock.call_count, 2)
+
+    def test_render_profile_counts_without_timing(self):
+        from core.db import sqlite
+        from core.template import RenderProfile
+
+        with mock.patch.object(settings, 'QUERY_STATS', False), \
+                mock.patch.object(sqlite, 'clock') as clock:
+            with RenderProfile():
+                self.execute()
+
+        clock.assert_not_called()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,110 @@
+import unittest
+import datetime
+
+from helpers import BlogTestCase
+
+
+class PageNeighborTest(BlogTestCase):
+    '''
+    The materialized next/previous page index.
+    '''
+
+    def neighbor_rows(self):
+        from core.models import PageNeighbor
+        return PageNeighbor.select().where(PageNeighbor.blog == self.blog).count()
+
+    def test_built_with_blog_fileinfos(self):
+        from core.models import PageNeighbor
+        from core.cms.fileinfo import build_blog_fileinfos
+
+        PageNeighbor.delete().execute()
+        build_blog_fileinfos(self.blog)
+        self.assertEqual(self.neighbor_rows(), self.page_count)
+
+    def test_lookup_does_not_write(self):
+        from core.models import PageNeighbor, Page
+
+        PageNeighbor.delete().execute()
+        page = Page.load(self.pages[1].id)
+
+        self.assertEqual(page.next_page.id, self.pages[2].id)
+        self.assertEqual(page.previous_page.id, self.pages[0].id)
+        self.assertEqual(self.neighbor_rows(), 0)
+
+    def test_removed_neighbor_falls_back(self):
+        from core.models import PageNeighbor, Page
+
+        PageNeighbor.update(next_page=9999).where(
+            PageNeighbor.page == self.pages[1].id).execute()
+        page = Page.load(self.pages[1].id)
+
+        self.assertEqual(page.next_page.id, self.pages[2].id)
+
+    def test_resaving_unchanged_page_keeps_index(self):
+        from unittest import mock
+        from core.models import PageNeighbor, Page
+
+        page = Page.load(self.pages[1].id)
+        # As save_page() does for every edit.
+        page.status = page.status
+        page.publication_date = page.publication_date
+
+        with mock.patch.object(PageNeighbor, 'update_page') as update_page:
+            page.save(self.user)
+        update_page.assert_not_called()
+
+    def test_lookup_single_query(self):
+        from core.models import Page
+        from core.db import instrument
+
+        page = Page.load(self.pages[1].id)
+        instrument.count_queries(True)
+        try:
+            before = instrument.query_count()
+            next_page = page.next_page
+            self.assertEqual(instrument.query_count(), before + 1)
+        finally:
+            instrument.count_queries(False)
+
+        self.assertEqual(next_page.id, self.pages[2].id)
+        self.assertIsNone(Page.load(self.pages[-1].id).next_page)
+
+    def test_resaving_unchanged_page_not_reread(self):
+        from unittest import mock
+        from core.models import Page
+
+        page = Page.load(self.pages[1].id)
+        page.status = page.status
+        page.publication_date = page.publication_date
+
+        with mock.patch.object(Page, 'select') as select:
+            page.save(self.user, no_revision=True)
+        select.assert_not_called()
+
+    def test_moved_page_relinked(self):
+        from core.models import Page
+
+        page = Page.load(self.pages[0].id)
+        page.publication_date = datetime.datetime(2017, 1, 1)
+        page.save(self.user)
+
+        last = Page.load(self.pages[-1].id)
+        self.assertEqual(last.next_page.id, page.id)
+        self.assertEqual(Page.load(page.id).previous_page.id, last.id)
+        self.assertIsNone(Page.load(self.pages[1].id).previous_page)
+
+    def test_page_moved_twice_relinked(self):
+        from core.models import Page
+
+        page = Page.load(self.pages[0].id)
+        page.publication_date = datetime.datetime(2017, 1, 1)
+        page.save(self.user)
+        page.publication_date = datetime.datetime(2015, 1, 1)
+        page.save(self.user)
+
+        self.assertEqual(Page.load(self.pages[1].id).previous_page.id, page.id)
+        self.assertIsNone(Page.load(self.pages[-1].id).next_page)
+
+
+if __name__ == '__main__':
+    unittest.main()
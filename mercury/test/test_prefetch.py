@@ -0,0 +1,61 @@
+import unittest
+
+from helpers import BlogTestCase
+
+
+class PrefetchPagesTest(BlogTestCase):
+    '''
+    Page relations loaded in bulk by prefetch_pages().
+    '''
+
+    page_count = 2
+
+    def setUp(self):
+        super().setUp()
+        from core.models import Tag, TagAssociation, Media, MediaAssociation
+
+        for page in self.pages:
+            # Created out of order, and with names that only a
+            # case-sensitive sort keeps apart.
+            for name in ('beta', 'Alpha', 'alpha', 'Beta'):
+                tag = Tag.create(tag='{} {}'.format(name, page.id), blog=self.blog)
+                TagAssociation.create(tag=tag, page=page)
+
+            media = [Media.create(filename='{}-{}.jpg'.format(page.id, n),
+                path='{}/{}-{}.jpg'.format(self.output_path, page.id, n),
+                url='http://localhost/test/{}-{}.jpg'.format(page.id, n),
+                type='Image', user=self.user, blog=self.blog, site=self.site)
+                for n in range(3)]
+            for n in reversed(media):
+                MediaAssociation.create(media=n, page=page, blog=self.blog, site=self.site)
+
+    def load_pages(self):
+        from core.models import Page
+        return [Page.load(n.id) for n in self.pages]
+
+    def test_same_rows_in_same_order(self):
+        from core.models import prefetch_pages
+
+        queried = self.load_pages()
+        prefetched = self.load_pages()
+        prefetch_pages(prefetched)
+
+        for page, loaded in zip(queried, prefetched):
+            self.assertIsNotNone(loaded._prefetched)
+            for name in ('tags', 'media'):
+                self.assertEqual([n.id for n in getattr(loaded, name)],
+                    [n.id for n in getattr(page, name)])
+
+    def test_duplicate_links_listed_once(self):
+        from core.models import TagAssociation, prefetch_pages
+
+        page = self.load_pages()[0]
+        TagAssociation.create(tag=page.tags.get(), page=page)
+        expected = [n.id for n in page.tags]
+
+        prefetch_pages([page])
+        self.assertEqual([n.id for n in page.tags], expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
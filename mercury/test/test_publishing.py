@@ -0,0 +1,244 @@
+import unittest
+import os
+import shutil
+
+from helpers import BlogTestCase
+
+
+class PublishWorkersTest(BlogTestCase):
+    '''
+    Publishing with a pool of worker processes.
+    '''
+
+    def tearDown(self):
+        from core.cms.queue import close_publish_pool
+        close_publish_pool()
+
+    def clear_output(self):
+        shutil.rmtree(self.output_path)
+        os.mkdir(self.output_path)
+
+    def test_workers_match_single_process(self):
+        self.publish(workers=1)
+        single_process = self.output_files()
+        self.assertIn('2016/01/page-0.html', single_process)
+
+        self.clear_output()
+        self.publish(workers=2)
+
+        self.assertEqual(self.output_files(), single_process)
+
+    def test_workers_see_earlier_writes(self):
+        from core.models import Queue
+        from core.cms.queue import queue_page_actions
+
+        page = self.create_page(10)
+        queue_page_actions((page,))
+        self.run_queue(workers=2)
+
+        path = page.default_fileinfo.file_path
+        self.assertTrue(os.path.isfile(os.path.join(self.output_path, path)))
+        self.assertEqual(Queue.jobs(self.blog).count(), 0)
+
+    def test_workers_refuse_open_transaction(self):
+        # The workers couldn't see what the caller's transaction has written.
+        from core.error import DatabaseError
+        from core.models import db, Queue
+        from core.cms.queue import process_queue, queue_page_actions
+
+        with db.transaction():
+            queue_page_actions((self.pages[0],))
+            Queue.start(self.blog)
+            with self.assertRaises(DatabaseError):
+                process_queue(self.blog, workers=2)
+            db.rollback()
+
+    def test_single_process_by_default(self):
+        from core.cms import queue
+        self.publish(workers=None)
+        self.assertIsNone(queue._worker_pool)
+        self.assertIn('2016/01/page-0.html', self.output_files())
+
+    def test_worker_objects_kept_per_batch(self):
+        from core.models import Blog
+        from core.cms import queue
+
+        fileinfo = self.pages[0].default_fileinfo
+
+        job = (0, queue.job_type.page, fileinfo.id, self.blog.id, 'run', 'batch-1')
+        self.assertIsNone(queue._publish_worker(job)[1])
+        self.assertEqual(queue._worker_map.get(Blog, self.blog.id).name, self.blog.name)
+
+        Blog.update(name='Renamed blog').where(Blog.id == self.blog.id).execute()
+
+        self.assertIsNone(queue._publish_worker(job)[1])
+        self.assertEqual(queue._worker_map.get(Blog, self.blog.id).name, self.blog.name)
+
+        job = job[:-1] + ('batch-2',)
+        self.assertIsNone(queue._publish_worker(job)[1])
+        self.assertEqual(queue._worker_map.get(Blog, self.blog.id).name, 'Renamed blog')
+
+
+class RenderFingerprintTest(BlogTestCase):
+    '''
+    Skipping the render of files whose inputs are unchanged.
+    '''
+
+    page_template_body = ('{{page.title}}|{{page.primary_category.title}}|'
+        '{{page.author.name}}|{{blog.name}}|{{blog.kv_val("Setting")}}')
+
+    def setUp(self):
+        super().setUp()
+        template = self.page_template()
+        template.body = self.page_template_body
+        template.save(self.user)
+        self.publish()
+
+    def run_queue(self, blog=None, workers=1):
+        '''
+        Runs the queue until it's empty.
+        Returns the number of files that were rendered.
+        '''
+        from unittest import mock
+        from core.cms import queue
+
+        rendered = []
+
+        def generate_page_text(*a, **ka):
+            text = original(*a, **ka)
+            if text is not None:
+                rendered.append(text)
+            return text
+
+        original = queue.generate_page_text
+        with mock.patch.object(queue, 'generate_page_text', generate_page_text):
+            super().run_queue(blog, workers)
+
+        return len(rendered)
+
+    def republish(self, force=False):
+        '''
+        Queues the whole blog again and runs the queue.
+        Returns the number of files that were rendered.
+        '''
+        from core.cms import cms
+        cms.republish_blog(self.blog, force=force)
+        return self.run_queue()
+
+    def page_output(self):
+        with open(self.pages[0].default_fileinfo.sitewide_file_path, 'r', encoding='utf8') as f:
+            return f.read()
+
+    def test_unchanged_inputs_skip_render(self):
+        self.assertEqual(self.republish(), 0)
+
+    def test_force_renders_every_file(self):
+        self.assertGreater(self.republish(force=True), 0)
+        self.assertEqual(self.republish(), 0)
+
+    def test_purge_renders_every_file(self):
+        from core.cms import cms
+        cms.purge_blog(self.blog)
+        self.assertGreater(self.republish(), 0)
+
+    def test_missing_file_rendered(self):
+        import os
+        os.remove(self.pages[0].default_fileinfo.sitewide_file_path)
+        self.assertEqual(self.republish(), 1)
+        self.assertIn('Page 0|', self.page_output())
+
+    def test_page_edit_rerenders_page(self):
+        import datetime
+        from core.models import Page
+        Page.update(title='Edited page', modified_date=datetime.datetime.utcnow()).where(
+            Page.id == self.pages[0].id).execute()
+        self.assertEqual(self.republish(), 1)
+        self.assertTrue(self.page_output().startswith('Edited page|'))
+
+    def test_unfingerprinted_change_needs_force(self):
+        # A category isn't part of any fingerprint, so a plain
+        # republish skips the pages that show it.
+        from core.models import Category
+        Category.update(title='Renamed category').where(
+            Category.id == self.blog.default_category.id).execute()
+        self.assertEqual(self.republish(), 0)
+        self.assertGreater(self.republish(force=True), 0)
+        self.assertIn('|Renamed category|', self.page_output())
+
+    def test_queued_pages_rendered(self):
+        from core.models import User
+        from core.cms.queue import queue_page_actions
+        User.update(name='Renamed author').where(User.id == self.user.id).execute()
+        queue_page_actions((self.pages[0],), no_neighbors=True, no_archive=True)
+        self.assertEqual(self.run_queue(), 1)
+        self.assertIn('|Renamed author|', self.page_output())
+
+    def test_dependents_rendered(self):
+        from core.models import Blog, FileInfoDependency, dependency_type
+        from core.cms.queue import queue_dependent_actions
+        Blog.load(self.blog.id).kv_set('Setting', 'New value')
+        FileInfoDependency.record({self.pages[0].default_fileinfo.id:
+            {(dependency_type.page, self.pages[1].id)}})
+        queue_dependent_actions(self.blog, pages=(self.pages[1],))
+        self.assertGreater(self.run_queue(), 0)
+        self.assertIn('|New value', self.page_output())
+
+    def test_include_edit_rerenders(self):
+        import datetime
+        from core.models import Template, template_type
+        Template.update(modified_date=datetime.datetime.utcnow()).where(
+            Template.blog == self.blog,
+            Template.template_type == template_type.include).execute()
+        self.assertGreater(self.republish(), 0)
+
+    def test_template_edit_from_another_process(self):
+        self.edit_elsewhere(self.page_template(),
+            body='Edited|' + self.page_template_body)
+        self.assertGreater(self.republish(), 0)
+        self.assertTrue(self.page_output().startswith('Edited|'))
+
+
+class MappingJobTest(BlogTestCase):
+    '''
+    Reconciling fileinfos after a template mapping is edited.
+    '''
+
+    def edit_page_mapping(self, path_string):
+        from core.cms.fileinfo import build_mapping_xrefs
+
+        mapping = self.page_template().default_mapping
+        mapping.path_string = path_string
+        mapping.save()
+        build_mapping_xrefs((mapping,))
+
+    def test_editing_not_locked_by_queued_job(self):
+        from core.models import Queue
+        from core.auth import check_template_lock
+        from core.cms.queue import job_type
+
+        self.publish()
+        self.edit_page_mapping("'moved/%Y/'+$f")
+
+        self.assertEqual(Queue.jobs(self.blog).where(
+            Queue.job_type == job_type.mapping).count(), 1)
+        self.assertEqual(Queue.control_jobs(self.blog).count(), 0)
+        self.assertIsNone(check_template_lock(self.blog))
+
+    def test_next_pass_publishes_moved_files(self):
+        import os
+        from core.models import Queue, Page
+
+        self.publish()
+        self.edit_page_mapping("'moved/%Y/'+$f")
+
+        self.run_queue()
+
+        self.assertEqual(Queue.for_blog(self.blog).count(), 0)
+        page = Page.load(self.pages[0].id)
+        self.assertEqual(page.default_fileinfo.file_path, 'moved/2016/page-0.html')
+        self.assertTrue(os.path.isfile(os.path.join(self.output_path,
+            'moved', '2016', 'page-0.html')))
+
+
+if __name__ == '__main__':
+    unittest.main()
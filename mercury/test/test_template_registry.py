@@ -0,0 +1,61 @@
+import unittest
+
+from helpers import BlogTestCase
+
+
+class TemplateRegistryTest(BlogTestCase):
+    '''
+    Includes, modules and SSIs looked up in the per-blog template registry,
+    when their templates are changed by another process.
+    '''
+
+    page_count = 1
+
+    def setUp(self):
+        super().setUp()
+        self.include = self.create_include('Greeting', 'First')
+
+    def test_include_edited_by_another_process(self):
+        self.assertEqual(self.render('% include("Greeting")'), 'First')
+        self.edit_elsewhere(self.include, body='Second')
+        self.assertEqual(self.render('% include("Greeting")'), 'Second')
+
+    def test_include_added_by_another_process(self):
+        from core.models import Template, template_type, publishing_mode
+
+        self.assertEqual(self.render('% include("Greeting")'), 'First')
+        Template.insert(blog=self.blog, theme=self.blog.theme,
+            title='Farewell', template_type=template_type.include,
+            publishing_mode=publishing_mode.include, body='Bye',
+            modified_date=self.include.modified_date).execute()
+        self.assertEqual(self.render('% include("Farewell")'), 'Bye')
+
+    def test_ssi_moved_by_another_process(self):
+        from core.models import FileInfo, TemplateMapping, Template
+
+        source = '{{blog.ssi("Footer")}}\n% ssi("Footer")'
+        self.assertIn('_include/footer.html', self.render(source))
+
+        footer = Template.select().where(Template.blog == self.blog,
+            Template.title == 'Footer').get()
+        FileInfo.update(file_path='_include/moved.html').where(
+            FileInfo.template_mapping << TemplateMapping.select(TemplateMapping.id).where(
+                TemplateMapping.template == footer)).execute()
+
+        output = self.render(source)
+        self.assertNotIn('_include/footer.html', output)
+        self.assertEqual(output.count('_include/moved.html'), 2)
+
+    def test_checked_once_per_render(self):
+        from unittest import mock
+        from core.cms import TemplateRegistry
+
+        read_stamp = TemplateRegistry.read_stamp
+        with mock.patch.object(TemplateRegistry, 'read_stamp',
+                side_effect=read_stamp) as checked:
+            self.render('% include("Greeting")\n% include("Greeting")\n{{blog.ssi("Footer")}}')
+        self.assertEqual(checked.call_count, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
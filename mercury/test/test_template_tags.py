@@ -0,0 +1,80 @@
+import unittest
+
+from helpers import BlogTestCase
+
+
+class LazyTagsTest(BlogTestCase):
+    '''
+    Template tags that are only computed if a template reads them.
+    '''
+
+    page_count = 1
+
+    def test_unread_tags_not_computed(self):
+        from unittest import mock
+        from core.models import PublishingTags
+
+        tags = PublishingTags(blog=self.blog)
+        with mock.patch.object(PublishingTags, '_get_sites') as get_sites:
+            self.assertEqual(self.render('{{blog.name}}', tags), self.blog.name)
+        get_sites.assert_not_called()
+
+    def test_read_tags_computed_once(self):
+        from core.models import PublishingTags
+
+        tags = PublishingTags(blog=self.blog)
+        source = '{{sites.count()}} {{len([s for s in sites])}} {{defined("sites")}}'
+        self.assertEqual(self.render(source, tags), '1 1 True')
+
+    def test_lazy_tags_read_in_include(self):
+        self.create_include('Site count', '{{sites.count()}}')
+        self.assertEqual(self.render('% include("Site count")'), '1')
+
+    def test_admin_state_defined_when_publishing(self):
+        from core.models import PublishingTags
+
+        tags = PublishingTags(page=self.pages[0])
+        source = '{{request}} {{csrf}} {{csrf_token}} {{queue}} {{queue_count}}'
+        self.assertEqual(self.render(source, tags), 'None None None None None')
+
+    def test_admin_tags_still_forced_for_ui(self):
+        from core.models import TemplateTags
+
+        tags = TemplateTags(blog=self.blog, user=self.user)
+        values = tags.__dict__
+        for name in TemplateTags.lazy_attributes:
+            self.assertIn(name, values)
+
+
+
+class FragmentScopeTest(BlogTestCase):
+    '''
+    Which includes have their output memoized during a publishing run.
+    '''
+
+    page_count = 1
+
+    def scope(self, source):
+        from core.models import PublishingTags
+        from core.template import MetalTemplate
+        tags = PublishingTags(blog=self.blog)
+        return MetalTemplate(source, tags=tags.namespace).fragment_scope
+
+    def test_includes_not_memoized_by_default(self):
+        self.assertIsNone(self.scope('{{blog.name}}'))
+
+    def test_include_opts_in(self):
+        self.assertEqual(self.scope('% # cache\n{{blog.name}}'), ())
+        self.assertEqual(self.scope('% # cache: page\n{{page.title}}'), ('page',))
+
+    def test_automatic_memoizing_skips_page_reads(self):
+        from unittest import mock
+        from core import template
+
+        with mock.patch.object(template, 'FRAGMENT_CACHE', True):
+            self.assertEqual(self.scope('{{blog.name}}'), ())
+            self.assertIsNone(self.scope('{{page.title}}'))
+
+
+if __name__ == '__main__':
+    unittest.main()